@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+Measure the throughput, latency percentiles and peak memory usage of
+:class:`robgracli.client.GraphiteClient` against a synthetic local Graphite
+server (see ``fake_graphite.py``).
+
+Usage, with robgracli installed (e.g. with ``pip install -e .``)::
+
+    python benchmarks/bench_client.py --targets 1000 --output new.json
+    python benchmarks/bench_client.py --targets 1000 --compare new.json
+
+Results saved with ``--output`` can be given to ``--compare`` to show the
+relative changes between two versions, with the same parameters.
+'''
+from __future__ import division, print_function
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from robgracli.aggregators import percentile
+from robgracli.client import GraphiteClient, trim_datapoints
+
+from fake_graphite import FakeGraphite
+
+
+def scenarios(client, server, from_):
+    '''
+    Return the benchmarked operations, as ``(name, func)`` pairs.
+    '''
+    datapoints = json.loads(server.render(('servers.host00000.cpu',)))[0][
+        'datapoints']
+    return [
+        ('query', lambda: client.query('servers.*.cpu', from_)),
+        ('aggregate', lambda: client.aggregate('servers.*.cpu', from_)),
+        ('aggregate_p95',
+         lambda: client.aggregate('servers.*.cpu', from_, 'p95')),
+        ('trim_datapoints',
+         lambda: trim_datapoints(datapoints, from_ // 2)),
+        ('find_metrics', lambda: client.find_metrics('servers.*.*')),
+    ]
+
+
+def run(func, requests, concurrency, client):
+    '''
+    Call *func* *requests* times with *concurrency* threads. Return the
+    elapsed time, the sorted latencies of the successful calls and the
+    number of errors.
+    '''
+    def timed(_):
+        start = time.time()
+        func()
+        return time.time() - start
+
+    start = time.time()
+    if concurrency > 1:
+        results = client.map_parallel(timed, range(requests), concurrency)
+    else:
+        results = []
+        for i in range(requests):
+            try:
+                results.append((timed(i), None))
+            except Exception as exc:
+                results.append((None, exc))
+    elapsed = time.time() - start
+    latencies = sorted(latency for latency, exc in results if exc is None)
+    errors = sum(1 for _, exc in results if exc is not None)
+    return elapsed, latencies, errors
+
+
+def peak_memory(func):
+    '''
+    Return the peak memory allocated by a call to *func*, in bytes, or None
+    if :mod:`tracemalloc` is not available.
+    '''
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+    except Exception:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench(args):
+    server = FakeGraphite(args.targets, args.points, args.step,
+                          args.null_ratio, args.latency, args.error_ratio)
+    results = {}
+    with server:
+        client = GraphiteClient(server.url, max_retries=0,
+                                pool_maxsize=max(10, args.concurrency))
+        from_ = args.points * args.step
+        for name, func in scenarios(client, server, from_):
+            if args.scenarios and name not in args.scenarios:
+                continue
+            run(func, 1, 1, client)  # warm up
+            elapsed, latencies, errors = run(func, args.requests,
+                                             args.concurrency, client)
+            result = {
+                'throughput': len(latencies) / elapsed,
+                'errors': errors,
+                'peak_memory': peak_memory(func),
+            }
+            for n in (50, 90, 99):
+                result['p%d' % n] = percentile(latencies, n) \
+                    if latencies else None
+            results[name] = result
+        client.session.close()
+    return results
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_results(results, baseline=None):
+    columns = ['throughput', 'p50', 'p90', 'p99', 'peak_memory']
+    print('%-16s %12s %10s %10s %10s %12s %7s' % (
+        'scenario', 'calls/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak bytes',
+        'errors'))
+    for name, result in sorted(results.items()):
+        print('%-16s %12.1f %10s %10s %10s %12s %7d' % (
+            name, result['throughput'], ms(result['p50']), ms(result['p90']),
+            ms(result['p99']), result['peak_memory'], result['errors']))
+        if baseline is not None and name in baseline:
+            print('%-16s %12s %10s %10s %10s %12s' % tuple(
+                ['  vs baseline'] + [change(result[c], baseline[name][c])
+                                     for c in columns]))
+
+
+def ms(value):
+    return '-' if value is None else '%.2f' % (value * 1000)
+
+
+def change(value, baseline):
+    if value is None or not baseline:
+        return '-'
+    return '%+.1f%%' % ((value - baseline) * 100. / baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--targets', type=int, default=100)
+    parser.add_argument('--points', type=int, default=360)
+    parser.add_argument('--step', type=int, default=10)
+    parser.add_argument('--null-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='server latency, in seconds')
+    parser.add_argument('--error-ratio', type=float, default=0)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='number of calls per scenario')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='*',
+                        help='scenarios to run, all by default')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare',
+                        help='compare results to this JSON file')
+    args = parser.parse_args()
+    params = dict((k, v) for k, v in vars(args).items()
+                  if k not in ('output', 'compare', 'scenarios'))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            saved = json.load(fp)
+        if saved['params'] != params:
+            print('warning: baseline parameters differ: %r' %
+                  saved['params'], file=sys.stderr)
+        baseline = saved['results']
+    print('%d targets x %d points, version %s' % (args.targets, args.points,
+                                                  version()))
+    results = bench(args)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'version': version(),
+                'python': platform.python_version(),
+                'time': time.time(),
+                'params': params,
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
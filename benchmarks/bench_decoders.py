@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+Compare the decoding time and size of the ``/render`` formats supported by
+:mod:`robgracli.decoders`, on synthetic data.
+
+Usage, with robgracli installed (e.g. with ``pip install -e .``)::
+
+    python benchmarks/bench_decoders.py --targets 1000 --points 360
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import pickle
+import random
+import time
+import zlib
+
+from robgracli import decoders
+
+
+def make_series(targets, points, null_ratio, step=10, start=1417629000):
+    rand = random.Random(42)
+    ret = []
+    for i in range(targets):
+        values = [None if rand.random() < null_ratio else
+                  round(rand.uniform(0, 100), 3) for _ in range(points)]
+        ret.append({
+            'name': 'servers.host%05d.cpu.user' % i,
+            'start': start,
+            'end': start + points * step,
+            'step': step,
+            'values': values,
+        })
+    return ret
+
+
+def encode_json(series):
+    return json.dumps([{
+        'target': s['name'],
+        'datapoints': [[v, s['start'] + i * s['step']]
+                       for i, v in enumerate(s['values'])],
+    } for s in series]).encode('utf-8')
+
+
+def encode_pickle(series):
+    return pickle.dumps(series, protocol=2)
+
+
+def encode_raw(series):
+    lines = ['%s,%s,%s,%s|%s' % (s['name'], s['start'], s['end'], s['step'],
+                                 ','.join(str(v) for v in s['values']))
+             for s in series]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def encode_csv(series):
+    lines = []
+    for s in series:
+        for i, v in enumerate(s['values']):
+            date = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.gmtime(s['start'] + i * s['step']))
+            lines.append('%s,%s,%s' % (s['name'], date,
+                                       '' if v is None else v))
+    return '\n'.join(lines).encode('utf-8')
+
+
+ENCODERS = [
+    ('json', encode_json),
+    ('pickle', encode_pickle),
+    ('raw', encode_raw),
+    ('csv', encode_csv),
+]
+
+
+def bench(format, content, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        decoders.decode(format, content)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--targets', type=int, default=1000)
+    parser.add_argument('--points', type=int, default=360)
+    parser.add_argument('--null-ratio', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    series = make_series(args.targets, args.points, args.null_ratio)
+    json_backend = getattr(decoders.fast_json, '__name__', 'json')
+    print('%d targets x %d points, json backend: %s' % (
+        args.targets, args.points, json_backend))
+    print('%-8s %12s %12s %10s' % ('format', 'bytes', 'gzip bytes',
+                                   'decode ms'))
+    for format, encode in ENCODERS:
+        content = encode(series)
+        elapsed = bench(format, content, args.repeat)
+        print('%-8s %12d %12d %10.1f' % (format, len(content),
+                                         len(zlib.compress(content)),
+                                         elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+'''
+A stand-in Graphite server serving synthetic ``/render`` and
+``/metrics/find`` responses, for benchmarks.
+
+The namespace is ``servers.hostNNNNN.{cpu,load,memory}``, with *targets*
+hosts. Rendering a target with globs returns one series per matching metric,
+each of *points* datapoints with a ratio of *null_ratio* None values.
+Responses are generated once per set of parameters and cached, so the
+server's own cost stays out of the measurements.
+
+Can also be run standalone::
+
+    python benchmarks/fake_graphite.py --port 8080 --targets 1000
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+
+METRICS = ['cpu', 'load', 'memory']
+
+
+class FakeGraphite(object):
+    '''
+    A synthetic Graphite server, listening on localhost in a background
+    thread.
+
+    :param targets: the number of hosts in the namespace;
+    :param points: the number of datapoints of each series;
+    :param step: the interval between datapoints, in seconds;
+    :param null_ratio: the ratio of None values in the series;
+    :param latency: a delay added before each response, in seconds;
+    :param error_ratio: the ratio of requests answered with a 500 error;
+    :param port: the port to listen on, a random free port by default.
+    '''
+
+    def __init__(self, targets=100, points=360, step=10, null_ratio=0.1,
+                 latency=0, error_ratio=0, port=0, seed=42):
+        self.targets = targets
+        self.points = points
+        self.step = step
+        self.null_ratio = null_ratio
+        self.latency = latency
+        self.error_ratio = error_ratio
+        self.random = random.Random(seed)
+        self.hosts = ['host%05d' % i for i in range(targets)]
+        self.responses = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = Server(('127.0.0.1', port), Handler)
+        self.server.graphite = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, path, params):
+        '''
+        Return the ``(status, body)`` of the response to a request.
+        '''
+        with self.lock:
+            self.requests += 1
+            fail = self.random.random() < self.error_ratio
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return 500, b'injected error'
+        if path == '/render':
+            targets = tuple(value for name, value in params
+                            if name == 'target')
+            return 200, self._cached(('render', targets), self.render,
+                                     targets)
+        if path == '/metrics/find':
+            query = dict(params).get('query', '')
+            return 200, self._cached(('find', query), self.find, query)
+        return 404, b'not found'
+
+    def _cached(self, key, func, arg):
+        body = self.responses.get(key)
+        if body is None:
+            body = self.responses[key] = func(arg)
+        return body
+
+    def render(self, targets):
+        end = int(time.time()) // self.step * self.step
+        start = end - self.points * self.step
+        ret = []
+        for target in targets:
+            for name in self.expand(target):
+                rand = random.Random(zlib.crc32(name.encode('utf-8')))
+                ret.append({
+                    'target': name,
+                    'datapoints': [
+                        [None if rand.random() < self.null_ratio
+                         else round(rand.uniform(0, 100), 3),
+                         start + i * self.step]
+                        for i in range(self.points)
+                    ],
+                })
+        return json.dumps(ret).encode('utf-8')
+
+    def find(self, query):
+        nodes = query.split('.')
+        ret = []
+        if len(nodes) == 1:
+            candidates = [('servers', False)]
+        elif len(nodes) == 2 and match(nodes[0], 'servers'):
+            candidates = [('servers.' + host, False) for host in self.hosts]
+        elif len(nodes) == 3 and match(nodes[0], 'servers'):
+            candidates = [('servers.%s.%s' % (host, metric), True)
+                          for host in self.hosts if match(nodes[1], host)
+                          for metric in METRICS]
+        else:
+            candidates = []
+        for metric_id, leaf in candidates:
+            name = metric_id.rsplit('.', 1)[-1]
+            if match(nodes[-1], name):
+                ret.append({
+                    'text': name,
+                    'expandable': 0 if leaf else 1,
+                    'leaf': 1 if leaf else 0,
+                    'id': metric_id,
+                    'allowChildren': 0 if leaf else 1,
+                })
+        return json.dumps(ret).encode('utf-8')
+
+    def expand(self, target):
+        '''
+        Return the metrics matching the path expression *target*.
+        '''
+        nodes = target.split('.')
+        if len(nodes) != 3 or not match(nodes[0], 'servers'):
+            return [target]
+        return ['servers.%s.%s' % (host, metric) for host in self.hosts
+                if match(nodes[1], host)
+                for metric in METRICS if match(nodes[2], metric)]
+
+
+_regexes = {}
+
+
+def match(pattern, name):
+    regex = _regexes.get(pattern)
+    if regex is None:
+        regex = _regexes[pattern] = re.compile(
+            re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + '$')
+    return regex.match(name) is not None
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.respond(url.path, parse_qsl(url.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        url = urlparse(self.path)
+        self.respond(url.path, parse_qsl(url.query) + parse_qsl(body))
+
+    def respond(self, path, params):
+        status, body = self.server.graphite.handle(path, params)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--targets', type=int, default=100)
+    parser.add_argument('--points', type=int, default=360)
+    parser.add_argument('--null-ratio', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-ratio', type=float, default=0)
+    args = parser.parse_args()
+    server = FakeGraphite(args.targets, args.points,
+                          null_ratio=args.null_ratio, latency=args.latency,
+                          error_ratio=args.error_ratio, port=args.port)
+    print('serving on %s' % server.url)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
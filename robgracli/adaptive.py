@@ -0,0 +1,118 @@
+'''
+Adaptive query ranges, an alternative to the fixed *min_queries_range* of
+:class:`robgracli.client.GraphiteClient`.
+'''
+import re
+import threading
+
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+UNITS = {
+    's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'm': MINUTE, 'min': MINUTE, 'minute': MINUTE, 'minutes': MINUTE,
+    'h': HOUR, 'hour': HOUR, 'hours': HOUR,
+    'd': DAY, 'day': DAY, 'days': DAY,
+    'w': 7 * DAY, 'week': 7 * DAY, 'weeks': 7 * DAY,
+    'y': 365 * DAY, 'year': 365 * DAY, 'years': 365 * DAY,
+}
+DURATION = re.compile(r'^(\d+)([a-z]*)$')
+
+
+def parse_duration(value):
+    '''
+    Parse a Graphite duration like ``10s``, ``1min`` or ``7d`` to seconds.
+    Integers without unit are returned as is.
+    '''
+    match = DURATION.match(value.strip().lower())
+    if match is None:
+        raise ValueError('invalid duration: %r' % value)
+    number, unit = match.groups()
+    if not unit:
+        return int(number)
+    try:
+        return int(number) * UNITS[unit]
+    except KeyError:
+        raise ValueError('invalid duration unit: %r' % value)
+
+
+def parse_retentions(retentions):
+    '''
+    Parse a carbon retention schema like ``10s:1d,1min:7d,10min:1y`` to a
+    list of ``(step, duration)`` tuples in seconds, ordered like the schema.
+
+    Durations given as a number of points (e.g. ``10:8640``) are converted to
+    seconds.
+    '''
+    ret = []
+    for archive in retentions.split(','):
+        step, duration = archive.split(':')
+        step = parse_duration(step)
+        if duration.strip().isdigit():
+            duration = step * int(duration)
+        else:
+            duration = parse_duration(duration)
+        ret.append((step, duration))
+    return ret
+
+
+def is_short_response(data):
+    '''
+    Return True if the decoded ``/render`` response *data* looks like it was
+    hit by the empty data bug: no series, or only series without values.
+    '''
+    for entry in data:
+        for value, _ in entry['datapoints']:
+            if value is not None:
+                return False
+    return True
+
+
+class RangeLearner(object):
+    '''
+    Learns the minimum range to query for each target prefix.
+
+    :param prefix_nodes:
+        the number of leading nodes of the queries used as prefix;
+    :param decay_after:
+        the learned range of a prefix is halved after this number of
+        consecutive queries that did not need to be widened.
+    '''
+
+    def __init__(self, prefix_nodes=2, decay_after=100):
+        self.prefix_nodes = prefix_nodes
+        self.decay_after = decay_after
+        self.ranges = {}
+        self.successes = {}
+        self.lock = threading.Lock()
+
+    def prefix(self, query):
+        return '.'.join(query.split('.')[:self.prefix_nodes])
+
+    def get(self, prefix):
+        with self.lock:
+            return self.ranges.get(prefix, 0)
+
+    def learn(self, prefix, query_range):
+        '''
+        Record that a query for *prefix* had to be widened to *query_range*.
+        '''
+        with self.lock:
+            self.ranges[prefix] = max(self.ranges.get(prefix, 0),
+                                      query_range)
+            self.successes[prefix] = 0
+
+    def success(self, prefix):
+        '''
+        Record that a query for *prefix* did not need to be widened.
+        '''
+        with self.lock:
+            if prefix not in self.ranges:
+                return
+            self.successes[prefix] = self.successes.get(prefix, 0) + 1
+            if self.successes[prefix] >= self.decay_after:
+                self.successes[prefix] = 0
+                self.ranges[prefix] //= 2
+                if not self.ranges[prefix]:
+                    del self.ranges[prefix]
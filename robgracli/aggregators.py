@@ -0,0 +1,335 @@
+'''
+Built-in aggregators for :meth:`robgracli.client.GraphiteClient.aggregate`.
+
+Built-in aggregators are designated by name:
+
+* ``avg``, ``sum``, ``min``, ``max``: the average, sum, minimum and maximum
+  of the values;
+* ``last``: the last value;
+* ``count``: the number of values;
+* ``stddev``: the population standard deviation of the values;
+* ``pN``: the N-th percentile of the values, e.g. ``p95`` or ``p99.9``,
+  linearly interpolated between the closest ranks;
+* ``rate``: the per-second rate of change between the first and the last
+  values.
+
+None values are ignored, and targets with no values are aggregated to None
+(also ``rate`` if there is less than 2 values). ``count`` is the exception,
+it returns 0 for targets with no values.
+
+When `numpy <http://www.numpy.org>`_ is installed, all the targets of a query
+are aggregated at once with vectorized operations, otherwise each target is
+aggregated in pure Python.
+
+The aggregated values of many targets can then be reduced with :func:`top`
+and :func:`group_by`, that consume ``(target, value)`` pairs one by one.
+'''
+import heapq
+import math
+import re
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .series import Series
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+
+NAMES = frozenset(['avg', 'sum', 'min', 'max', 'last', 'count', 'stddev',
+                   'rate'])
+PERCENTILE_NAME = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
+#: Aggregators that can be computed by Graphite's ``summarize()`` function,
+#: and the corresponding ``summarize()`` function names
+SUMMARIZE_FUNCTIONS = {
+    'avg': 'avg',
+    'sum': 'sum',
+    'min': 'min',
+    'max': 'max',
+    'last': 'last',
+    sum: 'sum',
+    min: 'min',
+    max: 'max',
+}
+SUMMARIZED_NAME = re.compile(
+    r'^summarize\((.*), "[^"]*", "[^"]*"(?:, true)?\)$')
+
+
+def average(values):
+    return float(sum(values)) / len(values)
+
+
+def is_builtin(aggregator):
+    '''
+    Return True if *aggregator* is the name of a built-in aggregator. Raise
+    ValueError for percentiles above 100, e.g. ``'p150'``.
+    '''
+    if not isinstance(aggregator, string_types):
+        return False
+    if aggregator in NAMES:
+        return True
+    if PERCENTILE_NAME.match(aggregator) is None:
+        return False
+    percentile_rank(aggregator)
+    return True
+
+
+def percentile_rank(name):
+    '''
+    Return the percentile of the aggregator *name* (e.g. 99.9 for
+    ``'p99.9'``), or raise ValueError if it is not between 0 and 100.
+    '''
+    n = float(PERCENTILE_NAME.match(name).group(1))
+    if n > 100:
+        raise ValueError('invalid percentile: %r' % name)
+    return n
+
+
+def aggregate(data, name):
+    '''
+    Aggregate the datapoints of a
+    :meth:`~robgracli.client.GraphiteClient.query` result *data* with the
+    built-in aggregator *name*.
+
+    Return an :class:`~collections.OrderedDict` with the same keys as *data*
+    and aggregated values as values.
+    '''
+    if not is_builtin(name):
+        raise ValueError('unknown aggregator: %r' % name)
+    if numpy is not None:
+        values = aggregate_vectorized(list(data.values()), name)
+    else:
+        values = [aggregate_series(datapoints, name)
+                  for datapoints in data.values()]
+    return OrderedDict(zip(data.keys(), values))
+
+
+def summarize_function(aggregator):
+    '''
+    Return the name of the Graphite ``summarize()`` function equivalent to
+    *aggregator*, or None if there is none.
+    '''
+    if aggregator is average:
+        return 'avg'
+    try:
+        return SUMMARIZE_FUNCTIONS.get(aggregator)
+    except TypeError:
+        # Unhashable aggregator
+        return None
+
+
+def unwrap_summarized_name(name):
+    '''
+    Return the name of the series that was passed to ``summarize()`` to
+    produce a series named *name*, or None if *name* is not a ``summarize()``
+    series name.
+    '''
+    match = SUMMARIZED_NAME.match(name)
+    if match is not None:
+        return match.group(1)
+
+
+def aggregate_series(datapoints, name):
+    '''
+    Aggregate a single datapoints list or :class:`~robgracli.series.Series`
+    with the built-in aggregator *name*, in pure Python.
+    '''
+    points = [(value, ts) for value, ts in iter_datapoints(datapoints)
+              if value is not None]
+    if name == 'count':
+        return len(points)
+    if not points:
+        return None
+    values = [value for value, _ in points]
+    if name == 'avg':
+        return float(sum(values)) / len(values)
+    elif name == 'sum':
+        return sum(values)
+    elif name == 'min':
+        return min(values)
+    elif name == 'max':
+        return max(values)
+    elif name == 'last':
+        return values[-1]
+    elif name == 'stddev':
+        mean = float(sum(values)) / len(values)
+        return math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+    elif name == 'rate':
+        (first_value, first_ts), (last_value, last_ts) = points[0], points[-1]
+        if last_ts == first_ts:
+            return None
+        return float(last_value - first_value) / (last_ts - first_ts)
+    return percentile(sorted(values), percentile_rank(name))
+
+
+def percentile(sorted_values, n):
+    '''
+    Return the *n*-th percentile of *sorted_values*, linearly interpolated
+    between the closest ranks (the default method of numpy).
+    '''
+    rank = (len(sorted_values) - 1) * n / 100.
+    low = int(math.floor(rank))
+    high = min(low + 1, len(sorted_values) - 1)
+    fraction = rank - low
+    return sorted_values[low] + \
+        (sorted_values[high] - sorted_values[low]) * fraction
+
+
+def aggregate_vectorized(series_list, name):
+    '''
+    Aggregate each item of *series_list* (datapoints lists or
+    :class:`~robgracli.series.Series`) with the built-in aggregator *name*,
+    in a single pass over a ``(targets, datapoints)`` numpy matrix.
+    '''
+    width = max([len(series) for series in series_list] or [0])
+    if width == 0:
+        return [0 if name == 'count' else None for _ in series_list]
+    values, timestamps = to_matrix(series_list)
+    mask = ~numpy.isnan(values)
+    count = mask.sum(axis=1)
+    empty = count == 0
+    if name == 'count':
+        return [int(c) for c in count]
+    rows = numpy.arange(len(series_list))
+    if name in ('avg', 'sum', 'stddev'):
+        total = numpy.where(mask, values, 0).sum(axis=1)
+        if name == 'sum':
+            result = total
+        else:
+            mean = total / numpy.maximum(count, 1)
+            result = mean
+            if name == 'stddev':
+                deviations = numpy.where(mask, values - mean[:, None], 0)
+                result = numpy.sqrt((deviations ** 2).sum(axis=1) /
+                                    numpy.maximum(count, 1))
+    elif name == 'min':
+        result = numpy.where(mask, values, numpy.inf).min(axis=1)
+    elif name == 'max':
+        result = numpy.where(mask, values, -numpy.inf).max(axis=1)
+    elif name in ('last', 'rate'):
+        last = values.shape[1] - 1 - mask[:, ::-1].argmax(axis=1)
+        result = values[rows, last]
+        if name == 'rate':
+            first = mask.argmax(axis=1)
+            elapsed = (timestamps[rows, last] -
+                       timestamps[rows, first]).astype(float)
+            empty = empty | (elapsed == 0)
+            elapsed[elapsed == 0] = 1
+            result = (result - values[rows, first]) / elapsed
+    else:
+        n = percentile_rank(name)
+        # Sorting moves NaNs last, so each row's valid values come first
+        sorted_values = numpy.sort(values, axis=1)
+        rank = (numpy.maximum(count, 1) - 1) * n / 100.
+        low = numpy.floor(rank).astype(int)
+        high = numpy.minimum(low + 1, numpy.maximum(count, 1) - 1)
+        result = sorted_values[rows, low] + \
+            (sorted_values[rows, high] - sorted_values[rows, low]) * \
+            (rank - low)
+    return [None if e else float(r) for r, e in zip(result, empty)]
+
+
+def top(pairs, k, largest=True):
+    '''
+    Return an :class:`~collections.OrderedDict` with the *k* ``(target,
+    value)`` items of the iterable *pairs* with the largest values (or the
+    smallest if *largest* is False), sorted by value. None values are
+    ignored.
+
+    Only *k* items are kept in a heap while *pairs* is consumed, instead of
+    sorting all of them.
+    '''
+    pairs = (pair for pair in pairs if pair[1] is not None)
+    select = heapq.nlargest if largest else heapq.nsmallest
+    return OrderedDict(select(k, pairs, key=lambda pair: pair[1]))
+
+
+#: Reductions of :func:`group_by`
+GROUP_REDUCERS = frozenset(['avg', 'sum', 'min', 'max', 'count'])
+
+
+def group_by(pairs, nodes, reducer='avg'):
+    '''
+    Group the ``(target, value)`` items of the iterable *pairs* by the nodes
+    of their target names at the positions *nodes* (an integer or a list of
+    integers, negative ones counting from the end), like Graphite's
+    ``groupByNodes()``, and reduce the values of each group with *reducer*
+    (``avg``, ``sum``, ``min``, ``max`` or ``count``). None values are
+    ignored.
+
+    Return an :class:`~collections.OrderedDict` with the group keys (the
+    selected nodes joined with dots) as keys and the reduced values as
+    values. Only one running ``[count, sum, min, max]`` accumulator is kept
+    per group while *pairs* is consumed.
+    '''
+    if reducer not in GROUP_REDUCERS:
+        raise ValueError('unknown group reducer: %r' % reducer)
+    if isinstance(nodes, int):
+        nodes = [nodes]
+    groups = OrderedDict()
+    for target, value in pairs:
+        if value is None:
+            continue
+        parts = target.split('.')
+        key = '.'.join(parts[node] for node in nodes)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [1, value, value, value]
+        else:
+            group[0] += 1
+            group[1] += value
+            group[2] = min(group[2], value)
+            group[3] = max(group[3], value)
+    ret = OrderedDict()
+    for key, (count, total, minimum, maximum) in groups.items():
+        if reducer == 'avg':
+            ret[key] = float(total) / count
+        elif reducer == 'sum':
+            ret[key] = total
+        elif reducer == 'min':
+            ret[key] = minimum
+        elif reducer == 'max':
+            ret[key] = maximum
+        else:
+            ret[key] = count
+    return ret
+
+
+def to_matrix(series_list):
+    '''
+    Return ``(values, timestamps)`` numpy matrices for *series_list*, padded
+    with NaN values and zero timestamps.
+    '''
+    width = max(len(series) for series in series_list)
+    values = numpy.full((len(series_list), width), numpy.nan)
+    timestamps = numpy.zeros((len(series_list), width), dtype=numpy.int64)
+    for i, series in enumerate(series_list):
+        if isinstance(series, Series):
+            stop = series.stop
+            row_values = numpy.frombuffer(series.values)[series.start:stop]
+            mask = numpy.frombuffer(series.mask, dtype=numpy.uint8)
+            row_values = numpy.where(mask[series.start:stop], row_values,
+                                     numpy.nan)
+            row_timestamps = numpy.frombuffer(
+                series.timestamps,
+                dtype='i%s' % series.timestamps.itemsize)[series.start:stop]
+        else:
+            row_values = [numpy.nan if value is None else value
+                          for value, _ in series]
+            row_timestamps = [ts for _, ts in series]
+        values[i, :len(series)] = row_values
+        timestamps[i, :len(series)] = row_timestamps
+    return values, timestamps
+
+
+def iter_datapoints(datapoints):
+    if isinstance(datapoints, Series):
+        return iter(datapoints)
+    return ((dp[0], dp[1]) for dp in datapoints)
@@ -0,0 +1,336 @@
+'''
+Asyncio versions of :class:`robgracli.http.HttpClient` and
+:class:`robgracli.client.GraphiteClient`.
+
+This module requires Python 3.5+ and
+`aiohttp <https://aiohttp.readthedocs.io>`_ (install the ``async`` extra).
+'''
+import asyncio
+import json
+from collections import OrderedDict
+from functools import partial
+from urllib.parse import urljoin
+
+import aiohttp
+
+from .client import (GraphiteClient, RETRY_METHODS, average, build_result,
+                     aggregate_result, assign_series)
+from .exceptions import BadResponse, DeadlineExceeded
+from .singleflight import request_key
+
+
+#: Maximum delay between retries, same as urllib3's ``Retry.BACKOFF_MAX``
+BACKOFF_MAX = 120
+
+#: Methods for which read errors are retried, like urllib3's ``Retry``
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS',
+                                'TRACE'])
+
+
+class Response(object):
+    '''
+    A fully read HTTP response, exposing the subset of the
+    :class:`requests.Response` API used by the clients.
+    '''
+
+    def __init__(self, url, status_code, headers, content, encoding):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncSingleFlight(object):
+    '''
+    Asyncio counterpart of :class:`robgracli.singleflight.SingleFlight`.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, coro_func):
+        '''
+        Return the result of ``await coro_func()``, or of the call in
+        progress for *key*.
+
+        The call runs in its own task, so cancelling a caller (e.g. on
+        timeout) doesn't cancel it for the other callers.
+        '''
+        task = self.calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(coro_func())
+            self.calls[key] = task
+            task.add_done_callback(partial(self._done, key))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Avoid "exception was never retrieved" warnings if all the callers
+        # were cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+class AsyncHttpClient(object):
+    '''
+    Asyncio counterpart of :class:`robgracli.http.HttpClient`, with the same
+    timeouts and retry semantics.
+
+    :param connect_timeout: connection timeout, in seconds;
+    :param read_timeout: read timeout, in seconds;
+    :param max_retries:
+        retry requests this number of time on network errors (read errors are
+        only retried for :meth:`get`);
+    :param backoff_factor:
+        factor used for exponential delays between retries;
+    :param max_in_flight:
+        maximum number of concurrent requests, additional requests wait for
+        a free slot;
+    :param coalesce:
+        if True, concurrent identical GET requests are coalesced: only one
+        of them is sent and its response is shared by all callers;
+    :param retry_methods:
+        the HTTP methods retried on read errors, defaults to
+        :data:`IDEMPOTENT_METHODS`;
+    :param deadline:
+        the default maximum duration of requests in seconds, including
+        retries and the delays between them, or None;
+    :param extra_requests_opts:
+        additionnal keyworkd arguments passed to each
+        :meth:`aiohttp.ClientSession.request` calls.
+
+    The underlying :class:`aiohttp.ClientSession` is created on first use, in
+    the running event loop. Call :meth:`close` when done with the client, or
+    use it as an asynchronous context manager.
+    '''
+
+    def __init__(self, connect_timeout=5, read_timeout=5, max_retries=3,
+                 backoff_factor=1, max_in_flight=100, coalesce=False,
+                 retry_methods=IDEMPOTENT_METHODS, deadline=None,
+                 **extra_requests_opts):
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_in_flight = max_in_flight
+        self.coalesce = coalesce
+        self.retry_methods = frozenset(retry_methods)
+        self.deadline = deadline
+        self.flights = AsyncSingleFlight()
+        self.extra_requests_opts = extra_requests_opts
+        self.session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, url, data=None, params=None,
+                      raise_for_status=True, deadline=None):
+        return await self.with_deadline(
+            self._request_coalesced(method, url, data, params,
+                                    raise_for_status), deadline)
+
+    async def with_deadline(self, coro, deadline=None):
+        '''
+        Await *coro* for at most *deadline* seconds, or the client's default
+        deadline, and raise :class:`robgracli.exceptions.DeadlineExceeded`
+        if it did not complete in time.
+        '''
+        if deadline is None:
+            deadline = self.deadline
+        if deadline is None:
+            return await coro
+        loop = asyncio.get_event_loop()
+        end = loop.time() + deadline
+        try:
+            return await asyncio.wait_for(coro, deadline)
+        except asyncio.TimeoutError:
+            # Read timeouts are also asyncio.TimeoutError
+            if loop.time() < end:
+                raise
+            raise DeadlineExceeded(deadline)
+
+    async def _request_coalesced(self, method, url, data, params,
+                                 raise_for_status):
+        if self.coalesce and method.upper() == 'GET':
+            return await self.flights.do(
+                request_key(method, url, params),
+                lambda: self._request(method, url, data, params,
+                                      raise_for_status))
+        return await self._request(method, url, data, params,
+                                   raise_for_status)
+
+    async def _request(self, method, url, data, params, raise_for_status):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            response = await self._request_with_retries(method, url, data,
+                                                        params)
+        if raise_for_status and response.status_code >= 400:
+            raise BadResponse(response)
+        return response
+
+    async def get(self, url, params=None, raise_for_status=True,
+                  deadline=None):
+        return await self.request('GET', url, data=None, params=params,
+                                  raise_for_status=raise_for_status,
+                                  deadline=deadline)
+
+    async def post(self, url, data=None, params=None, raise_for_status=True,
+                   deadline=None):
+        return await self.request('POST', url, data=data, params=params,
+                                  raise_for_status=raise_for_status,
+                                  deadline=deadline)
+
+    async def _get(self, url, params=None):
+        '''
+        Like :meth:`get`, for calls already awaited with
+        :meth:`with_deadline`: the client's default deadline is not applied
+        again, so it doesn't override the deadline of the call.
+        '''
+        return await self._request_coalesced('GET', url, None, params, True)
+
+    async def _post(self, url, data=None):
+        '''
+        Like :meth:`post`, see :meth:`_get`.
+        '''
+        return await self._request_coalesced('POST', url, data, None, True)
+
+    async def _request_with_retries(self, method, url, data, params):
+        errors = 0
+        while True:
+            try:
+                async with self.session.request(
+                        method, url, data=data, params=params,
+                        **self.extra_requests_opts) as response:
+                    content = await response.read()
+                    return Response(str(response.url), response.status,
+                                    response.headers, content,
+                                    response.charset)
+            except aiohttp.ClientConnectorError:
+                retry = errors < self.max_retries
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                retry = (errors < self.max_retries and
+                         method.upper() in self.retry_methods)
+            if not retry:
+                raise
+            errors += 1
+            await asyncio.sleep(get_backoff_time(self.backoff_factor, errors))
+
+
+class AsyncGraphiteClient(AsyncHttpClient):
+    '''
+    Asyncio counterpart of :class:`robgracli.client.GraphiteClient`, with the
+    same methods as coroutines.
+
+    Additional arguments are passed to :class:`AsyncHttpClient`.
+    '''
+
+    def __init__(self, endpoint, min_queries_range=60 * 10, *args, **kwargs):
+        self.max_url_length = kwargs.pop('max_url_length', 2000)
+        self.max_post_size = kwargs.pop('max_post_size', 1024 * 1024)
+        self.render_format = kwargs.pop('render_format', 'json')
+        self.compress_targets = kwargs.pop('compress_targets', False)
+        self.metric_index = None
+        kwargs.setdefault('retry_methods', RETRY_METHODS)
+        super(AsyncGraphiteClient, self).__init__(*args, **kwargs)
+        self.endpoint = endpoint
+        self.min_queries_range = min_queries_range
+
+    _render_params = GraphiteClient._render_params
+    _plan_render = GraphiteClient._plan_render
+    _plan_batches = GraphiteClient._plan_batches
+    _group_targets = GraphiteClient._group_targets
+    _decode = GraphiteClient._decode
+
+    async def query(self, query, from_=60, deadline=None):
+        '''
+        See :meth:`robgracli.client.GraphiteClient.query`.
+        '''
+        return await self.with_deadline(self._query(query, from_), deadline)
+
+    async def _query(self, query, from_):
+        url = urljoin(self.endpoint, '/render')
+        response = await self._get(url,
+                                   params=self._render_params([query], from_))
+        return build_result(self._decode(response), from_)
+
+    async def query_many(self, queries, from_=60, deadline=None):
+        '''
+        See :meth:`robgracli.client.GraphiteClient.query_many`. Batches are
+        sent concurrently.
+        '''
+        return await self.with_deadline(self._query_many(queries, from_),
+                                        deadline)
+
+    async def _query_many(self, queries, from_):
+        queries = list(OrderedDict.fromkeys(queries))
+        groups = OrderedDict(self._group_targets(queries))
+        url = urljoin(self.endpoint, '/render')
+        plan = self._plan_render(url, list(groups), from_)
+        calls = []
+        for method, params, _ in plan:
+            if method == 'GET':
+                calls.append(self._get(url, params=params))
+            else:
+                calls.append(self._post(url, data=params))
+        assigned = {}
+        for (_, _, targets), response in zip(plan,
+                                             await asyncio.gather(*calls)):
+            assigned.update(assign_series(
+                [(target, groups[target]) for target in targets],
+                self._decode(response)))
+        ret = OrderedDict()
+        for query in queries:
+            ret[query] = build_result(assigned[query], from_)
+        return ret
+
+    async def aggregate(self, query, from_=60, aggregator=average,
+                        deadline=None):
+        '''
+        See :meth:`robgracli.client.GraphiteClient.aggregate`.
+        '''
+        return aggregate_result(await self.query(query, from_, deadline),
+                                aggregator)
+
+    async def find_metrics(self, query, deadline=None):
+        '''
+        See :meth:`robgracli.client.GraphiteClient.find_metrics`.
+        '''
+        url = urljoin(self.endpoint, '/metrics/find')
+        response = await self.with_deadline(self._get(url, {'query': query}),
+                                            deadline)
+        return response.json()
+
+
+def get_backoff_time(backoff_factor, errors):
+    '''
+    Return the delay before the next retry after *errors* consecutive
+    errors, following urllib3's ``Retry.get_backoff_time()``.
+    '''
+    if errors <= 1:
+        return 0
+    return min(BACKOFF_MAX, backoff_factor * (2 ** (errors - 1)))
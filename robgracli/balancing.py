@@ -0,0 +1,184 @@
+'''
+Load balancing between multiple Graphite endpoints.
+'''
+import threading
+import time
+from collections import deque
+try:
+    from queue import Queue, Empty
+except ImportError:  # Python 2
+    from Queue import Queue, Empty
+
+from requests.exceptions import RequestException
+
+from .aggregators import percentile
+from .exceptions import BadResponse
+from .resilience import CircuitBreaker
+
+
+class EndpointStats(object):
+
+    def __init__(self, endpoint, breaker=None):
+        self.endpoint = endpoint
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+        self.breaker = breaker
+
+
+class EndpointPool(object):
+    '''
+    Tracks the health and latency of a list of *endpoints*, to route requests
+    to the fastest healthy one.
+
+    :param endpoints: the list of endpoint URLs;
+    :param alpha:
+        the smoothing factor of the exponentially weighted moving average of
+        the latency of each endpoint;
+    :param cooldown:
+        the number of seconds an endpoint is considered unhealthy after a
+        failure;
+    :param latency_window:
+        the number of most recent latencies (all endpoints combined) used to
+        compute :meth:`latency_percentile`;
+    :param breaker_threshold:
+        if not None, each endpoint gets a
+        :class:`~robgracli.resilience.CircuitBreaker` opening after this
+        number of consecutive failures (see :meth:`allow`);
+    :param breaker_timeout:
+        the number of seconds circuit breakers stay open.
+    '''
+
+    def __init__(self, endpoints, alpha=0.3, cooldown=30,
+                 latency_window=1000, breaker_threshold=None,
+                 breaker_timeout=30):
+        if not endpoints:
+            raise ValueError('at least one endpoint is required')
+        self.stats = [
+            EndpointStats(endpoint, None if breaker_threshold is None else
+                          CircuitBreaker(breaker_threshold, breaker_timeout))
+            for endpoint in endpoints
+        ]
+        self.alpha = alpha
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=latency_window)
+        self.lock = threading.Lock()
+
+    @property
+    def endpoints(self):
+        return [stats.endpoint for stats in self.stats]
+
+    def ranked(self):
+        '''
+        Return the endpoints by order of preference: healthy endpoints first,
+        by increasing latency (endpoints with no latency measured yet first),
+        then unhealthy endpoints, the ones that will recover first first.
+        '''
+        now = time.time()
+        with self.lock:
+            healthy = [s for s in self.stats if s.down_until <= now]
+            unhealthy = [s for s in self.stats if s.down_until > now]
+            healthy.sort(key=lambda s: (s.latency is not None,
+                                        s.latency or 0))
+            unhealthy.sort(key=lambda s: s.down_until)
+            return [s.endpoint for s in healthy + unhealthy]
+
+    def allow(self, endpoint):
+        '''
+        Return True if the circuit breaker of *endpoint* allows sending it a
+        request. Must be called just before sending it, as a half-open
+        breaker only allows a single request.
+        '''
+        breaker = self._get(endpoint).breaker
+        return breaker is None or breaker.allow()
+
+    def record_success(self, endpoint, latency):
+        with self.lock:
+            stats = self._get(endpoint)
+            if stats.breaker is not None:
+                stats.breaker.record_success()
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.alpha * (latency - stats.latency)
+            stats.failures = 0
+            stats.down_until = 0
+            self.latencies.append(latency)
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            stats = self._get(endpoint)
+            if stats.breaker is not None:
+                stats.breaker.record_failure()
+            stats.failures += 1
+            stats.down_until = time.time() + self.cooldown
+
+    def latency_percentile(self, n, min_samples=10):
+        '''
+        Return the *n*-th percentile of the recent latencies, or None if less
+        than *min_samples* latencies were recorded.
+        '''
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return percentile(latencies, n)
+
+    def _get(self, endpoint):
+        for stats in self.stats:
+            if stats.endpoint == endpoint:
+                return stats
+        raise KeyError(endpoint)
+
+
+def is_endpoint_failure(exc):
+    '''
+    Return True if *exc* is caused by a faulty endpoint: network errors and
+    5xx responses.
+    '''
+    if isinstance(exc, BadResponse):
+        return exc.response.status_code >= 500
+    return isinstance(exc, RequestException)
+
+
+def hedged_call(primary, secondary, delay):
+    '''
+    Call *primary*, and if it did not return after *delay* seconds also call
+    *secondary*. Return the result of the first call that succeeds, or raise
+    the error of the last one if both fail.
+
+    Calls are made in daemon threads, the slowest one runs to completion in
+    the background.
+    '''
+    results = Queue()
+
+    def run(func):
+        try:
+            results.put((True, func()))
+        except Exception as exc:
+            results.put((False, exc))
+
+    def start(func):
+        thread = threading.Thread(target=run, args=(func,))
+        thread.daemon = True
+        thread.start()
+
+    start(primary)
+    try:
+        success, value = results.get(timeout=delay)
+    except Empty:
+        start(secondary)
+        pending = 2
+    else:
+        if success:
+            return value
+        start(secondary)
+        pending = 1
+    while True:
+        success, value = results.get()
+        pending -= 1
+        if success or not pending:
+            break
+    if success:
+        return value
+    raise value
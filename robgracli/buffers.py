@@ -0,0 +1,130 @@
+'''
+Ring buffers of recent datapoints, used by the incremental mode of
+:class:`robgracli.client.GraphiteClient`.
+'''
+import threading
+from collections import OrderedDict, deque
+
+
+class QueryBuffer(object):
+    '''
+    Holds the most recent datapoints of each series returned by a query.
+
+    :param max_age:
+        the time range covered by the buffer, in seconds, older datapoints
+        are discarded;
+    :param max_points:
+        the maximum number of datapoints kept per series.
+    '''
+
+    def __init__(self, max_age, max_points):
+        self.max_age = max_age
+        self.max_points = max_points
+        self.series = OrderedDict()
+        self.last_ts = None
+        self.lock = threading.Lock()
+
+    def replace(self, data):
+        '''
+        Replace the buffer contents with the series of *data*, a mapping of
+        target names to datapoints lists.
+        '''
+        with self.lock:
+            self.series = OrderedDict()
+            for target, datapoints in data.items():
+                self.series[target] = deque(datapoints, self.max_points)
+            self._update()
+
+    def merge(self, data):
+        '''
+        Merge the series of *data*, a mapping of target names to datapoints
+        lists, in the buffer.
+
+        Datapoints newer than those of the buffer are appended, and the others
+        replace the values of the buffered datapoints with the same
+        timestamps, unless they are None. Series absent from *data* are
+        discarded.
+        '''
+        with self.lock:
+            series = OrderedDict()
+            for target, datapoints in data.items():
+                buf = self.series.get(target)
+                if buf is None:
+                    buf = deque(maxlen=self.max_points)
+                for datapoint in datapoints:
+                    merge_datapoint(buf, datapoint)
+                series[target] = buf
+            self.series = series
+            self._update()
+
+    def datapoints(self):
+        '''
+        Return an :class:`~collections.OrderedDict` with target names as keys
+        and copies of the buffered datapoints lists as values.
+        '''
+        with self.lock:
+            return OrderedDict((target, list(buf))
+                               for target, buf in self.series.items())
+
+    def _update(self):
+        self.last_ts = None
+        for buf in self.series.values():
+            if not buf:
+                continue
+            last_ts = buf[-1][1]
+            while last_ts - buf[0][1] > self.max_age:
+                buf.popleft()
+            if self.last_ts is None or last_ts > self.last_ts:
+                self.last_ts = last_ts
+
+
+def merge_datapoint(buf, datapoint):
+    '''
+    Merge *datapoint* in the deque *buf*, sorted by timestamps. Buffered
+    values are not replaced by None, since Graphite may return None for
+    recent datapoints that are not written yet.
+    '''
+    ts = datapoint[1]
+    if not buf or ts > buf[-1][1]:
+        buf.append(datapoint)
+        return
+    for i in range(len(buf) - 1, -1, -1):
+        buf_ts = buf[i][1]
+        if buf_ts == ts:
+            if datapoint[0] is not None or buf[i][0] is None:
+                buf[i] = datapoint
+            return
+        elif buf_ts < ts:
+            break
+    # Older datapoints with no match in the buffer are dropped, inserting in
+    # the middle of a deque is not worth it for such a rare case
+
+
+class BufferStore(object):
+    '''
+    A thread-safe mapping of queries to :class:`QueryBuffer` objects, keeping
+    only the *max_queries* most recently used ones.
+    '''
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, query):
+        with self.lock:
+            buf = self.buffers.pop(query, None)
+            if buf is not None:
+                self.buffers[query] = buf
+            return buf
+
+    def set(self, query, buf):
+        with self.lock:
+            self.buffers.pop(query, None)
+            self.buffers[query] = buf
+            while len(self.buffers) > self.max_queries:
+                self.buffers.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.buffers.clear()
@@ -0,0 +1,187 @@
+'''
+In-process cache for :class:`robgracli.client.GraphiteClient` results.
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(object):
+
+    def __init__(self, value, size, created_at, expires_at):
+        self.value = value
+        self.size = size
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+
+class ResultCache(object):
+    '''
+    A thread-safe TTL and LRU cache.
+
+    Entries expire at the start of the next step of the series they were
+    computed from, e.g. a result with 10 seconds datapoints computed at
+    12:00:03 expires at 12:00:10. When the step is unknown, *default_ttl* is
+    used instead.
+
+    :param max_entries: maximum number of entries;
+    :param max_bytes:
+        maximum approximate size of the cached values, in bytes, or None for
+        no limit;
+    :param default_ttl:
+        time to live of entries whose step is unknown, in seconds;
+    :param max_ttl: maximum time to live of entries, in seconds;
+    :param refresh_ahead:
+        if not None, a fraction of the time to live after which entries are
+        recomputed in a background thread when they are accessed, so hot
+        entries never expire;
+    :param sizeof:
+        function returning the approximate size of a value in bytes, defaults
+        to :func:`estimate_size`.
+
+    The ``hits``, ``misses``, ``evictions`` and ``refreshes`` counters are
+    available as attributes, or as a dict with :meth:`stats`.
+
+    Cached values are returned as is to all callers, they must not be
+    modified.
+    '''
+
+    def __init__(self, max_entries=1000, max_bytes=None, default_ttl=10,
+                 max_ttl=60, refresh_ahead=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.refresh_ahead = refresh_ahead
+        self.sizeof = sizeof or estimate_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refreshes = 0
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    def get_or_compute(self, key, compute):
+        '''
+        Return the cached value for *key*, or call *compute* and cache its
+        result.
+
+        *compute* must return a ``(value, step)`` pair, *step* being the
+        interval between the datapoints used to compute *value*, in seconds,
+        or None if unknown.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry.expires_at > now:
+                self.entries[key] = entry
+                self.hits += 1
+                refresh = self._should_refresh(key, entry, now)
+            else:
+                if entry is not None:
+                    self.size -= entry.size
+                self.misses += 1
+                entry = None
+        if entry is None:
+            return self._compute(key, compute)
+        if refresh:
+            thread = threading.Thread(target=self._refresh,
+                                      args=(key, compute))
+            thread.daemon = True
+            thread.start()
+        return entry.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+    def _should_refresh(self, key, entry, now):
+        if self.refresh_ahead is None or key in self.refreshing:
+            return False
+        ttl = entry.expires_at - entry.created_at
+        if now - entry.created_at < ttl * self.refresh_ahead:
+            return False
+        self.refreshing.add(key)
+        self.refreshes += 1
+        return True
+
+    def _refresh(self, key, compute):
+        try:
+            self._compute(key, compute)
+        except Exception:
+            logger.exception('error refreshing cache entry %r', key)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def _compute(self, key, compute):
+        value, step = compute()
+        now = time.time()
+        if step:
+            expires_at = (now // step + 1) * step
+        else:
+            expires_at = now + self.default_ttl
+        expires_at = min(expires_at, now + self.max_ttl)
+        entry = CacheEntry(value, self.sizeof(value), now, expires_at)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and
+                     self.size > self.max_bytes and len(self.entries) > 1):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+        return value
+
+
+def estimate_size(value):
+    '''
+    Return the approximate memory footprint of a
+    :meth:`~robgracli.client.GraphiteClient.query` or
+    :meth:`~robgracli.client.GraphiteClient.aggregate` result, in bytes.
+    '''
+    size = 0
+    for key, item in value.items():
+        size += 64 + len(key)
+        if isinstance(item, list):
+            size += 72 + 88 * len(item)
+        elif hasattr(item, 'nbytes'):
+            size += 64 + item.nbytes
+        else:
+            size += 24
+    return size
+
+
+def series_step(data):
+    '''
+    Return the interval between datapoints in a
+    :meth:`~robgracli.client.GraphiteClient.query` result *data*, or None if
+    it cannot be determined.
+    '''
+    steps = [datapoints[-1][1] - datapoints[-2][1]
+             for datapoints in data.values() if len(datapoints) > 1]
+    steps = [step for step in steps if step > 0]
+    if steps:
+        return min(steps)
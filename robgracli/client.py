@@ -1,18 +1,60 @@
-from urlparse import urljoin
+import logging
+import math
+import pickle
+import re
+import sys
+import threading
+import time
 from collections import OrderedDict
+from functools import partial
+from itertools import islice
+try:
+    from urllib import urlencode
+    from urlparse import urljoin
+except ImportError:  # Python 3
+    from urllib.parse import urlencode, urljoin
 
+from . import aggregators, decoders, functions
+from .adaptive import RangeLearner, is_short_response, parse_retentions
+from .aggregators import average
+from .balancing import EndpointPool, is_endpoint_failure, hedged_call
+from .buffers import BufferStore, QueryBuffer
+from .cache import series_step
+from .deadline import bind as bind_deadline, current_deadline
+from .exceptions import BadResponse, CircuitOpen
 from .http import HttpClient
+from .instrumentation import bind, current_stats, measure, phase
+from .ranges import Stitcher, split_range, to_timestamp
+from .series import Series
+from .streaming import iter_json_array, CHUNK_SIZE
+from .watch import Watcher
 
 
-def average(values):
-    return float(sum(values)) / len(values)
+logger = logging.getLogger(__name__)
+
+#: Methods retried on read errors: ``/render`` POST requests only read data,
+#: so they are retried like GET requests
+RETRY_METHODS = frozenset(['HEAD', 'GET', 'POST'])
+
+#: Characters of the targets that can't be merged by :func:`compress_targets`
+NOT_PLAIN = re.compile(r'[(){},\s"\']')
+#: Characters of targets that are not path expressions (function calls)
+CALL_CHARS = re.compile(r'[()\s"\']')
+#: Characters of path expressions that are not plain metric names
+GLOB_CHARS = re.compile(r'[*?\[{]')
+#: Maximum number of compiled path expressions kept by :func:`target_matches`
+GLOB_CACHE_SIZE = 1000
 
 
 class GraphiteClient(HttpClient):
     '''
     A simple client for querying Graphite.
 
-    :param endpoint: the Graphite URL;
+    :param endpoint:
+        the Graphite URL, or a list of URLs of Graphite frontends sharing the
+        same storage. Requests are then sent to the healthy endpoint with the
+        lowest average latency, and retried on the next one if it fails (see
+        :class:`robgracli.balancing.EndpointPool`);
     :param min_queries_range:
         The minimum range of data to query. Graphite occasionally returns empty
         data when querying small time ranges (probably on busy servers). The
@@ -27,60 +69,669 @@ class GraphiteClient(HttpClient):
         As a guideline, the default value of 10 minutes gave good results on
         our server for querying 1 minute data ranges with a
         ``10s:1d,1min:7d,10min:1y`` retention schema;
+    :param max_url_length:
+        keyword-only, the maximum length of the URLs generated by
+        :meth:`query_many`, above which targets are sent in POST bodies;
+    :param max_post_size:
+        keyword-only, the maximum size in bytes of the POST bodies generated
+        by :meth:`query_many`, longer lists of targets are split in multiple
+        requests;
+    :param compress_targets:
+        keyword-only, if True, :meth:`query_many` merges metric paths that
+        only differ by one node into brace expressions (see
+        :func:`compress_targets`), or wildcards if :attr:`metric_index` says
+        they cover all the existing metrics;
+    :param incremental:
+        keyword-only, enable the incremental mode of :meth:`query` and
+        :meth:`aggregate`: the datapoints of each query are kept in memory
+        after a first full fetch, and next calls only fetch the datapoints
+        since the last received timestamp. If Graphite returns nothing for
+        the new window the full range is fetched again;
+    :param incremental_overlap:
+        keyword-only, in incremental mode, the number of seconds before the
+        last received timestamp that are fetched again, to catch late writes;
+    :param incremental_max_points:
+        keyword-only, the maximum number of datapoints kept per series in
+        incremental mode;
+    :param incremental_max_queries:
+        keyword-only, the maximum number of queries for which datapoints are
+        kept in incremental mode, the least recently used are discarded;
+    :param cache:
+        keyword-only, a :class:`robgracli.cache.ResultCache` used to cache the
+        results of :meth:`query` and :meth:`aggregate`;
+    :param series:
+        keyword-only, if True, :meth:`query` and its variants return
+        :class:`robgracli.series.Series` objects instead of datapoints lists;
+    :param render_format:
+        keyword-only, the format of ``/render`` responses, one of the formats
+        of :mod:`robgracli.decoders`, defaults to ``json``;
+    :param hedge_percentile:
+        keyword-only, with multiple endpoints, if a request did not complete
+        after this percentile of the recent latencies (e.g. 95), send the
+        same request to a second endpoint and use the first response;
+    :param endpoint_cooldown:
+        keyword-only, the number of seconds an endpoint is avoided after a
+        network error or a 5xx response;
+    :param breaker_threshold:
+        keyword-only, if not None, stop sending requests to an endpoint after
+        this number of consecutive network errors or 5xx responses, until
+        *breaker_timeout* seconds have passed and a probe request succeeds.
+        :class:`robgracli.exceptions.CircuitOpen` is raised when no endpoint
+        is available (see :class:`robgracli.resilience.CircuitBreaker`);
+    :param breaker_timeout:
+        keyword-only, the number of seconds circuit breakers stay open;
+    :param adaptive_range:
+        keyword-only, if True, :meth:`query` and :meth:`aggregate` query the
+        range actually requested instead of *min_queries_range*, and only
+        widen it (doubling it, up to *min_queries_range*) when Graphite
+        returns empty data. The widened ranges are remembered for each
+        target prefix (see :class:`robgracli.adaptive.RangeLearner`);
+    :param retentions:
+        keyword-only, in adaptive mode, the retention schema of the queried
+        metrics (e.g. ``10s:1d,1min:7d``). Ranges are then widened up to
+        *min_queries_range* or the duration of the first archive, whichever
+        is shorter, so Graphite never returns data from a coarser archive;
+    :param history_cache:
+        keyword-only, a :class:`robgracli.history.HistoryCache` storing
+        datapoints older than its *settle* delay on disk. :meth:`query` and
+        :meth:`aggregate` calls over ranges longer than *settle* and
+        *min_queries_range* then only fetch the datapoints that are not
+        cached yet. Recent datapoints returned at a finer resolution than the
+        cached ones (from another archive) are averaged to the cached step.
+        Not used in incremental mode;
+    :param process_pool:
+        keyword-only, a :class:`multiprocessing.pool.Pool` (or any object with
+        a compatible ``apply()`` method) in which :meth:`query` and
+        :meth:`aggregate` decode, trim and aggregate responses larger than
+        *process_threshold*, so they don't hold the GIL of the calling
+        process. Only the results are sent back, as packed arrays or
+        aggregated values. Not used in the incremental, adaptive and history
+        modes;
+    :param process_threshold:
+        keyword-only, the size in bytes of the responses processed in
+        *process_pool*, defaults to 10 MB.
 
     Additional arguments are passed to :class:`robgracli.http.HttpClient`.
     '''
 
     def __init__(self, endpoint, min_queries_range=60 * 10, *args, **kwargs):
+        self.max_url_length = kwargs.pop('max_url_length', 2000)
+        self.max_post_size = kwargs.pop('max_post_size', 1024 * 1024)
+        self.compress_targets = kwargs.pop('compress_targets', False)
+        self.incremental = kwargs.pop('incremental', False)
+        self.incremental_overlap = kwargs.pop('incremental_overlap', 60)
+        self.incremental_max_points = kwargs.pop('incremental_max_points',
+                                                 10000)
+        self.buffers = BufferStore(kwargs.pop('incremental_max_queries',
+                                              1000))
+        self.cache = kwargs.pop('cache', None)
+        self.series = kwargs.pop('series', False)
+        self.render_format = kwargs.pop('render_format', 'json')
+        self.hedge_percentile = kwargs.pop('hedge_percentile', None)
+        endpoint_cooldown = kwargs.pop('endpoint_cooldown', 30)
+        breaker_threshold = kwargs.pop('breaker_threshold', None)
+        breaker_timeout = kwargs.pop('breaker_timeout', 30)
+        self.adaptive_range = kwargs.pop('adaptive_range', False)
+        retentions = kwargs.pop('retentions', None)
+        if retentions is not None:
+            self.adaptive_max_range = min(min_queries_range,
+                                          parse_retentions(retentions)[0][1])
+        else:
+            self.adaptive_max_range = min_queries_range
+        self.range_learner = RangeLearner()
+        self.metric_index = None
+        self.history_cache = kwargs.pop('history_cache', None)
+        self.process_pool = kwargs.pop('process_pool', None)
+        self.process_threshold = kwargs.pop('process_threshold',
+                                            10 * 1024 * 1024)
+        self.watcher = None
+        kwargs.setdefault('retry_methods', RETRY_METHODS)
         super(GraphiteClient, self).__init__(*args, **kwargs)
-        self.endpoint = endpoint
+        if isinstance(endpoint, (list, tuple)):
+            self.endpoints = list(endpoint)
+        else:
+            self.endpoints = [endpoint]
+        self.endpoint = self.endpoints[0]
+        self.endpoint_pool = EndpointPool(self.endpoints,
+                                          cooldown=endpoint_cooldown,
+                                          breaker_threshold=breaker_threshold,
+                                          breaker_timeout=breaker_timeout)
         self.min_queries_range = min_queries_range
 
-    def query(self, query, from_=60):
+    def query(self, query, from_=60, deadline=None):
         '''
         Return datapoints for *query* over the last *from_* seconds.
 
         The return value is an :class:`~collections.OrderedDict` with target
         names as keys and datapoints ``(value, timestamp)`` pairs as values.
+
+        If the client was created with ``coalesce=True``, concurrent calls
+        with the same arguments share the same result, which must then not be
+        modified.
+
+        *deadline* is the maximum duration of the call in seconds, including
+        retries, failovers and the delays between them, and defaults to the
+        client's *deadline*. :class:`robgracli.exceptions.DeadlineExceeded`
+        is raised when it is exceeded.
         '''
-        query_from = max(self.min_queries_range, from_)
-        url = urljoin(self.endpoint, '/render')
-        response = self.get(url, params={
-            'target': query,
-            'format': 'json',
-            'from': '-%ss' % query_from,
-        })
-        data = response.json()
-        ret = OrderedDict()
+        key = ('query', query, from_, self.min_queries_range, None)
+        with measure(self.instrumentation, 'query', query), \
+                self.deadline_scope(deadline):
+            if self.cache is not None:
+                return self._cached(key, self._query_step, query, from_)
+            return self._coalesced(key, self._query_step, query, from_)[0]
+
+    def _cached(self, key, func, *args):
+        '''
+        Return the cached result of *func* called with *args*, recording
+        cache hits in the current call stats.
+        '''
+        stats = current_stats()
+        if stats is not None:
+            stats.cache_hit = True
+
+        def compute():
+            # Background refreshes don't count as misses of this call
+            if stats is not None and current_stats() is stats:
+                stats.cache_hit = False
+            return self._coalesced(key, func, *args)
+        return self.cache.get_or_compute(key, compute)
+
+    def _coalesced(self, key, func, *args):
+        '''
+        Call *func* with *args*, sharing the result with concurrent calls
+        with the same *key* if coalescing is enabled.
+        '''
+        if self.coalesce:
+            return self.flights.do(key, lambda: func(*args),
+                                   current_deadline())
+        return func(*args)
+
+    def _query_step(self, query, from_):
+        data = self._query(query, from_)
+        return data, series_step(data)
+
+    def _query(self, query, from_):
+        if self.incremental:
+            return self._query_incremental(query, from_)
+        if self._use_history(from_):
+            return self._query_history(query, from_)
+        if self.adaptive_range:
+            return self._query_adaptive(query, from_)
+        return self._render(query, from_)[0]
+
+    def _use_history(self, from_):
+        return self.history_cache is not None and \
+            from_ > max(self.min_queries_range, self.history_cache.settle)
+
+    def _render(self, query, from_, aggregator=None):
+        '''
+        Fetch the last *from_* seconds of *query*, and return a ``(data,
+        step)`` pair, with *data* aggregated with *aggregator* if it is not
+        None. Large responses are processed in :attr:`process_pool`.
+        '''
+        response = self._call('GET', '/render',
+                              params=self._render_params([query], from_))
+        if self.process_pool is not None and \
+                len(response.content) >= self.process_threshold:
+            return self._process(response, from_, aggregator)
+        data = build_result(self._decode(response), from_, self.series)
+        step = series_step(data)
+        if aggregator is not None:
+            with phase('aggregate'):
+                data = aggregate_result(data, aggregator)
+        return data, step
+
+    def _process(self, response, from_, aggregator):
+        '''
+        Like :meth:`_render`, for *response*, in :attr:`process_pool`.
+        '''
+        # Aggregators that can't be sent to the pool (e.g. lambdas) are
+        # applied to the returned series
+        remote_aggregator = aggregator if picklable(aggregator) else None
+        with phase('process'):
+            result, step, count = self.process_pool.apply(
+                process_render, (self.render_format, response.content, from_,
+                                 remote_aggregator))
+        stats = current_stats()
+        if stats is not None:
+            stats.datapoints += count
+        if remote_aggregator is not None:
+            return result, step
+        data = OrderedDict(
+            (name, unpack_series(packed, self.series))
+            for name, packed in result)
+        if aggregator is not None:
+            with phase('aggregate'):
+                data = aggregate_result(data, aggregator)
+        return data, step
+
+    def _query_adaptive(self, query, from_):
+        prefix = self.range_learner.prefix(query)
+        max_range = max(from_, self.adaptive_max_range)
+        query_range = min(max(from_, self.range_learner.get(prefix)),
+                          max_range)
+        widened = False
+        while True:
+            response = self._call('GET', '/render', params=render_params(
+                [query], query_range, 0, self.render_format))
+            data = self._decode(response)
+            empty = is_short_response(data)
+            if not empty or query_range >= max_range:
+                break
+            query_range = min(query_range * 2, max_range)
+            widened = True
+        if not widened:
+            self.range_learner.success(prefix)
+        elif not empty:
+            # Metrics without values over the widest range are just empty,
+            # their range is not learned
+            self.range_learner.learn(prefix, query_range)
+        return build_result(data, from_, self.series)
+
+    def _query_history(self, query, from_):
+        history = self.history_cache
+        now = int(time.time())
+        cached = OrderedDict()
+        for target in history.get_targets(query) or []:
+            entry = history.read(query, target, now - from_)
+            if entry is None:
+                cached = None
+                break
+            cached[target] = entry
+        data = None
+        if cached:
+            # Fetch from the oldest last cached timestamp, and at least
+            # min_queries_range to avoid empty responses
+            tail_from = min(min(last_ts for _, last_ts, _ in cached.values()),
+                            now - self.min_queries_range)
+            response = self._call('GET', '/render', params=[
+                ('target', query),
+                ('format', self.render_format),
+                ('from', str(tail_from)),
+            ] + decoders.FORMAT_PARAMS.get(self.render_format, []))
+            data = self._decode(response)
+            if [entry['target'] for entry in data] != list(cached):
+                # The query now returns other series
+                data = None
+            else:
+                tails = [match_step(entry['datapoints'],
+                                    cached[entry['target']][2])
+                         for entry in data]
+                if None in tails:
+                    data = None
+                else:
+                    for entry, tail in zip(data, tails):
+                        entry['datapoints'] = merge_tail(
+                            cached[entry['target']][0], tail)
+        if data is None:
+            response = self._call('GET', '/render',
+                                  params=self._render_params([query], from_))
+            data = self._decode(response)
+            history.set_targets(query, [entry['target'] for entry in data])
         for entry in data:
-            ret[entry['target']] = trim_datapoints(entry['datapoints'], from_)
+            history.append(query, entry['target'], entry['datapoints'],
+                           now - history.settle)
+        return build_result(data, from_, self.series)
+
+    def _query_incremental(self, query, from_):
+        buf = self.buffers.get(query)
+        data = None
+        if buf is not None and buf.max_age >= from_ and \
+                buf.last_ts is not None:
+            response = self._call('GET', '/render', params=[
+                ('target', query),
+                ('format', self.render_format),
+                ('from', str(buf.last_ts - self.incremental_overlap)),
+            ] + decoders.FORMAT_PARAMS.get(self.render_format, []))
+            data = self._decode(response)
+            if is_short_response(data):
+                # Possibly hit by the empty data bug, fetch the whole range
+                data = None
+            else:
+                buf.merge(raw_result(data))
+        if data is None:
+            response = self._call('GET', '/render',
+                                  params=self._render_params([query], from_))
+            buf = QueryBuffer(max(self.min_queries_range, from_),
+                              self.incremental_max_points)
+            buf.replace(raw_result(self._decode(response)))
+        self.buffers.set(query, buf)
+        ret = OrderedDict()
+        with phase('trim'):
+            for target, datapoints in buf.datapoints().items():
+                ret[target] = trim_result(datapoints, from_, self.series)
         return ret
 
-    def aggregate(self, query, from_=60, aggregator=average):
+    def query_iter(self, query, from_=60):
+        '''
+        Like :meth:`query`, but return an iterator of ``(target,
+        datapoints)`` pairs, decoded one by one while the response is read.
+
+        Peak memory usage is bounded by the size of the largest series
+        instead of the size of the whole response. The incremental mode and
+        the cache are not used, and the response is always requested in the
+        ``json`` format.
+        '''
+        response = self._call('GET', '/render',
+                              params=self._render_params([query], from_,
+                                                         'json'),
+                              stream=True)
+        try:
+            for entry in iter_json_array(response.iter_content(CHUNK_SIZE)):
+                yield entry['target'], trim_result(entry['datapoints'],
+                                                   from_, self.series)
+        finally:
+            response.close()
+
+    def query_range(self, query, start, end=None, chunk=None,
+                    max_workers=None, deadline=None):
+        '''
+        Return the datapoints of *query* after *start* and up to *end* (now
+        if None), :class:`~datetime.datetime` objects or unix timestamps, in
+        the same format as :meth:`query`.
+
+        If *chunk* is set, ranges longer than *chunk* seconds are split in
+        chunks aligned on multiples of *chunk* (see
+        :func:`robgracli.ranges.split_range`), fetched by up to *max_workers*
+        threads (defaults to *pool_maxsize*), and stitched back together as
+        they arrive, without overlaps. *chunk* should be a multiple of the
+        steps of the series, e.g. an hour or a day.
+
+        Graphite picks the archive of each chunk from how far back its start
+        is, so with multiple archives recent chunks are returned at a finer
+        step than older ones. They are consolidated to the step of the
+        oldest chunk of each series (see :func:`consolidate_steps`), so the
+        stitched series have a single step.
+
+        Since at most *max_workers* chunks are fetched ahead of the one
+        being stitched, the memory used is bounded by the result and
+        *max_workers* decoded chunks, instead of a single response of the
+        whole range. *deadline* caps the duration of the whole call, as for
+        :meth:`query`.
+        '''
+        start = to_timestamp(start)
+        end = to_timestamp(time.time() if end is None else end)
+        ranges = split_range(start, end, chunk) if chunk else [(start, end)]
+        stitcher = Stitcher(self.series)
+        with measure(self.instrumentation, 'query_range', query), \
+                self.deadline_scope(deadline):
+            fetch = bind_deadline(bind(partial(self._fetch_range, query)))
+            if len(ranges) > 1:
+                results = self.imap_ordered(fetch, ranges, max_workers)
+            else:
+                results = map(fetch, ranges)
+            steps = {}
+            for i, data in enumerate(results):
+                stitcher.add(consolidate_steps(data, steps), *ranges[i])
+        return stitcher.result()
+
+    def _fetch_range(self, query, range_):
+        start, end = range_
+        response = self._call('GET', '/render', params=range_params(
+            [query], start, end, self.render_format))
+        return self._decode(response)
+
+    def query_many(self, queries, from_=60, deadline=None):
+        '''
+        Like :meth:`query`, but for multiple *queries* at once.
+
+        Queries are grouped in as few ``/render`` calls as possible: a single
+        GET request if the resulting URL is shorter than *max_url_length*,
+        otherwise POST requests with bodies of at most *max_post_size* bytes.
+        With *compress_targets*, sibling metrics are also merged in single
+        targets, and series of merged targets that match none of the queries
+        are discarded.
+
+        The return value is an :class:`~collections.OrderedDict` with queries
+        as keys and the same values :meth:`query` would have returned for
+        them.
+
+        Graphite does not say which target produced which series, so the
+        series names of batched requests are matched against the queries, in
+        order. Only path expressions are batched: queries with function
+        calls, whose series names may not match them (e.g. ``alias()``), are
+        sent in their own request.
+        '''
+        queries = list(OrderedDict.fromkeys(queries))
+        with measure(self.instrumentation, 'query_many', queries), \
+                self.deadline_scope(deadline):
+            assigned = self._render_many(queries, from_)
+            ret = OrderedDict()
+            for query in queries:
+                ret[query] = build_result(assigned[query], from_, self.series)
+            return ret
+
+    def _render_many(self, queries, from_):
+        '''
+        Fetch the last *from_* seconds of *queries* like :meth:`query_many`,
+        and return the untrimmed response entries of each query.
+        '''
+        groups = OrderedDict(self._group_targets(queries))
+        url = max((urljoin(e, '/render') for e in self.endpoints), key=len)
+        assigned = OrderedDict()
+        for method, params, targets in self._plan_render(url, list(groups),
+                                                         from_):
+            if method == 'GET':
+                response = self._call('GET', '/render', params=params)
+            else:
+                response = self._call('POST', '/render', data=params)
+            assigned.update(assign_series(
+                [(target, groups[target]) for target in targets],
+                self._decode(response)))
+        return assigned
+
+    def evaluate(self, targets, from_=60, deadline=None):
+        '''
+        Like :meth:`query_many`, but evaluate the functions of *targets*
+        supported by :mod:`robgracli.functions` client side.
+
+        The path expressions of all the *targets* are fetched at once, each
+        only once even if several targets use it, so derived targets built
+        on the same metrics don't make Graphite read and compute them again.
+        Calls to unsupported functions, and targets that can't be parsed, are
+        sent to Graphite as is. Moving windows given as durations fetch the
+        datapoints they need before the requested range.
+
+        The return value is an :class:`~collections.OrderedDict` with
+        targets as keys and the same values :meth:`query` would have
+        returned for them.
+        '''
+        targets = list(OrderedDict.fromkeys(targets))
+        nodes = OrderedDict()
+        for target in targets:
+            try:
+                nodes[target] = functions.parse(target)
+            except ValueError:
+                logger.warning('cannot parse %r, evaluating it server side',
+                               target, exc_info=True)
+                nodes[target] = functions.Path(target)
+        leaves = list(OrderedDict.fromkeys(
+            leaf for node in nodes.values()
+            for leaf in functions.leaves(node)))
+        lookback = max([functions.lookback(node) for node in nodes.values()] or
+                       [0])
+        with measure(self.instrumentation, 'evaluate', targets), \
+                self.deadline_scope(deadline):
+            assigned = self._render_many(leaves, from_ + lookback)
+            data = dict((leaf, [functions.TimeSeries.from_datapoints(
+                entry['target'], entry['datapoints'])
+                for entry in assigned[leaf]]) for leaf in leaves)
+            ret = OrderedDict()
+            with phase('evaluate'):
+                for target, node in nodes.items():
+                    result = ret[target] = OrderedDict()
+                    for series in functions.evaluate(node, data):
+                        result[series.name] = trim_result(
+                            series.to_datapoints(), from_, self.series)
+            return ret
+
+    def aggregate(self, query, from_=60, aggregator=average,
+                  push_down=False, deadline=None):
         '''
         Get the current value of a metric, by aggregating Graphite datapoints
         over an interval.
 
         Values returned by *query* over the last *from_* seconds are aggregated
         using the *aggregator* function, after filtering out None values.
+        *aggregator* can also be the name of one of the built-in aggregators
+        of :mod:`robgracli.aggregators` (e.g. ``'avg'`` or ``'p95'``), that
+        aggregate all targets at once.
 
         The return value is an :class:`~collections.OrderedDict` with target
         names as keys and aggregated values as values, or None for targets that
         returned no datapoints or only None values.
+
+        If *push_down* is True and *aggregator* is ``'avg'``, ``'sum'``,
+        ``'min'``, ``'max'``, ``'last'`` (or the :func:`average`,
+        :func:`sum`, :func:`min` or :func:`max` functions), the aggregation is
+        done by Graphite, using the ``summarize()`` function with *from_*
+        seconds buckets, so only a few datapoints per target are downloaded.
+        *from_* should then be a multiple of the storage step. Aggregation
+        falls back to the client side if the target can't be rewritten or
+        Graphite returns an error.
+
+        *deadline* is the maximum duration of the call, as for
+        :meth:`query`.
         '''
-        data = self.query(query, from_)
+        key = ('aggregate', query, from_, self.min_queries_range, aggregator,
+               push_down)
+        with measure(self.instrumentation, 'aggregate', query), \
+                self.deadline_scope(deadline):
+            if self.cache is not None:
+                return self._cached(key, self._aggregate_step, query, from_,
+                                    aggregator, push_down)
+            return self._coalesced(key, self._aggregate_step, query, from_,
+                                   aggregator, push_down)[0]
+
+    def _aggregate_step(self, query, from_, aggregator, push_down=False):
+        if push_down:
+            func = aggregators.summarize_function(aggregator)
+            if func is not None and from_ > 0:
+                result = self._aggregate_summarized(query, from_, func)
+                if result is not None:
+                    return result, None
+        if not self.incremental and not self._use_history(from_) and \
+                not self.adaptive_range:
+            return self._render(query, from_, aggregator)
+        data = self._query(query, from_)
+        with phase('aggregate'):
+            result = aggregate_result(data, aggregator)
+        return result, series_step(data)
+
+    def aggregate_top(self, query, k, from_=60, aggregator=average,
+                      largest=True, deadline=None):
+        '''
+        Like :meth:`aggregate`, but only return the *k* targets with the
+        largest aggregated values (or the smallest if *largest* is False),
+        sorted by value (see :func:`robgracli.aggregators.top`). Targets with
+        no values are ignored.
+
+        Series are aggregated one by one while the response is decoded, like
+        :meth:`query_iter`, and only the best *k* are kept, so memory usage
+        grows with *k* instead of the number of targets.
+        '''
+        with measure(self.instrumentation, 'aggregate_top', query), \
+                self.deadline_scope(deadline):
+            return aggregators.top(
+                self._iter_aggregated(query, from_, aggregator), k, largest)
+
+    def aggregate_grouped(self, query, nodes, from_=60, aggregator=average,
+                          reducer='avg', deadline=None):
+        '''
+        Like :meth:`aggregate`, but group targets by the nodes of their names
+        at the positions *nodes*, like Graphite's ``groupByNodes()``, and
+        reduce the aggregated values of each group with *reducer* (see
+        :func:`robgracli.aggregators.group_by`). For example, the average
+        CPU usage of each datacenter::
+
+            client.aggregate_grouped('dc.*.servers.*.cpu', 1)
+
+        Series are aggregated one by one while the response is decoded, like
+        :meth:`query_iter`, so memory usage grows with the number of groups
+        instead of the number of targets.
+        '''
+        with measure(self.instrumentation, 'aggregate_grouped', query), \
+                self.deadline_scope(deadline):
+            return aggregators.group_by(
+                self._iter_aggregated(query, from_, aggregator), nodes,
+                reducer)
+
+    def _iter_aggregated(self, query, from_, aggregator):
+        for target, datapoints in self.query_iter(query, from_):
+            yield target, aggregate_datapoints(datapoints, aggregator)
+
+    def _aggregate_summarized(self, query, from_, func):
+        '''
+        Aggregate *query* with Graphite's ``summarize()`` function *func*.
+
+        The range queried is at least *min_queries_range*, rounded to a
+        multiple of *from_* so that the last bucket covers exactly the last
+        *from_* seconds. Return None if the result can't be used.
+        '''
+        query_from = max(self.min_queries_range, from_)
+        query_from = int(math.ceil(float(query_from) / from_) * from_)
+        try:
+            response = self._call('GET', '/render', params=[
+                ('target', 'summarize(%s, "%ss", "%s", true)' % (
+                    query, from_, func)),
+                ('format', self.render_format),
+                ('from', '-%ss' % query_from),
+            ] + decoders.FORMAT_PARAMS.get(self.render_format, []))
+        except BadResponse:
+            logger.warning('summarize() push down failed for %r, '
+                           'aggregating client side', query, exc_info=True)
+            return None
         ret = OrderedDict()
-        for key, values in data.items():
-            values = [v[0] for v in values if v[0] is not None]
-            if len(values):
-                ret[key] = aggregator(values)
-            else:
-                ret[key] = None
+        for entry in self._decode(response):
+            name = aggregators.unwrap_summarized_name(entry['target'])
+            if name is None:
+                return None
+            datapoints = entry['datapoints']
+            ret[name] = datapoints[-1][0] if datapoints else None
         return ret
 
-    def find_metrics(self, query):
+    def query_parallel(self, queries, from_=60, max_workers=None):
         '''
-        Find metrics on the server.
+        Call :meth:`query` for each item of *queries*, in a pool of
+        *max_workers* threads sharing the client's connection pool.
+
+        Return a list of ``(result, exception)`` pairs in the order of
+        *queries*: errors are collected instead of aborting the whole batch.
+        '''
+        return self.map_parallel(lambda query: self.query(query, from_),
+                                 queries, max_workers)
+
+    def aggregate_parallel(self, queries, from_=60, aggregator=average,
+                           max_workers=None, push_down=False):
+        '''
+        Like :meth:`query_parallel`, for :meth:`aggregate`.
+        '''
+        return self.map_parallel(
+            lambda query: self.aggregate(query, from_, aggregator, push_down),
+            queries, max_workers)
+
+    def watch(self, targets, callback, step=None):
+        '''
+        Call *callback* with the new datapoints of *targets* as they arrive,
+        until the returned subscription is cancelled with its ``cancel()``
+        method.
+
+        Watched targets are polled by :attr:`watcher`, a
+        :class:`robgracli.watch.Watcher` started on the first call, that can
+        also be set before to configure it. See :meth:`Watcher.watch
+        <robgracli.watch.Watcher.watch>` for the arguments.
+        '''
+        if self.watcher is None:
+            self.watcher = Watcher(self)
+        subscription = self.watcher.watch(targets, callback, step)
+        self.watcher.start()
+        return subscription
+
+    def find_metrics(self, query, use_index=True, deadline=None):
+        '''
+        Find metrics on the server, or in :attr:`metric_index` if it is set
+        (see :class:`robgracli.index.MetricIndex`) and *use_index* is True.
 
         Querying '*' will return the root of all metrics, and you can then find
         other metrics from there.
@@ -104,15 +755,550 @@ class GraphiteClient(HttpClient):
                 }
             ]
 
+        *deadline* is the maximum duration of the call, as for
+        :meth:`query`.
+        '''
+        if use_index and self.metric_index is not None:
+            return self.metric_index.find(query)
+        with measure(self.instrumentation, 'find_metrics', query), \
+                self.deadline_scope(deadline):
+            response = self._call('GET', '/metrics/find',
+                                  params={'query': query})
+            with phase('decode'):
+                return response.json()
+
+    def expand_metrics(self, pattern, use_index=True, deadline=None):
+        '''
+        Return the sorted list of the metrics matching *pattern*, from
+        :attr:`metric_index` if it is set and *use_index* is True, or from the
+        server.
+        '''
+        if use_index and self.metric_index is not None:
+            return self.metric_index.expand(pattern)
+        with self.deadline_scope(deadline):
+            response = self._call('GET', '/metrics/expand',
+                                  params={'query': pattern, 'leavesOnly': 1})
+        return sorted(response.json()['results'])
+
+    def _call(self, method, path, params=None, data=None, stream=False):
+        '''
+        Send a request to *path* on the best endpoint, failing over to the
+        next ones on network errors and 5xx responses, until the deadline of
+        the call. Endpoints whose circuit breaker is open are skipped.
+        '''
+        pool = self.endpoint_pool
+        endpoints = pool.ranked()
+        # Breakers are only asked just before sending a request, as half-open
+        # ones allow a single request
+        allowed = (endpoint for endpoint in endpoints if pool.allow(endpoint))
+        if self.hedge_percentile is not None and len(endpoints) > 1 and \
+                method == 'GET' and not stream:
+            delay = pool.latency_percentile(self.hedge_percentile)
+            if delay is not None:
+                candidates = list(islice(allowed, 2))
+                if len(candidates) == 2:
+                    return hedged_call(
+                        bind_deadline(bind(partial(
+                            self._call_endpoint, candidates[0], method, path,
+                            params, data, stream))),
+                        bind_deadline(bind(partial(
+                            self._call_endpoint, candidates[1], method, path,
+                            params, data, stream))),
+                        delay)
+                allowed = iter(candidates)
+        failed = None
+        for endpoint in allowed:
+            if failed is not None:
+                logger.warning('request to %s failed, trying next endpoint',
+                               failed[0], exc_info=failed[1])
+            try:
+                return self._call_endpoint(endpoint, method, path, params,
+                                           data, stream)
+            except Exception as exc:
+                if not is_endpoint_failure(exc):
+                    raise
+                failed = endpoint, sys.exc_info()
+        if failed is None:
+            raise CircuitOpen('the circuit breakers of all endpoints are '
+                              'open')
+        raise failed[1][1]
+
+    def _call_endpoint(self, endpoint, method, path, params, data, stream):
+        start = time.time()
+        try:
+            response = self.request(method, urljoin(endpoint, path),
+                                    data=data, params=params, stream=stream)
+        except Exception as exc:
+            if is_endpoint_failure(exc):
+                self.endpoint_pool.record_failure(endpoint)
+            raise
+        self.endpoint_pool.record_success(endpoint, time.time() - start)
+        return response
+
+    def _render_params(self, queries, from_, format=None):
+        return render_params(queries, from_, self.min_queries_range,
+                             format or self.render_format)
+
+    def _decode(self, response):
+        with phase('decode'):
+            data = decoders.decode(self.render_format, response.content)
+        stats = current_stats()
+        if stats is not None:
+            stats.datapoints += sum(len(entry['datapoints']) for entry in data)
+        return data
+
+    def _group_targets(self, queries):
+        '''
+        Return the ``(target, queries)`` pairs to render *queries*.
+        '''
+        if self.compress_targets:
+            return compress_targets(queries, self.metric_index)
+        return [(query, [query]) for query in queries]
+
+    def _plan_render(self, url, queries, from_):
         '''
-        url = urljoin(self.endpoint, '/metrics/find')
-        response = self.get(url, {'query': query})
-        return response.json()
+        Return the ``(method, params, targets)`` tuples of the ``/render``
+        requests needed to query *queries* at *url*.
+
+        Path expressions are batched in as few requests as possible. Targets
+        with function calls are sent in their own request, since the names
+        of their series can't be matched against them.
+        '''
+        paths = [query for query in queries
+                 if CALL_CHARS.search(query) is None]
+        plan = self._plan_batches(url, paths, from_) if paths else []
+        for query in queries:
+            if CALL_CHARS.search(query) is not None:
+                plan.extend(self._plan_batches(url, [query], from_))
+        return plan
+
+    def _plan_batches(self, url, queries, from_):
+        base_size = len(urlencode(self._render_params([], from_)))
+        if len(url) + 1 + batch_size(queries, base_size) <= \
+                self.max_url_length:
+            return [('GET', self._render_params(queries, from_), queries)]
+        return [('POST', self._render_params(batch, from_), batch)
+                for batch in split_batches(queries, base_size,
+                                           self.max_post_size)]
+
+
+def render_params(queries, from_, min_queries_range, format='json'):
+    '''
+    Return the ``/render`` parameters to query the last *from_* seconds of
+    *queries* in *format*, as a list of ``(name, value)`` pairs.
+    '''
+    query_from = max(min_queries_range, from_)
+    params = [('target', query) for query in queries]
+    params.append(('format', format))
+    params.append(('from', '-%ss' % query_from))
+    params.extend(decoders.FORMAT_PARAMS.get(format, []))
+    return params
+
+
+def range_params(queries, start, end, format='json'):
+    '''
+    Return the ``/render`` parameters to query *queries* between the unix
+    timestamps *start* and *end* in *format*.
+    '''
+    params = [('target', query) for query in queries]
+    params.append(('format', format))
+    params.append(('from', str(start)))
+    params.append(('until', str(end)))
+    params.extend(decoders.FORMAT_PARAMS.get(format, []))
+    return params
+
+
+def process_render(format, content, from_, aggregator=None):
+    '''
+    Decode the ``/render`` response *content* in *format*, trim its series to
+    the last *from_* seconds, and aggregate them with *aggregator* if it is
+    not None, as :meth:`GraphiteClient.aggregate` would.
+
+    This is the function called in :attr:`GraphiteClient.process_pool`, it
+    returns a ``(result, step, datapoints)`` tuple, with *result* the
+    aggregated values, or a list of ``(target, packed_series)`` pairs (see
+    :func:`unpack_series`), *step* the interval between datapoints, and
+    *datapoints* the number of datapoints received.
+    '''
+    data = decoders.decode(format, content)
+    count = sum(len(entry['datapoints']) for entry in data)
+    data = build_result(data, from_, series=True)
+    step = series_step(data)
+    if aggregator is not None:
+        return aggregate_result(data, aggregator), step, count
+    packed = [(name, (series.values[series.start:series.stop],
+                      series.timestamps[series.start:series.stop],
+                      series.mask[series.start:series.stop]))
+              for name, series in data.items()]
+    return packed, step, count
+
+
+def unpack_series(packed, series=False):
+    '''
+    Return the datapoints of a series packed by :func:`process_render`, as
+    a :class:`~robgracli.series.Series` if *series* is True.
+    '''
+    ret = Series(*packed)
+    if series:
+        return ret
+    return ret.to_datapoints()
+
+
+def picklable(obj):
+    '''
+    Return True if *obj* can be sent to other processes.
+    '''
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        return False
+    return True
+
+
+def aggregate_result(data, aggregator):
+    '''
+    Aggregate the datapoints of a :meth:`GraphiteClient.query` result *data*
+    with *aggregator*, as described in :meth:`GraphiteClient.aggregate`.
+    '''
+    if aggregators.is_builtin(aggregator):
+        return aggregators.aggregate(data, aggregator)
+    ret = OrderedDict()
+    for key, datapoints in data.items():
+        ret[key] = aggregate_datapoints(datapoints, aggregator)
+    return ret
+
+
+def aggregate_datapoints(datapoints, aggregator):
+    '''
+    Aggregate the datapoints of a single series with *aggregator*, as
+    described in :meth:`GraphiteClient.aggregate`.
+    '''
+    if aggregators.is_builtin(aggregator):
+        return aggregators.aggregate_series(datapoints, aggregator)
+    if isinstance(datapoints, Series):
+        values = datapoints.valid_values()
+    else:
+        values = [v[0] for v in datapoints if v[0] is not None]
+    if len(values):
+        return aggregator(values)
+    return None
+
+
+def merge_tail(cached, tail):
+    '''
+    Return the *cached* datapoints older than the first datapoint of *tail*,
+    followed by *tail*.
+    '''
+    if not tail:
+        return cached
+    first_ts = tail[0][1]
+    return [dp for dp in cached if dp[1] < first_ts] + tail
+
+
+def match_step(datapoints, step):
+    '''
+    Return *datapoints* with an interval of *step* seconds between
+    datapoints, or None if they can't be converted.
+
+    With multiple archives, Graphite returns recent datapoints at a finer
+    resolution than older ones. They are then consolidated by averaging the
+    datapoints of each *step* seconds bucket (Graphite's default aggregation
+    method), aligned on multiples of *step*. The first bucket is dropped if
+    the datapoints don't cover its start.
+    '''
+    if len(datapoints) < 2:
+        return datapoints
+    fine_step = datapoints[1][1] - datapoints[0][1]
+    if fine_step == step:
+        return datapoints
+    if fine_step <= 0 or fine_step > step or step % fine_step:
+        return None
+    ret = []
+    total = count = 0
+    for value, ts in datapoints:
+        bucket = ts - ts % step
+        if not ret or ret[-1][1] != bucket:
+            if ret:
+                ret[-1][0] = float(total) / count if count else None
+            ret.append([None, bucket])
+            total = count = 0
+        if value is not None:
+            total += value
+            count += 1
+    ret[-1][0] = float(total) / count if count else None
+    if ret[0][1] < datapoints[0][1]:
+        del ret[0]
+    return ret
+
+
+def consolidate_steps(data, steps):
+    '''
+    Consolidate the series of the decoded ``/render`` response *data* to the
+    steps recorded in *steps*, a dict with target names as keys, with
+    :func:`match_step`. The steps of series not in *steps* yet are recorded.
+
+    Consecutive responses are passed oldest first, so the steps recorded are
+    the coarsest ones. Series that can't be converted are left as is.
+    '''
+    for entry in data:
+        datapoints = entry['datapoints']
+        if len(datapoints) < 2:
+            continue
+        step = steps.setdefault(entry['target'],
+                                datapoints[1][1] - datapoints[0][1])
+        consolidated = match_step(datapoints, step)
+        if consolidated is not None:
+            entry['datapoints'] = consolidated
+    return data
+
+
+def raw_result(data):
+    '''
+    Return an :class:`~collections.OrderedDict` with target names as keys and
+    datapoints as values, from the decoded JSON *data* of a ``/render``
+    response.
+    '''
+    return OrderedDict((entry['target'], entry['datapoints'])
+                       for entry in data)
+
+
+def build_result(data, from_, series=False):
+    '''
+    Convert the decoded JSON *data* of a ``/render`` response to the
+    :class:`~collections.OrderedDict` returned by
+    :meth:`GraphiteClient.query`, with :class:`~robgracli.series.Series`
+    values if *series* is True.
+    '''
+    ret = OrderedDict()
+    with phase('trim'):
+        for entry in data:
+            ret[entry['target']] = trim_result(entry['datapoints'], from_,
+                                               series)
+    return ret
+
+
+def trim_result(datapoints, max_age, series=False):
+    '''
+    Trim *datapoints* like :func:`trim_datapoints`, returning a
+    :class:`~robgracli.series.Series` if *series* is True.
+    '''
+    if series:
+        return Series.from_datapoints(datapoints).trim(max_age)
+    return trim_datapoints(datapoints, max_age)
+
+
+def batch_size(queries, base_size):
+    '''
+    Return the size of the urlencoded ``/render`` parameters for *queries*,
+    *base_size* being the size of the other parameters.
+    '''
+    return base_size + sum(len(urlencode([('target', q)])) + 1
+                           for q in queries)
+
+
+def split_batches(queries, base_size, max_size):
+    '''
+    Split *queries* in lists whose urlencoded ``/render`` parameters are at
+    most *max_size* long. Each batch contains at least one query, even if it
+    exceeds the limit on its own.
+    '''
+    batch = []
+    size = base_size
+    for query in queries:
+        query_size = len(urlencode([('target', query)])) + 1
+        if batch and size + query_size > max_size:
+            yield batch
+            batch = []
+            size = base_size
+        batch.append(query)
+        size += query_size
+    if batch:
+        yield batch
+
+
+def compress_targets(queries, index=None):
+    '''
+    Merge the metric paths of *queries* that only differ by one node in
+    Graphite brace expressions, e.g. ``a.b.c1`` and ``a.b.c2`` in
+    ``a.b.{c1,c2}``. Queries with functions or braces are left as is.
+
+    If *index* (a :class:`robgracli.index.MetricIndex`) says that the merged
+    nodes are all the existing ones, a ``*`` wildcard is used instead of the
+    braces. It may then match metrics created since the index was built,
+    that :func:`assign_series` discards.
+
+    Return a list of ``(target, queries)`` pairs, *queries* being the list
+    of queries merged in *target*, in the order of *queries*.
+    '''
+    nodes = dict((query, query.split('.')) for query in queries
+                 if NOT_PLAIN.search(query) is None)
+    existing = set(queries)
+    groups = {}
+    remaining = [query for query in queries if query in nodes]
+    depth = max([len(n) for n in nodes.values()] or [0])
+    for position in reversed(range(depth)):
+        siblings = OrderedDict()
+        for query in remaining:
+            query_nodes = nodes[query]
+            if position < len(query_nodes):
+                key = (len(query_nodes), tuple(query_nodes[:position]),
+                       tuple(query_nodes[position + 1:]))
+                siblings.setdefault(key, []).append(query)
+        for members in siblings.values():
+            if len(members) < 2:
+                continue
+            target = merged_target(members, nodes, position, index)
+            if target in existing:
+                continue
+            groups[members[0]] = (target, members)
+            for member in members:
+                groups.setdefault(member, None)
+        remaining = [query for query in remaining if query not in groups]
+    ret = []
+    for query in queries:
+        if query not in groups:
+            ret.append((query, [query]))
+        elif groups[query] is not None:
+            ret.append(groups[query])
+    return ret
+
+
+def merged_target(members, nodes, position, index):
+    names = [nodes[member][position] for member in members]
+    template = list(nodes[members[0]])
+    if index is not None and not any(GLOB_CHARS.search(n) for n in names):
+        template[position] = '*'
+        leaves = index.expand('.'.join(template))
+        if set(leaf.split('.')[position] for leaf in leaves) == set(names):
+            return '.'.join(template)
+    template[position] = '{%s}' % ','.join(names)
+    return '.'.join(template)
+
+
+def assign_series(groups, data):
+    '''
+    Assign the series of a ``/render`` response *data* for the targets of
+    *groups* (as returned by :func:`compress_targets`) to the queries that
+    requested them, like :func:`split_series`. Series of merged targets that
+    match none of their queries are discarded.
+    '''
+    ret = OrderedDict()
+    split = split_series([target for target, _ in groups], data)
+    for (target, members), entries in zip(groups, split.values()):
+        if members == [target]:
+            ret[target] = entries
+            continue
+        for member in members:
+            ret[member] = []
+        for entry in entries:
+            for member in members:
+                if target_matches(member, entry['target']):
+                    ret[member].append(entry)
+                    break
+    return ret
+
+
+def split_series(queries, data):
+    '''
+    Assign the series of a multi-target ``/render`` response *data* to the
+    *queries* that produced them.
+
+    Graphite returns series in the order of the targets, so they are matched
+    against the queries starting from the last matched one. Series that
+    match no query are discarded, unless there is a single query. Return an
+    :class:`~collections.OrderedDict` with queries as keys and lists of
+    response entries as values.
+    '''
+    ret = OrderedDict((query, []) for query in queries)
+    if len(queries) == 1:
+        ret[queries[0]].extend(data)
+        return ret
+    seen = set()
+    index = 0
+    for entry in data:
+        name = entry['target']
+        start = index + 1 if name in seen else index
+        matched = None
+        for i in range(start, len(queries)):
+            if target_matches(queries[i], name):
+                matched = i
+                break
+        if matched is None and queries and \
+                target_matches(queries[index], name):
+            matched = index
+        if matched is None:
+            logger.warning('discarding series %r matching none of the '
+                           'queries', name)
+            continue
+        if matched != index:
+            index = matched
+            seen = set()
+        seen.add(name)
+        ret[queries[index]].append(entry)
+    return ret
+
+
+_glob_regexes = OrderedDict()
+_glob_regexes_lock = threading.Lock()
+
+
+def target_matches(pattern, name):
+    '''
+    Return True if the series *name* matches the Graphite path expression
+    *pattern* (supporting ``*``, ``?``, ``[...]`` and ``{a,b}``).
+    '''
+    if pattern == name:
+        return True
+    # Merged targets change from batch to batch, only the most recently
+    # used ones are kept
+    with _glob_regexes_lock:
+        regex = _glob_regexes.pop(pattern, None)
+        if regex is None:
+            regex = re.compile(glob_to_regex(pattern) + '$')
+            if len(_glob_regexes) >= GLOB_CACHE_SIZE:
+                _glob_regexes.popitem(last=False)
+        _glob_regexes[pattern] = regex
+    return regex.match(name) is not None
+
+
+def glob_to_regex(pattern):
+    '''
+    Translate the Graphite path expression *pattern* to a regular
+    expression.
+    '''
+    ret = []
+    i = 0
+    in_braces = False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            ret.append('[^.]*')
+        elif char == '?':
+            ret.append('[^.]')
+        elif char == '[':
+            end = pattern.find(']', i)
+            if end == -1:
+                ret.append(re.escape(char))
+            else:
+                ret.append(pattern[i:end + 1])
+                i = end
+        elif char == '{' and not in_braces:
+            ret.append('(?:')
+            in_braces = True
+        elif char == '}' and in_braces:
+            ret.append(')')
+            in_braces = False
+        elif char == ',' and in_braces:
+            ret.append('|')
+        else:
+            ret.append(re.escape(char))
+        i += 1
+    return ''.join(ret)
 
 
 def trim_datapoints(datapoints, max_age):
     if len(datapoints):
         last_ts = datapoints[-1][1]
-        return filter(lambda (_, ts): last_ts - ts <= max_age, datapoints)
+        return [dp for dp in datapoints if last_ts - dp[1] <= max_age]
     else:
         return []
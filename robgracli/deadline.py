@@ -0,0 +1,134 @@
+'''
+End-to-end deadlines, capping the total duration of client calls across
+connections, reads, retries and backoff delays.
+'''
+import threading
+import time
+
+from requests.packages.urllib3.util.timeout import Timeout
+
+from .exceptions import DeadlineExceeded
+
+
+_local = threading.local()
+
+
+class Deadline(object):
+    '''
+    A point in time, *timeout* seconds from now, at which a call must be
+    done.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def check(self):
+        '''
+        Raise :class:`~robgracli.exceptions.DeadlineExceeded` if the deadline
+        has passed.
+        '''
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(self.timeout)
+
+
+def current_deadline():
+    '''
+    Return the :class:`Deadline` of the call in progress in the current
+    thread, or None.
+    '''
+    return getattr(_local, 'deadline', None)
+
+
+def deadline_scope(timeout):
+    '''
+    Return a context manager applying a deadline *timeout* seconds from now
+    to the calls made in its block, in the current thread. Does nothing if
+    *timeout* is None, or if an earlier deadline already applies.
+    '''
+    current = current_deadline()
+    if timeout is None or (current is not None and
+                           current.remaining() <= timeout):
+        return NULL_SCOPE
+    return DeadlineScope(Deadline(timeout), current)
+
+
+def check_delay(delay):
+    '''
+    Raise :class:`~robgracli.exceptions.DeadlineExceeded` if waiting *delay*
+    seconds would exceed the deadline of the current call.
+    '''
+    deadline = current_deadline()
+    if deadline is not None and delay >= deadline.remaining():
+        raise DeadlineExceeded(deadline.timeout)
+
+
+def bind(func):
+    '''
+    Return a function calling *func* with the deadline of the calling
+    thread, to apply it to calls made in other threads.
+    '''
+    deadline = current_deadline()
+    if deadline is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        # Restored on exit, when called in the calling thread
+        previous = current_deadline()
+        _local.deadline = deadline
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return wrapper
+
+
+class DeadlineScope(object):
+
+    def __init__(self, deadline, previous):
+        self.deadline = deadline
+        self.previous = previous
+
+    def __enter__(self):
+        _local.deadline = self.deadline
+        return self.deadline
+
+    def __exit__(self, *exc_info):
+        _local.deadline = self.previous
+        return False
+
+
+class NullScope(object):
+
+    def __enter__(self):
+        return current_deadline()
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SCOPE = NullScope()
+
+
+class DeadlineTimeout(Timeout):
+    '''
+    A urllib3 timeout whose connect and read timeouts shrink to the time
+    remaining before *deadline*.
+
+    urllib3 clones the timeout for each attempt, retries included, so each
+    attempt gets the remaining time, and no attempt is made once the
+    deadline has passed.
+    '''
+
+    def __init__(self, connect, read, deadline):
+        super(DeadlineTimeout, self).__init__(connect=connect, read=read)
+        self.deadline = deadline
+
+    def clone(self):
+        self.deadline.check()
+        remaining = self.deadline.remaining()
+        return Timeout(connect=min(self._connect, remaining),
+                       read=min(self._read, remaining), total=remaining)
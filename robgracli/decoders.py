@@ -0,0 +1,122 @@
+'''
+Decoders for the formats of Graphite's ``/render`` responses.
+
+All decoders take the raw response body and return a list of ``{'target':
+name, 'datapoints': [[value, timestamp], ...]}`` dicts, like the ``json``
+format.
+
+Supported formats:
+
+* ``json``: decoded with `orjson <https://github.com/ijl/orjson>`_ or
+  `ujson <https://github.com/ultrajson/ultrajson>`_ if one of them is
+  installed, or the standard library :mod:`json` module otherwise;
+* ``pickle``: decoded with an unpickler that refuses to load anything but
+  basic types, so it is safe to use with untrusted servers;
+* ``raw``: Graphite's ``target,start,end,step|value,...`` text format;
+* ``csv``: Graphite's ``target,date,value`` text format, requested with
+  ``tz=UTC``.
+'''
+import calendar
+import io
+import json
+import pickle
+
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = None
+
+
+def decode_json(content):
+    if fast_json is not None:
+        return fast_json.loads(content)
+    return json.loads(content.decode('utf-8'))
+
+
+class SafeUnpickler(pickle.Unpickler):
+    '''
+    An unpickler that only loads basic types (dicts, lists, strings,
+    numbers...), and raises :class:`pickle.UnpicklingError` for everything
+    else.
+    '''
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('forbidden global: %s.%s' %
+                                     (module, name))
+
+
+def decode_pickle(content):
+    ret = []
+    for series in SafeUnpickler(io.BytesIO(content)).load():
+        start = series['start']
+        step = series['step']
+        ret.append({
+            'target': series['name'],
+            'datapoints': [[value, start + i * step]
+                           for i, value in enumerate(series['values'])],
+        })
+    return ret
+
+
+def decode_raw(content):
+    ret = []
+    for line in content.decode('utf-8').splitlines():
+        if not line:
+            continue
+        header, values = line.rsplit('|', 1)
+        target, start, _, step = header.rsplit(',', 3)
+        start = int(start)
+        step = int(step)
+        datapoints = []
+        ts = start
+        for value in values.split(','):
+            datapoints.append([None if value == 'None' else float(value), ts])
+            ts += step
+        ret.append({'target': target, 'datapoints': datapoints})
+    return ret
+
+
+def decode_csv(content):
+    ret = []
+    current = None
+    for line in content.decode('utf-8').splitlines():
+        if not line:
+            continue
+        target, date, value = line.rsplit(',', 2)
+        if current is None or current['target'] != target:
+            current = {'target': target, 'datapoints': []}
+            ret.append(current)
+        # Slicing is much faster than time.strptime()
+        ts = calendar.timegm((int(date[0:4]), int(date[5:7]),
+                              int(date[8:10]), int(date[11:13]),
+                              int(date[14:16]), int(date[17:19])))
+        current['datapoints'].append([float(value) if value else None, ts])
+    return ret
+
+
+#: Decoders by format name
+DECODERS = {
+    'json': decode_json,
+    'pickle': decode_pickle,
+    'raw': decode_raw,
+    'csv': decode_csv,
+}
+
+#: Extra ``/render`` parameters needed by each format
+FORMAT_PARAMS = {
+    'csv': [('tz', 'UTC')],
+}
+
+
+def decode(format, content):
+    '''
+    Decode the ``/render`` response body *content*, in the given *format*.
+    '''
+    try:
+        decoder = DECODERS[format]
+    except KeyError:
+        raise ValueError('unsupported format: %r' % format)
+    return decoder(content)
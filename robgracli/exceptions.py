@@ -20,3 +20,21 @@ Graphite response
                 sep='-' * 79,
                 response=response.text)
         super(BadResponse, self).__init__(err)
+
+
+class CircuitOpen(GraphiteException):
+    '''
+    Raised when no request is sent because the circuit breakers of all
+    endpoints are open.
+    '''
+
+
+class DeadlineExceeded(GraphiteException):
+    '''
+    Raised when a call did not complete before its deadline.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        super(DeadlineExceeded, self).__init__(
+            'deadline of %ss exceeded' % timeout)
@@ -0,0 +1,563 @@
+'''
+A client-side evaluator for a subset of Graphite's render functions, used by
+:meth:`robgracli.client.GraphiteClient.evaluate`.
+
+Supported functions are:
+
+* ``sumSeries()`` (or ``sum()``), ``averageSeries()`` (or ``avg()``),
+  ``minSeries()``, ``maxSeries()``, ``diffSeries()`` and
+  ``multiplySeries()``, combining series datapoint by datapoint;
+* ``scale()``, ``offset()``, ``absolute()``, ``derivative()``,
+  ``nonNegativeDerivative()`` and ``alias()``;
+* ``movingAverage()``, with a number of datapoints or a duration (e.g.
+  ``'5min'``) as window, that includes the current datapoint, and no
+  ``xFilesFactor``;
+* ``asPercent()``, with no total, a number, or a series list as total.
+
+Other functions, and calls whose arguments don't match these signatures, are
+left to Graphite: they are sent verbatim, with their arguments, as the
+targets of the evaluated expressions. Series are combined
+on the union of their timestamps, with vectorized numpy operations when
+`numpy <http://www.numpy.org>`_ is installed.
+'''
+import inspect
+import re
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .aggregators import string_types
+
+
+#: Supported functions, by name
+FUNCTIONS = {}
+
+NUMBER = re.compile(r'^-?\d+(\.\d*)?([eE][-+]?\d+)?$')
+DURATION = re.compile(r'^(\d+)([a-z]+)$')
+UNITS = [
+    ('s', 1),
+    ('min', 60),
+    ('h', 60 * 60),
+    ('d', 24 * 60 * 60),
+    ('w', 7 * 24 * 60 * 60),
+    ('mon', 30 * 24 * 60 * 60),
+    ('y', 365 * 24 * 60 * 60),
+]
+LITERALS = {
+    'true': True,
+    'false': False,
+    'none': None,
+}
+
+
+class Path(object):
+    '''
+    A path expression, e.g. ``servers.*.cpu``.
+    '''
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return 'Path(%r)' % self.text
+
+
+class Call(object):
+    '''
+    A function call, *text* being its source.
+    '''
+
+    def __init__(self, name, args, kwargs, text):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.text = text
+
+    def __repr__(self):
+        return 'Call(%r)' % self.text
+
+
+class TimeSeries(object):
+    '''
+    A named series, with lists of timestamps and values (None for missing
+    values).
+    '''
+
+    def __init__(self, name, timestamps, values):
+        self.name = name
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def from_datapoints(cls, name, datapoints):
+        return cls(name, [dp[1] for dp in datapoints],
+                   [dp[0] for dp in datapoints])
+
+    def to_datapoints(self):
+        return [[value, ts] for value, ts in zip(self.values,
+                                                 self.timestamps)]
+
+    def step(self):
+        if len(self.timestamps) < 2:
+            return None
+        return self.timestamps[1] - self.timestamps[0]
+
+    def map(self, name, func):
+        '''
+        Return a series named *name* with *func* applied to the values that
+        are not None.
+        '''
+        return TimeSeries(name, self.timestamps,
+                          [None if v is None else func(v)
+                           for v in self.values])
+
+
+def parse(target):
+    '''
+    Parse the *target* expression, and return a :class:`Path` or
+    :class:`Call` tree. Raise ValueError if it is invalid.
+    '''
+    tokens = tokenize(target)
+    node, pos = parse_expression(target, tokens, 0)
+    if pos != len(tokens):
+        raise ValueError('unexpected %r in %r' % (tokens[pos][0], target))
+    if not isinstance(node, (Path, Call)):
+        raise ValueError('invalid target: %r' % target)
+    return node
+
+
+def tokenize(target):
+    '''
+    Return the ``(token, start, end)`` tuples of *target*: punctuation,
+    quoted strings (with their quotes) and words (path expressions, function
+    names, numbers). Braces of path expressions may contain commas.
+    '''
+    tokens = []
+    pos = 0
+    while pos < len(target):
+        char = target[pos]
+        if char.isspace():
+            pos += 1
+        elif char in '(),=':
+            tokens.append((char, pos, pos + 1))
+            pos += 1
+        elif char in '\'"':
+            end = target.find(char, pos + 1)
+            if end == -1:
+                raise ValueError('unterminated string in %r' % target)
+            tokens.append((target[pos:end + 1], pos, end + 1))
+            pos = end + 1
+        else:
+            start = pos
+            depth = 0
+            while pos < len(target):
+                char = target[pos]
+                if char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                elif depth <= 0 and (char in '(),=\'"' or char.isspace()):
+                    break
+                pos += 1
+            tokens.append((target[start:pos], start, pos))
+    return tokens
+
+
+def parse_expression(target, tokens, pos):
+    if pos >= len(tokens):
+        raise ValueError('unexpected end of %r' % target)
+    token, start, end = tokens[pos]
+    if token in '(),=':
+        raise ValueError('unexpected %r in %r' % (token, target))
+    if token[0] in '\'"':
+        return token[1:-1], pos + 1
+    if pos + 1 < len(tokens) and tokens[pos + 1][0] == '(':
+        return parse_call(target, tokens, pos)
+    if NUMBER.match(token):
+        value = float(token)
+        return int(value) if value.is_integer() and '.' not in token and \
+            'e' not in token.lower() else value, pos + 1
+    if token.lower() in LITERALS:
+        return LITERALS[token.lower()], pos + 1
+    return Path(token), pos + 1
+
+
+def parse_call(target, tokens, pos):
+    name, start, _ = tokens[pos]
+    pos += 2
+    args = []
+    kwargs = {}
+    while True:
+        if pos >= len(tokens):
+            raise ValueError('unexpected end of %r' % target)
+        if tokens[pos][0] == ')':
+            break
+        if pos + 1 < len(tokens) and tokens[pos + 1][0] == '=':
+            key = tokens[pos][0]
+            kwargs[key], pos = parse_expression(target, tokens, pos + 2)
+        else:
+            arg, pos = parse_expression(target, tokens, pos)
+            args.append(arg)
+        if pos < len(tokens) and tokens[pos][0] == ',':
+            pos += 1
+        elif pos >= len(tokens) or tokens[pos][0] != ')':
+            raise ValueError('expected "," or ")" in %r' % target)
+    end = tokens[pos][2]
+    return Call(name, args, kwargs, target[start:end]), pos + 1
+
+
+def is_supported(node):
+    '''
+    Return True if *node* is a call to a supported function, with arguments
+    matching the signature of its implementation.
+    '''
+    if not isinstance(node, Call) or node.name not in FUNCTIONS:
+        return False
+    try:
+        inspect.getcallargs(FUNCTIONS[node.name], node, *node.args,
+                            **node.kwargs)
+    except TypeError:
+        return False
+    return True
+
+
+def leaves(node):
+    '''
+    Return the targets to fetch from Graphite to evaluate *node*: its path
+    expressions, and its calls to unsupported functions.
+    '''
+    if isinstance(node, Path) or \
+            (isinstance(node, Call) and not is_supported(node)):
+        return [node.text]
+    if not isinstance(node, Call):
+        return []
+    ret = []
+    for arg in node.args + list(node.kwargs.values()):
+        ret.extend(leaves(arg))
+    return ret
+
+
+def lookback(node):
+    '''
+    Return the number of seconds of datapoints needed by *node* before the
+    evaluated range, for moving windows given as durations.
+    '''
+    if not is_supported(node):
+        return 0
+    ret = max([lookback(arg)
+               for arg in node.args + list(node.kwargs.values())] or [0])
+    if node.name == 'movingAverage':
+        window = node.args[1] if len(node.args) > 1 else \
+            node.kwargs.get('windowSize')
+        if isinstance(window, string_types):
+            ret += parse_duration(window)
+    return ret
+
+
+def evaluate(node, data):
+    '''
+    Evaluate *node*, and return the resulting list of :class:`TimeSeries`.
+
+    *data* is a dict with the targets returned by :func:`leaves` as keys and
+    lists of :class:`TimeSeries` as values.
+    '''
+    if isinstance(node, Path) or \
+            (isinstance(node, Call) and not is_supported(node)):
+        return list(data.get(node.text, []))
+    if not isinstance(node, Call):
+        return node
+    args = [evaluate(arg, data) for arg in node.args]
+    kwargs = dict((key, evaluate(value, data))
+                  for key, value in node.kwargs.items())
+    return FUNCTIONS[node.name](node, *args, **kwargs)
+
+
+def parse_duration(duration):
+    '''
+    Return the number of seconds of a Graphite *duration*, e.g. ``'5min'``.
+    '''
+    match = DURATION.match(duration.strip().lstrip('-').lower())
+    if match is not None:
+        count, unit = match.groups()
+        for prefix, seconds in reversed(UNITS):
+            if unit.startswith(prefix):
+                return int(count) * seconds
+    raise ValueError('invalid duration: %r' % duration)
+
+
+def function(*names):
+    '''
+    Register the decorated function as the implementation of the Graphite
+    functions *names*.
+    '''
+    def register(func):
+        for name in names:
+            FUNCTIONS[name] = func
+        return func
+    return register
+
+
+def format_arg(value):
+    if isinstance(value, string_types):
+        return '"%s"' % value
+    return str(value)
+
+
+def series_expression(node):
+    '''
+    Return the source of the series arguments of *node*, used to name
+    combined series like Graphite.
+    '''
+    return ','.join(sorted(set(arg.text for arg in node.args
+                               if isinstance(arg, (Path, Call)))))
+
+
+def flatten(series_lists):
+    ret = []
+    for series_list in series_lists:
+        if isinstance(series_list, list):
+            ret.extend(series_list)
+    return ret
+
+
+def align(series_list):
+    '''
+    Return the sorted union of the timestamps of *series_list*, and the rows
+    of values of each series for these timestamps.
+    '''
+    timestamps = sorted(set(ts for series in series_list
+                            for ts in series.timestamps))
+    rows = []
+    for series in series_list:
+        values = dict(zip(series.timestamps, series.values))
+        rows.append([values.get(ts) for ts in timestamps])
+    return timestamps, rows
+
+
+def combine(node, series_list, name):
+    '''
+    Combine *series_list* datapoint by datapoint with the reduction *name*
+    (``sum``, ``avg``, ``min``, ``max``, ``diff`` or ``multiply``).
+    '''
+    if not series_list:
+        return []
+    timestamps, rows = align(series_list)
+    if numpy is not None and name in ('sum', 'avg', 'min', 'max'):
+        values = combine_vectorized(rows, name)
+    else:
+        values = [combine_values(column, name) for column in zip(*rows)]
+    return [TimeSeries('%s(%s)' % (node.name, series_expression(node)),
+                       timestamps, values)]
+
+
+def combine_values(values, name):
+    if name == 'multiply':
+        if None in values:
+            return None
+        ret = 1
+        for value in values:
+            ret *= value
+        return ret
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    if name == 'sum':
+        return sum(values)
+    elif name == 'avg':
+        return float(sum(values)) / len(values)
+    elif name == 'min':
+        return min(values)
+    elif name == 'max':
+        return max(values)
+    # Like Graphite, the first value that is not None minus the others
+    return values[0] - sum(values[1:])
+
+
+def combine_vectorized(rows, name):
+    matrix = numpy.array([[numpy.nan if v is None else v for v in row]
+                          for row in rows], dtype=float)
+    empty = numpy.isnan(matrix).all(axis=0)
+    with warnings.catch_warnings():
+        # All-NaN columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if name == 'sum':
+            result = numpy.nansum(matrix, axis=0)
+        elif name == 'avg':
+            result = numpy.nanmean(matrix, axis=0)
+        elif name == 'min':
+            result = numpy.nanmin(matrix, axis=0)
+        else:
+            result = numpy.nanmax(matrix, axis=0)
+    return [None if e else float(r) for r, e in zip(result, empty)]
+
+
+@function('sumSeries', 'sum')
+def sum_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'sum')
+
+
+@function('averageSeries', 'avg')
+def average_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'avg')
+
+
+@function('minSeries')
+def min_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'min')
+
+
+@function('maxSeries')
+def max_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'max')
+
+
+@function('diffSeries')
+def diff_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'diff')
+
+
+@function('multiplySeries')
+def multiply_series(node, *series_lists):
+    return combine(node, flatten(series_lists), 'multiply')
+
+
+@function('scale')
+def scale(node, series_list, factor):
+    return [series.map('scale(%s,%s)' % (series.name, format_arg(factor)),
+                       lambda value: value * factor)
+            for series in series_list]
+
+
+@function('offset')
+def offset(node, series_list, factor):
+    return [series.map('offset(%s,%s)' % (series.name, format_arg(factor)),
+                       lambda value: value + factor)
+            for series in series_list]
+
+
+@function('absolute')
+def absolute(node, series_list):
+    return [series.map('absolute(%s)' % series.name, abs)
+            for series in series_list]
+
+
+@function('alias')
+def alias(node, series_list, new_name):
+    return [TimeSeries(new_name, series.timestamps, series.values)
+            for series in series_list]
+
+
+@function('derivative')
+def derivative(node, series_list):
+    return [TimeSeries('derivative(%s)' % series.name, series.timestamps,
+                       deltas(series.values, False))
+            for series in series_list]
+
+
+@function('nonNegativeDerivative')
+def non_negative_derivative(node, series_list):
+    return [TimeSeries('nonNegativeDerivative(%s)' % series.name,
+                       series.timestamps, deltas(series.values, True))
+            for series in series_list]
+
+
+def deltas(values, non_negative):
+    ret = []
+    previous = None
+    for value in values:
+        if value is None or previous is None:
+            ret.append(None)
+        else:
+            delta = value - previous
+            ret.append(None if non_negative and delta < 0 else delta)
+        previous = value
+    return ret
+
+
+@function('movingAverage')
+def moving_average(node, series_list, windowSize):
+    ret = []
+    for series in series_list:
+        if isinstance(windowSize, string_types):
+            step = series.step()
+            points = parse_duration(windowSize) // step if step else 1
+        else:
+            points = int(windowSize)
+        name = 'movingAverage(%s,%s)' % (series.name, format_arg(windowSize))
+        ret.append(TimeSeries(name, series.timestamps,
+                              moving_averages(series.values,
+                                              max(points, 1))))
+    return ret
+
+
+def moving_averages(values, points):
+    '''
+    Return the averages of the values that are not None in the windows of
+    *points* values ending at each value.
+    '''
+    if numpy is not None:
+        array = numpy.array([numpy.nan if v is None else v for v in values],
+                            dtype=float)
+        valid = ~numpy.isnan(array)
+        sums = numpy.concatenate(([0.], numpy.cumsum(numpy.where(valid,
+                                                                 array, 0))))
+        counts = numpy.concatenate(([0], numpy.cumsum(valid)))
+        starts = numpy.maximum(numpy.arange(1, len(array) + 1) - points, 0)
+        window_sums = sums[1:] - sums[starts]
+        window_counts = counts[1:] - counts[starts]
+        return [None if c == 0 else float(s) / c
+                for s, c in zip(window_sums, window_counts)]
+    ret = []
+    total = 0.
+    count = 0
+    for i, value in enumerate(values):
+        if value is not None:
+            total += value
+            count += 1
+        if i >= points:
+            old = values[i - points]
+            if old is not None:
+                total -= old
+                count -= 1
+        ret.append(total / count if count else None)
+    return ret
+
+
+@function('asPercent')
+def as_percent(node, series_list, total=None):
+    if total is None:
+        if not series_list:
+            return []
+        total_series = combine(Call('sumSeries', node.args[:1], {}, ''),
+                               series_list, 'sum')
+        totals = total_series * len(series_list)
+    elif isinstance(total, list):
+        if len(total) == 1:
+            totals = total * len(series_list)
+        elif len(total) == len(series_list):
+            totals = total
+        else:
+            raise ValueError('asPercent() total must have 1 series or as '
+                             'many as the series list')
+    else:
+        return [series.map('asPercent(%s,%s)' % (series.name,
+                                                 format_arg(total)),
+                           lambda value: percent(value, total))
+                for series in series_list]
+    ret = []
+    for series, total_series in zip(series_list, totals):
+        timestamps, (values, total_values) = align([series, total_series])
+        ret.append(TimeSeries(
+            'asPercent(%s,%s)' % (series.name, total_series.name), timestamps,
+            [percent(value, total_value)
+             for value, total_value in zip(values, total_values)]))
+    return ret
+
+
+def percent(value, total):
+    if value is None or not total:
+        return None
+    return value * 100. / total
@@ -0,0 +1,301 @@
+'''
+A persistent on-disk cache of historical datapoints, shared by all the
+processes of a host, used by :class:`robgracli.client.GraphiteClient` to
+only fetch the recent tail of long-range queries.
+'''
+import errno
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+#: Header of data files: magic, step, timestamp of the first value, number
+#: of values
+HEADER = struct.Struct('<4sIqQ')
+MAGIC = b'RGH1'
+VALUE_SIZE = 8
+NAN = float('nan')
+
+
+class HistoryCache(object):
+    '''
+    Caches the datapoints of each series returned by a query that are older
+    than *settle* seconds, and thus no longer expected to change.
+
+    Each series is stored in its own file, as a fixed-width array of
+    little-endian doubles (None values are stored as NaN) after a small
+    header, and read by memory-mapping it. Timestamps are not stored: the
+    datapoint at index *i* has timestamp ``start + i * step``, so the values
+    of a time range are found without searching. Files are only appended to
+    (or atomically replaced), and protected by ``flock()`` locks, so any
+    number of processes can share the same *directory*.
+
+    :param directory: the directory containing the cache files, created if
+        needed;
+    :param max_bytes:
+        the maximum size of the cache files; the least recently used ones
+        are deleted when it is exceeded;
+    :param settle:
+        the age in seconds after which datapoints are considered final and
+        cached;
+    :param max_gap:
+        the maximum number of missing datapoints filled with None when
+        appending to a file, larger gaps replace the file;
+    :param evict_interval:
+        the minimum number of seconds between two checks of the size of the
+        cache by a process.
+    '''
+
+    def __init__(self, directory, max_bytes=1024 ** 3, settle=60 * 60,
+                 max_gap=1000, evict_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.settle = settle
+        self.max_gap = max_gap
+        self.evict_interval = evict_interval
+        self.evicted_at = 0
+        try:
+            os.makedirs(directory)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def get_targets(self, query):
+        '''
+        Return the list of the series names returned by *query* when it was
+        last stored, or None if it is not cached.
+        '''
+        try:
+            with open(self._path(query, ext='.json')) as fp:
+                return json.load(fp)['targets']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def set_targets(self, query, targets):
+        self._replace(self._path(query, ext='.json'), json.dumps({
+            'query': query,
+            'targets': targets,
+        }).encode('utf-8'))
+
+    def read(self, query, target, from_ts):
+        '''
+        Return a ``(datapoints, last_ts, step)`` tuple with the cached
+        datapoints of the series *target* of *query* from the one at or just
+        before *from_ts*, the timestamp of the last cached datapoint and the
+        interval between datapoints, or None if the cache does not cover
+        *from_ts*.
+        '''
+        path = self._path(query, target)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        with fp:
+            lock(fp, shared=True)
+            try:
+                size = os.fstat(fp.fileno()).st_size
+                if size < HEADER.size:
+                    return None
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    magic, step, start, count = HEADER.unpack_from(mapped)
+                    if magic != MAGIC or not count or start > from_ts:
+                        return None
+                    # Include the datapoint before from_ts, results are
+                    # trimmed relatively to their last datapoint
+                    first = (from_ts - start) // step
+                    values = array('d')
+                    frombytes(values, mapped[HEADER.size + first * VALUE_SIZE:
+                                             HEADER.size + count * VALUE_SIZE])
+                finally:
+                    mapped.close()
+            finally:
+                unlock(fp)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        touch(path)
+        ts = start + first * step
+        datapoints = []
+        for value in values:
+            datapoints.append([None if value != value else value, ts])
+            ts += step
+        return datapoints, start + (count - 1) * step, step
+
+    def append(self, query, target, datapoints, until):
+        '''
+        Store the datapoints of the series *target* of *query* whose
+        timestamps are at most *until* and after the last cached one. If
+        *datapoints* start before the cached ones, they replace them, so the
+        cache covers the longest range queried.
+        '''
+        datapoints = [dp for dp in datapoints if dp[1] <= until]
+        if not datapoints:
+            return
+        path = self._path(query, target)
+        try:
+            fp = open(path, 'r+b')
+        except IOError:
+            self._create(path, datapoints)
+            return
+        with fp:
+            lock(fp, shared=False)
+            try:
+                header = fp.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    self._create(path, datapoints)
+                    return
+                magic, step, start, count = HEADER.unpack(header)
+                if datapoints[0][1] < start:
+                    self._create(path, datapoints)
+                    return
+                end = start + count * step
+                new = [dp for dp in datapoints if dp[1] >= end]
+                if not new:
+                    return
+                if magic != MAGIC or (new[0][1] - end) % step or \
+                        (new[0][1] - end) // step > self.max_gap:
+                    self._create(path, datapoints)
+                    return
+                values = [NAN] * ((new[0][1] - end) // step)
+                ts = new[0][1]
+                for value, dp_ts in new:
+                    if dp_ts != ts:
+                        # Irregular series, give up appending
+                        self._create(path, datapoints)
+                        return
+                    values.append(NAN if value is None else value)
+                    ts += step
+                fp.seek(HEADER.size + count * VALUE_SIZE)
+                fp.write(pack_values(values))
+                fp.flush()
+                # The header is updated last, so readers never see values
+                # that are not completely written
+                fp.seek(0)
+                fp.write(HEADER.pack(MAGIC, step, start,
+                                     count + len(values)))
+                fp.flush()
+            finally:
+                unlock(fp)
+        self._maybe_evict()
+
+    def evict(self):
+        '''
+        Delete the least recently used files until the size of the cache is
+        below 90% of *max_bytes*. Does nothing if another process is already
+        evicting.
+        '''
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_fp:
+            if not lock(lock_fp, shared=False, blocking=False):
+                return
+            try:
+                files = []
+                for name in os.listdir(self.directory):
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(self.directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                total = sum(size for _, size, _ in files)
+                files.sort()
+                for _, size, path in files:
+                    if total <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        continue
+                    total -= size
+            finally:
+                unlock(lock_fp)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if not name.startswith('.'):
+                os.unlink(os.path.join(self.directory, name))
+
+    def _maybe_evict(self):
+        now = time.time()
+        if now - self.evicted_at >= self.evict_interval:
+            self.evicted_at = now
+            self.evict()
+
+    def _create(self, path, datapoints):
+        if len(datapoints) < 2:
+            return
+        start = datapoints[0][1]
+        step = datapoints[1][1] - start
+        if step <= 0:
+            return
+        values = []
+        for i, (value, ts) in enumerate(datapoints):
+            if ts != start + i * step:
+                return
+            values.append(NAN if value is None else value)
+        self._replace(path, HEADER.pack(MAGIC, step, start, len(values)) +
+                      pack_values(values))
+        self._maybe_evict()
+
+    def _replace(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.rename(tmp_path, path)
+
+    def _path(self, query, target='', ext='.dat'):
+        key = (query + '\n' + target).encode('utf-8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + ext)
+
+
+def pack_values(values):
+    return struct.pack('<%dd' % len(values), *values)
+
+
+def frombytes(values, data):
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:  # Python 2
+        values.fromstring(data)
+
+
+def touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def lock(fp, shared, blocking=True):
+    '''
+    Lock the file *fp*, return False if *blocking* is False and it is
+    already locked.
+    '''
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(fp.fileno(), flags)
+    except (IOError, OSError) as exc:
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def unlock(fp):
+    if fcntl is not None:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
@@ -1,8 +1,17 @@
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
 import requests
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3 import Retry
-from .exceptions import BadResponse
+from .deadline import DeadlineTimeout, current_deadline, deadline_scope
+from .exceptions import BadResponse, DeadlineExceeded
+from .instrumentation import current_stats, measure, record_response
+from .resilience import BudgetedRetry
+from .singleflight import SingleFlight, request_key
 
 
 class HttpClient(object):
@@ -17,29 +26,124 @@ class HttpClient(object):
         :meth:`get`);
     :param backoff_factor:
         factor used for exponential delays between retries;
+    :param pool_connections:
+        number of connection pools to cache (one per host);
+    :param pool_maxsize:
+        maximum number of connections kept open per host, it should be at
+        least the number of threads sharing the client;
+    :param coalesce:
+        if True, concurrent identical GET requests are coalesced: only one
+        of them is sent and its response is shared by all callers;
+    :param instrumentation:
+        a sink receiving the performance statistics of each request (see
+        :mod:`robgracli.instrumentation`), or a list of sinks;
+    :param retry_budget:
+        a :class:`robgracli.resilience.RetryBudget` capping the number of
+        retries to a fraction of the requests sent;
+    :param concurrency_limiter:
+        a :class:`robgracli.resilience.ConcurrencyLimiter` adapting the
+        number of concurrent requests to the latency and errors of the
+        server;
+    :param retry_methods:
+        the HTTP methods retried on read errors, defaults to urllib3's
+        idempotent methods (POST is not included);
+    :param deadline:
+        the default maximum duration of requests in seconds, including
+        retries and the delays between them (see :mod:`robgracli.deadline`),
+        or None;
     :param extra_requests_opts:
         additionnal keyworkd arguments passed to each
         :meth:`requests.Session.request` calls.
     '''
 
     def __init__(self, connect_timeout=5, read_timeout=5, max_retries=3,
-                 backoff_factor=1, **extra_requests_opts):
+                 backoff_factor=1, pool_connections=10, pool_maxsize=10,
+                 coalesce=False, instrumentation=None, retry_budget=None,
+                 concurrency_limiter=None, retry_methods=None, deadline=None,
+                 **extra_requests_opts):
         self.timeout = (connect_timeout, read_timeout)
+        self.deadline = deadline
+        self.pool_maxsize = pool_maxsize
+        self.coalesce = coalesce
+        self.flights = SingleFlight()
+        self.instrumentation = instrumentation
+        self.retry_budget = retry_budget
+        self.concurrency_limiter = concurrency_limiter
         self.extra_requests_opts = extra_requests_opts
         self.session = requests.Session()
         self.session.mount('http://',
-                           get_adapter(max_retries, backoff_factor))
+                           get_adapter(max_retries, backoff_factor,
+                                       pool_connections, pool_maxsize,
+                                       retry_budget, retry_methods))
         self.session.mount('https://',
-                           get_adapter(max_retries, backoff_factor))
+                           get_adapter(max_retries, backoff_factor,
+                                       pool_connections, pool_maxsize,
+                                       retry_budget, retry_methods))
 
     def request(self, method, url, data=None, params=None,
-                raise_for_status=True):
-        response = self.session.request(method,
-                                        url,
-                                        data=data,
-                                        params=params,
-                                        timeout=self.timeout,
-                                        **self.extra_requests_opts)
+                raise_for_status=True, stream=False):
+        with measure(self.instrumentation, 'request', url), \
+                self.deadline_scope():
+            return self._request_coalesced(method, url, data, params,
+                                           raise_for_status, stream)
+
+    def deadline_scope(self, deadline=None):
+        '''
+        Return a context manager applying a deadline of *deadline* seconds to
+        the requests made in its block (see
+        :func:`robgracli.deadline.deadline_scope`). If *deadline* is None,
+        the client's default deadline applies, unless the block is already
+        under a deadline.
+        '''
+        if deadline is None and current_deadline() is None:
+            deadline = self.deadline
+        return deadline_scope(deadline)
+
+    def _request_coalesced(self, method, url, data, params, raise_for_status,
+                           stream):
+        if self.coalesce and method.upper() == 'GET' and not stream:
+            return self.flights.do(
+                request_key(method, url, params),
+                lambda: self._request(method, url, data, params,
+                                      raise_for_status, stream),
+                current_deadline())
+        return self._request(method, url, data, params, raise_for_status,
+                             stream)
+
+    def _request(self, method, url, data, params, raise_for_status, stream):
+        stats = current_stats()
+        deadline = current_deadline()
+        limiter = self.concurrency_limiter
+        timeout = self.timeout
+        if deadline is not None:
+            deadline.check()
+            # Shrunk to the remaining time before each attempt
+            timeout = DeadlineTimeout(timeout[0], timeout[1], deadline)
+        if self.retry_budget is not None:
+            self.retry_budget.record_request()
+        if limiter is not None and not limiter.acquire(
+                None if deadline is None else deadline.remaining()):
+            raise DeadlineExceeded(deadline.timeout)
+        start = time.time()
+        try:
+            # Instrumented responses are streamed to time their download
+            # apart
+            response = self.session.request(
+                method, url, data=data, params=params, timeout=timeout,
+                stream=stream or stats is not None,
+                **self.extra_requests_opts)
+        except Exception as exc:
+            if limiter is not None:
+                limiter.release(None, error=True)
+            if isinstance(exc, RequestException) and deadline is not None \
+                    and deadline.remaining() <= 0:
+                raise DeadlineExceeded(deadline.timeout)
+            raise
+        if limiter is not None:
+            limiter.release(time.time() - start,
+                            error=response.status_code >= 500)
+        if stats is not None:
+            record_response(stats, response, time.time() - start, stream)
         if raise_for_status:
             try:
                 response.raise_for_status()
@@ -47,11 +151,79 @@ class HttpClient(object):
                 raise BadResponse(response)
         return response
 
-    def get(self, url, params=None, raise_for_status=True):
+    def get(self, url, params=None, raise_for_status=True, stream=False):
         return self.request('GET', url, data=None, params=params,
+                            raise_for_status=raise_for_status, stream=stream)
+
+    def post(self, url, data=None, params=None, raise_for_status=True):
+        return self.request('POST', url, data=data, params=params,
                             raise_for_status=raise_for_status)
 
+    def map_parallel(self, func, args, max_workers=None):
+        '''
+        Call *func* on each item of *args* in a pool of *max_workers* threads
+        (defaults to *pool_maxsize*, so each thread gets its own pooled
+        connection).
+
+        Return a list of ``(result, exception)`` pairs in the order of
+        *args*, *exception* being None if the call succeeded, and *result*
+        None if it failed.
+        '''
+        args = list(args)
+        if not args:
+            return []
+        if max_workers is None:
+            max_workers = self.pool_maxsize
+        pool = ThreadPool(min(max_workers, len(args)))
+        try:
+            return pool.map(partial(call_catching, func), args)
+        finally:
+            pool.close()
+
+    def imap_ordered(self, func, args, max_workers=None):
+        '''
+        Call *func* on each item of *args* in a pool of *max_workers* threads
+        (defaults to *pool_maxsize*), and yield the results in the order of
+        *args* as they are available. Errors are raised.
+
+        At most *max_workers* calls are running or waiting for their result
+        to be consumed, so slow consumers bound the number of results kept in
+        memory.
+        '''
+        if max_workers is None:
+            max_workers = self.pool_maxsize
+        args = iter(args)
+        pending = deque()
+        pool = ThreadPool(max_workers)
+        try:
+            for arg in islice(args, max_workers):
+                pending.append(pool.apply_async(func, (arg,)))
+            while pending:
+                result = pending.popleft().get()
+                for arg in islice(args, 1):
+                    pending.append(pool.apply_async(func, (arg,)))
+                yield result
+        finally:
+            pool.close()
+
+
+def call_catching(func, arg):
+    try:
+        return func(arg), None
+    except Exception as exc:
+        return None, exc
+
 
-def get_adapter(max_retries, backoff_factor):
-    retry = Retry(max_retries, backoff_factor=backoff_factor)
-    return HTTPAdapter(max_retries=retry)
+def get_adapter(max_retries, backoff_factor, pool_connections=10,
+                pool_maxsize=10, retry_budget=None, retry_methods=None):
+    kwargs = {}
+    if retry_methods is not None:
+        # urllib3 < 1.26 calls allowed_methods method_whitelist
+        if hasattr(BudgetedRetry, 'DEFAULT_ALLOWED_METHODS'):
+            kwargs['allowed_methods'] = frozenset(retry_methods)
+        else:
+            kwargs['method_whitelist'] = frozenset(retry_methods)
+    retry = BudgetedRetry(max_retries, backoff_factor=backoff_factor,
+                          budget=retry_budget, **kwargs)
+    return HTTPAdapter(max_retries=retry, pool_connections=pool_connections,
+                       pool_maxsize=pool_maxsize)
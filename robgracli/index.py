@@ -0,0 +1,234 @@
+'''
+A local index of the metrics namespace, to answer
+:meth:`~robgracli.client.GraphiteClient.find_metrics` without round trips to
+the server.
+'''
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from .client import GLOB_CHARS, glob_to_regex
+from .exceptions import BadResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricIndex(object):
+    '''
+    An in-memory trie of all the metrics of a Graphite server.
+
+    The index is built on first use, by downloading ``/metrics/index.json``
+    if the server supports it, or by crawling the tree level by level with
+    parallel ``/metrics/find`` requests otherwise. Once older than *ttl*
+    seconds, it is rebuilt in a background thread, while the previous
+    version keeps answering queries.
+
+    Attach it to a client to make
+    :meth:`~robgracli.client.GraphiteClient.find_metrics` and
+    :meth:`~robgracli.client.GraphiteClient.expand_metrics` use it::
+
+        client.metric_index = MetricIndex(client)
+
+    :param client: the :class:`~robgracli.client.GraphiteClient` used to
+        fetch metrics;
+    :param ttl: the maximum age of the index, in seconds;
+    :param path:
+        if not None, the index is saved to this file after each build, and
+        loaded from it when still fresh, so it can be shared between
+        processes or survive restarts;
+    :param max_workers: the number of threads used to crawl the tree.
+    '''
+
+    def __init__(self, client, ttl=60 * 60, path=None, max_workers=8):
+        self.client = client
+        self.ttl = ttl
+        self.path = path
+        self.max_workers = max_workers
+        self.root = None
+        self.built_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def find(self, query):
+        '''
+        Return the nodes matching *query*, in the format of
+        :meth:`~robgracli.client.GraphiteClient.find_metrics`.
+        '''
+        ret = []
+        for path, node in self._match(query):
+            name = path[-1]
+            metric_id = '.'.join(path)
+            children, leaf = node
+            if children:
+                ret.append(node_info(name, metric_id, leaf=False))
+            if leaf:
+                ret.append(node_info(name, metric_id, leaf=True))
+        return ret
+
+    def expand(self, pattern):
+        '''
+        Return the sorted list of the metrics matching *pattern*.
+        '''
+        return sorted('.'.join(path) for path, (_, leaf)
+                      in self._match(pattern) if leaf)
+
+    def build(self):
+        '''
+        Build the index from the server, replacing the current one.
+        '''
+        try:
+            metrics = self._download()
+        except BadResponse:
+            metrics = self._crawl()
+        root = {}
+        for metric in metrics:
+            insert(root, metric)
+        self.root = root
+        self.built_at = time.time()
+        if self.path is not None:
+            self._save(metrics)
+
+    def _match(self, pattern):
+        root = self._get_root()
+        matches = [((), [root, False])]
+        for node_pattern in split_nodes(pattern):
+            is_glob = GLOB_CHARS.search(node_pattern) is not None
+            regex = re.compile(glob_to_regex(node_pattern) + '$')
+            next_matches = []
+            for path, (children, _) in matches:
+                if not is_glob:
+                    names = [node_pattern] if node_pattern in children else []
+                else:
+                    names = sorted(name for name in children
+                                   if regex.match(name))
+                for name in names:
+                    next_matches.append((path + (name,), children[name]))
+            matches = next_matches
+        return matches
+
+    def _get_root(self):
+        if self.root is None:
+            with self.lock:
+                if self.root is None and not self._load():
+                    self.build()
+        elif time.time() - self.built_at > self.ttl:
+            self._refresh_in_background()
+        return self.root
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.build()
+            except Exception:
+                logger.exception('error refreshing metric index')
+            finally:
+                self.refreshing = False
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _download(self):
+        response = self.client._call('GET', '/metrics/index.json')
+        return response.json()
+
+    def _crawl(self):
+        metrics = []
+        patterns = ['*']
+        while patterns:
+            results = self.client.map_parallel(
+                lambda query: self.client.find_metrics(query,
+                                                       use_index=False),
+                patterns, self.max_workers)
+            patterns = []
+            for nodes, exc in results:
+                if exc is not None:
+                    raise exc
+                for node in nodes:
+                    if node['leaf']:
+                        metrics.append(node['id'])
+                    else:
+                        patterns.append(node['id'] + '.*')
+        return metrics
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path) as fp:
+            data = json.load(fp)
+        if time.time() - data['built_at'] > self.ttl:
+            return False
+        root = {}
+        for metric in data['metrics']:
+            insert(root, metric)
+        self.root = root
+        self.built_at = data['built_at']
+        return True
+
+    def _save(self, metrics):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'built_at': self.built_at, 'metrics': metrics}, fp)
+        os.rename(tmp_path, self.path)
+
+
+def insert(root, metric):
+    '''
+    Insert *metric* in the trie *root*. Nodes are ``[children, leaf]``
+    lists.
+    '''
+    children = root
+    nodes = metric.split('.')
+    for name in nodes[:-1]:
+        node = children.get(name)
+        if node is None:
+            node = children[name] = [{}, False]
+        children = node[0]
+    node = children.get(nodes[-1])
+    if node is None:
+        children[nodes[-1]] = [{}, True]
+    else:
+        node[1] = True
+
+
+def node_info(name, metric_id, leaf):
+    return {
+        'text': name,
+        'expandable': 0 if leaf else 1,
+        'leaf': 1 if leaf else 0,
+        'id': metric_id,
+        'allowChildren': 0 if leaf else 1,
+    }
+
+
+def split_nodes(pattern):
+    '''
+    Split the Graphite path expression *pattern* on the dots that are not in
+    braces.
+    '''
+    nodes = []
+    current = []
+    depth = 0
+    for char in pattern:
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == '.' and depth == 0:
+            nodes.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    nodes.append(''.join(current))
+    return nodes
@@ -0,0 +1,303 @@
+'''
+Performance instrumentation of :class:`robgracli.http.HttpClient` and
+:class:`robgracli.client.GraphiteClient` calls.
+
+Pass a sink to the clients with the *instrumentation* argument to receive a
+:class:`Stats` object after each call::
+
+    client = GraphiteClient(url, instrumentation=HistogramSink())
+
+A sink is any object with a ``record(stats)`` method, or a list of sinks.
+Instrumentation is disabled by default, and then costs almost nothing.
+'''
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Stats(object):
+    '''
+    Performance statistics of a client call.
+
+    :ivar operation: the name of the call, e.g. ``query`` or ``request``;
+    :ivar target: the query or URL of the call;
+    :ivar duration: the total duration of the call, in seconds;
+    :ivar phases:
+        a dict of the time spent in each phase of the call, in seconds:
+        ``ttfb`` (from sending the request to receiving the response headers,
+        connection included), ``download``, ``decode``, ``trim``,
+        ``aggregate``, ``evaluate`` (see
+        :meth:`~robgracli.client.GraphiteClient.evaluate`) and ``process``
+        (see the *process_pool* argument of
+        :class:`~robgracli.client.GraphiteClient`);
+    :ivar requests: the number of HTTP requests sent;
+    :ivar retries: the number of retries made by urllib3;
+    :ivar bytes: the size of the response bodies;
+    :ivar datapoints: the number of datapoints received;
+    :ivar cache_hit:
+        True if the result was found in the cache, False if not, None if no
+        cache is used;
+    :ivar error: the exception raised by the call, if any.
+    '''
+
+    def __init__(self, operation, target):
+        self.operation = operation
+        self.target = target
+        self.duration = None
+        self.phases = {}
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.datapoints = 0
+        self.cache_hit = None
+        self.error = None
+
+    def add_phase(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def __repr__(self):
+        return ('<Stats %s %r duration=%.3f phases=%r requests=%s retries=%s '
+                'bytes=%s datapoints=%s cache_hit=%s>' % (
+                    self.operation, self.target, self.duration or 0,
+                    self.phases, self.requests, self.retries, self.bytes,
+                    self.datapoints, self.cache_hit))
+
+
+def current_stats():
+    '''
+    Return the :class:`Stats` of the call in progress in the current thread,
+    or None if it is not instrumented.
+    '''
+    return getattr(_local, 'stats', None)
+
+
+def measure(sink, operation, target):
+    '''
+    Return a context manager measuring a call: its :class:`Stats` are
+    available with :func:`current_stats` in the current thread, and passed to
+    *sink* when it's done. Does nothing if *sink* is None or a call is
+    already measured in the current thread.
+    '''
+    if sink is None or current_stats() is not None:
+        return NULL_CONTEXT
+    return Measure(sink, operation, target)
+
+
+def phase(name):
+    '''
+    Return a context manager adding the time spent in its block to the
+    *name* phase of the current call stats, if any.
+    '''
+    stats = current_stats()
+    if stats is None:
+        return NULL_CONTEXT
+    return Phase(stats, name)
+
+
+def bind(func):
+    '''
+    Return a function calling *func* with the current call stats of the
+    calling thread, to measure calls made in other threads.
+    '''
+    stats = current_stats()
+    if stats is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        # Restored on exit, when called in the calling thread
+        previous = current_stats()
+        _local.stats = stats
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stats = previous
+    return wrapper
+
+
+def record_response(stats, response, ttfb, stream):
+    '''
+    Add the timings, size and retries of the :class:`requests.Response`
+    *response* to *stats*. Unless *stream* is True, the body of the response
+    is read to measure its download time.
+    '''
+    stats.requests += 1
+    stats.add_phase('ttfb', ttfb)
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None:
+        stats.retries += len(retries.history)
+    if not stream:
+        with Phase(stats, 'download'):
+            stats.bytes += len(response.content)
+
+
+class NullContext(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+
+class Measure(object):
+
+    def __init__(self, sink, operation, target):
+        self.sink = sink
+        self.stats = Stats(operation, target)
+
+    def __enter__(self):
+        _local.stats = self.stats
+        self.start = time.time()
+        return self.stats
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.duration = time.time() - self.start
+        if exc is not None:
+            self.stats.error = exc
+        _local.stats = None
+        record(self.sink, self.stats)
+        return False
+
+
+class Phase(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.add_phase(self.name, time.time() - self.start)
+        return False
+
+
+def record(sink, stats):
+    sinks = sink if isinstance(sink, (list, tuple)) else [sink]
+    for sink in sinks:
+        try:
+            sink.record(stats)
+        except Exception:
+            logger.exception('error recording stats in %r', sink)
+
+
+class LoggingSink(object):
+    '''
+    Logs the stats of each call.
+    '''
+
+    def __init__(self, logger=logger, level=logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def record(self, stats):
+        self.logger.log(self.level, '%r', stats)
+
+
+class Histogram(object):
+    '''
+    A histogram with logarithmic buckets, for positive values.
+
+    :param growth: the ratio between the bounds of consecutive buckets.
+    '''
+
+    def __init__(self, growth=1.1):
+        self.log_growth = math.log(growth)
+        self.growth = growth
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        bucket = int(math.floor(math.log(value) / self.log_growth)) \
+            if value > 0 else None
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, n):
+        '''
+        Return an approximation of the *n*-th percentile of the values (the
+        upper bound of the bucket containing it), or None if empty.
+        '''
+        if not self.count:
+            return None
+        rank = self.count * n / 100.
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda b: (b is not None, b)):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                if bucket is None:
+                    return 0.
+                return min(self.growth ** (bucket + 1), self.max)
+        return self.max
+
+
+class HistogramSink(object):
+    '''
+    Keeps in-process histograms of the durations of each phase and of the
+    sizes of the responses, by operation, and counters of requests, retries,
+    errors and cache hits.
+
+    Histograms are keyed by ``(operation, metric)`` tuples, *metric* being
+    ``duration``, a phase name, ``bytes`` or ``datapoints``.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+
+    def record(self, stats):
+        op = stats.operation
+        with self.lock:
+            self.histograms[op, 'duration'].add(stats.duration)
+            for name, duration in stats.phases.items():
+                self.histograms[op, name].add(duration)
+            if stats.requests:
+                self.histograms[op, 'bytes'].add(stats.bytes)
+                self.histograms[op, 'datapoints'].add(stats.datapoints)
+            self.counters[op, 'calls'] += 1
+            self.counters[op, 'requests'] += stats.requests
+            self.counters[op, 'retries'] += stats.retries
+            if stats.error is not None:
+                self.counters[op, 'errors'] += 1
+            if stats.cache_hit is not None:
+                self.counters[op, 'cache_hits' if stats.cache_hit
+                              else 'cache_misses'] += 1
+
+    def percentile(self, operation, metric, n):
+        with self.lock:
+            return self.histograms[operation, metric].percentile(n)
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        '''
+        Return a dict summarizing the histograms and counters.
+        '''
+        with self.lock:
+            ret = {}
+            for (op, metric), histogram in self.histograms.items():
+                summary = {
+                    'count': histogram.count,
+                    'mean': histogram.total / histogram.count,
+                    'max': histogram.max,
+                }
+                for n in percentiles:
+                    summary['p%s' % n] = histogram.percentile(n)
+                ret.setdefault(op, {})[metric] = summary
+            for (op, counter), value in self.counters.items():
+                ret.setdefault(op, {})[counter] = value
+            return ret
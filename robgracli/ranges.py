@@ -0,0 +1,95 @@
+'''
+Absolute time ranges, split in chunks fetched in parallel by
+:meth:`robgracli.client.GraphiteClient.query_range` and stitched back
+together.
+'''
+import calendar
+import datetime
+from array import array
+from collections import OrderedDict
+
+from .series import NAN, TIMESTAMP_TYPECODE, Series
+
+
+def to_timestamp(value):
+    '''
+    Convert *value*, a :class:`~datetime.datetime` (naive ones are assumed to
+    be in UTC) or a unix timestamp, to an integer unix timestamp.
+    '''
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return int(value)
+
+
+def split_range(start, end, chunk):
+    '''
+    Split the ``(start, end]`` time range in ``(start, end)`` pairs of at
+    most *chunk* seconds, with bounds aligned on multiples of *chunk* (except
+    *start* and *end*).
+
+    Graphite returns the datapoints after ``from`` and up to ``until``, so
+    the chunks don't overlap as long as *chunk* is a multiple of the steps of
+    the series.
+    '''
+    ranges = []
+    while start < end:
+        chunk_end = min(end, (start // chunk + 1) * chunk)
+        ranges.append((start, chunk_end))
+        start = chunk_end
+    return ranges
+
+
+class Stitcher(object):
+    '''
+    Concatenates the series of consecutive ``/render`` responses, in order.
+
+    Datapoints are appended as responses are added, so only the stitched
+    result is kept in memory. Datapoints that are not after the last one
+    already added for their series (overlapping chunks) are dropped, so
+    timestamps are strictly increasing. With *series*, datapoints are
+    appended to compact arrays and :meth:`result` returns
+    :class:`~robgracli.series.Series` objects.
+    '''
+
+    def __init__(self, series=False):
+        self.series = series
+        self.targets = OrderedDict()
+        self.last_ts = {}
+
+    def add(self, data, start, end):
+        '''
+        Add the series of the decoded ``/render`` response *data*, keeping
+        the datapoints in the ``(start, end]`` time range.
+        '''
+        for entry in data:
+            name = entry['target']
+            last_ts = max(start, self.last_ts.get(name, start))
+            new = [dp for dp in entry['datapoints'] if last_ts < dp[1] <= end]
+            stitched = self.targets.get(name)
+            if stitched is None:
+                if self.series:
+                    stitched = (array('d'), array(TIMESTAMP_TYPECODE),
+                                bytearray())
+                else:
+                    stitched = []
+                self.targets[name] = stitched
+            if not new:
+                continue
+            self.last_ts[name] = new[-1][1]
+            if self.series:
+                values, timestamps, mask = stitched
+                values.extend(NAN if dp[0] is None else dp[0] for dp in new)
+                timestamps.extend(dp[1] for dp in new)
+                mask.extend(dp[0] is not None for dp in new)
+            else:
+                stitched.extend(new)
+
+    def result(self):
+        '''
+        Return an :class:`~collections.OrderedDict` with target names as keys
+        and the stitched datapoints as values.
+        '''
+        if not self.series:
+            return self.targets
+        return OrderedDict((name, Series(*arrays))
+                           for name, arrays in self.targets.items())
@@ -0,0 +1,226 @@
+'''
+Protections against overloading a struggling Graphite server: a retry
+budget, circuit breakers and an adaptive concurrency limit.
+'''
+import threading
+import time
+from collections import deque
+
+from requests.packages.urllib3 import Retry
+from requests.packages.urllib3.exceptions import MaxRetryError
+
+from .deadline import check_delay
+
+
+class RetryBudget(object):
+    '''
+    Caps retries to a fraction of the requests sent, so retries can't
+    multiply the load of an overloaded server.
+
+    :param ratio:
+        the maximum number of retries per request, over the last *window*
+        seconds;
+    :param min_retries:
+        a number of retries always allowed over the last *window* seconds,
+        so clients sending few requests can still retry;
+    :param window: the sliding window, in seconds.
+    '''
+
+    def __init__(self, ratio=0.1, min_retries=10, window=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.requests = deque()
+        self.retries = deque()
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            now = time.time()
+            self.requests.append(now)
+            self._expire(now)
+
+    def withdraw(self):
+        '''
+        Return True and count a retry if the budget allows it, otherwise
+        return False.
+        '''
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if len(self.retries) >= \
+                    self.min_retries + self.ratio * len(self.requests):
+                self.exhausted += 1
+                return False
+            self.retries.append(now)
+            return True
+
+    def _expire(self, now):
+        for timestamps in (self.requests, self.retries):
+            while timestamps and timestamps[0] < now - self.window:
+                timestamps.popleft()
+
+
+class BudgetedRetry(Retry):
+    '''
+    A :class:`urllib3.util.retry.Retry` that gives up when its
+    :class:`RetryBudget` is exhausted, or when the delay before the next
+    attempt would exceed the deadline of the call (see
+    :mod:`robgracli.deadline`).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.budget = kwargs.pop('budget', None)
+        super(BudgetedRetry, self).__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        kwargs['budget'] = self.budget
+        return super(BudgetedRetry, self).new(**kwargs)
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        new_retry = super(BudgetedRetry, self).increment(
+            method, url, response, error, _pool, _stacktrace)
+        if error is not None and self.budget is not None and \
+                not self.budget.withdraw():
+            raise MaxRetryError(_pool, url, error)
+        return new_retry
+
+    def sleep(self, response=None):
+        delay = self.get_backoff_time()
+        if response is not None and self.respect_retry_after_header:
+            delay = self.get_retry_after(response) or delay
+        check_delay(delay)
+        super(BudgetedRetry, self).sleep(response)
+
+    def sleep_for_retry(self, response=None):
+        check_delay(self.get_retry_after(response) or 0)
+        return super(BudgetedRetry, self).sleep_for_retry(response)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    '''
+    Fails fast while an endpoint is unhealthy.
+
+    The circuit opens after *threshold* consecutive failures, and requests
+    are then refused for *timeout* seconds. The circuit is then half-open:
+    a single probe request is allowed, closing the circuit if it succeeds,
+    or opening it again if it fails.
+    '''
+
+    def __init__(self, threshold=5, timeout=30):
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Return True if a request can be sent.
+        '''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == OPEN:
+                if now - self.opened_at < self.timeout:
+                    return False
+                self.state = HALF_OPEN
+            elif self.probe_at is not None and \
+                    now - self.probe_at < self.timeout:
+                # A probe is in flight (probes that never reported are
+                # forgotten after timeout)
+                return False
+            self.probe_at = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probe_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.probe_at = None
+
+
+class ConcurrencyLimiter(object):
+    '''
+    An adaptive limit on the number of concurrent requests, adjusted with
+    additive increase / multiplicative decrease (AIMD).
+
+    The limit grows by about one per *limit* successful requests, and is
+    multiplied by *backoff* after an error or a request slower than
+    *latency_tolerance* times the lowest of the last *latency_window*
+    latencies (the server is then considered congested). It decreases at
+    most once per the lowest latency, so a burst of slow responses to
+    requests sent at the same time only counts once.
+    '''
+
+    def __init__(self, initial=10, min_limit=1, max_limit=100, backoff=0.5,
+                 latency_tolerance=2., latency_window=100):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latencies = deque(maxlen=latency_window)
+        self.in_flight = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        '''
+        Wait until a request can be sent, and count it as in flight. Return
+        False if it could not be sent within *timeout* seconds.
+        '''
+        if timeout is not None:
+            end = time.time() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                if timeout is None:
+                    self.condition.wait()
+                    continue
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, error=False):
+        '''
+        Count a request as completed in *latency* seconds, and adjust the
+        limit.
+        '''
+        with self.condition:
+            self.in_flight -= 1
+            min_latency = min(self.latencies) if self.latencies else None
+            if latency is not None:
+                self.latencies.append(latency)
+            congested = error or (
+                min_latency is not None and
+                latency > self.latency_tolerance * min_latency)
+            now = time.time()
+            if congested:
+                if now - self.decreased_at >= (min_latency or 0):
+                    self.limit = max(self.min_limit,
+                                     self.limit * self.backoff)
+                    self.decreased_at = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1. / self.limit)
+            self.condition.notify_all()
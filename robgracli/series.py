@@ -0,0 +1,124 @@
+'''
+A compact, array-backed alternative to datapoints lists.
+'''
+from array import array
+from bisect import bisect_left
+
+
+NAN = float('nan')
+
+try:
+    array('q')
+    TIMESTAMP_TYPECODE = 'q'
+except ValueError:  # Python 2
+    TIMESTAMP_TYPECODE = 'l'
+
+
+class Series(object):
+    '''
+    A series of datapoints, stored in compact arrays.
+
+    Values are stored in an ``array('d')``, with None values stored as NaN
+    and flagged in a mask, and timestamps in a separate integers array.
+    Timestamps must be sorted.
+
+    Slicing a series returns a view sharing the same arrays, without
+    copying datapoints. Iterating over a series yields ``(value,
+    timestamp)`` pairs, with None for missing values.
+
+    Use :meth:`from_datapoints` to create a series from a datapoints list and
+    :meth:`to_datapoints` for the opposite.
+    '''
+
+    __slots__ = ('values', 'timestamps', 'mask', 'start', 'stop')
+
+    def __init__(self, values, timestamps, mask, start=0, stop=None):
+        self.values = values
+        self.timestamps = timestamps
+        self.mask = mask
+        self.start = start
+        self.stop = len(timestamps) if stop is None else stop
+
+    @classmethod
+    def from_datapoints(cls, datapoints):
+        '''
+        Create a series from a ``[[value, timestamp], ...]`` list.
+        '''
+        values = array('d', [NAN if dp[0] is None else dp[0]
+                             for dp in datapoints])
+        timestamps = array(TIMESTAMP_TYPECODE, [dp[1] for dp in datapoints])
+        mask = bytearray([dp[0] is not None for dp in datapoints])
+        return cls(values, timestamps, mask)
+
+    def to_datapoints(self):
+        '''
+        Return the datapoints as a ``[[value, timestamp], ...]`` list, the
+        format returned by :meth:`robgracli.client.GraphiteClient.query`.
+        '''
+        return [[value, ts] for value, ts in self]
+
+    def valid_values(self):
+        '''
+        Return the list of values, without None values.
+        '''
+        values = self.values
+        mask = self.mask
+        return [values[i] for i in range(self.start, self.stop) if mask[i]]
+
+    def trim(self, max_age):
+        '''
+        Return a view of the datapoints at most *max_age* seconds older than
+        the last one, like :func:`robgracli.client.trim_datapoints`.
+        '''
+        if self.start == self.stop:
+            return self
+        min_ts = self.timestamps[self.stop - 1] - max_age
+        start = bisect_left(self.timestamps, min_ts, self.start, self.stop)
+        return Series(self.values, self.timestamps, self.mask, start,
+                      self.stop)
+
+    @property
+    def nbytes(self):
+        '''
+        The memory used by the arrays of the series, in bytes (shared between
+        views).
+        '''
+        return (len(self.values) * self.values.itemsize +
+                len(self.timestamps) * self.timestamps.itemsize +
+                len(self.mask))
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        values = self.values
+        timestamps = self.timestamps
+        mask = self.mask
+        for i in range(self.start, self.stop):
+            yield (values[i] if mask[i] else None), timestamps[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('slices with steps are not supported')
+            return Series(self.values, self.timestamps, self.mask,
+                          self.start + start, self.start + max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('series index out of range')
+        index += self.start
+        value = self.values[index] if self.mask[index] else None
+        return value, self.timestamps[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, Series):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Series(%r)' % self.to_datapoints()
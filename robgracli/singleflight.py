@@ -0,0 +1,80 @@
+'''
+Coalescing of concurrent identical calls.
+'''
+import threading
+
+from .exceptions import DeadlineExceeded
+
+
+class Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    '''
+    Deduplicates concurrent calls: while a call for a given key is in
+    progress, other callers with the same key wait for it and share its
+    result (or exception) instead of making their own call.
+
+    The ``coalesced`` attribute counts the calls that were deduplicated.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func, deadline=None):
+        '''
+        Return the result of ``func()``, or of the call in progress for
+        *key*. Waiting for a call in progress stops at *deadline* (a
+        :class:`robgracli.deadline.Deadline`), if any. If the call in
+        progress exceeded its own deadline before *deadline*, ``func()`` is
+        called instead of sharing its error.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if deadline is None:
+                call.event.wait()
+            elif not call.event.wait(max(deadline.remaining(), 0)):
+                raise DeadlineExceeded(deadline.timeout)
+            if isinstance(call.exception, DeadlineExceeded) and \
+                    (deadline is None or deadline.remaining() > 0):
+                # The leader ran out of its own time, not of ours
+                return func()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+def request_key(method, url, params):
+    '''
+    Return a hashable key identifying a request.
+    '''
+    if params is None:
+        items = ()
+    elif isinstance(params, dict):
+        items = tuple(sorted(params.items()))
+    else:
+        items = tuple(params)
+    return method.upper(), url, items
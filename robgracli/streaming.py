@@ -0,0 +1,65 @@
+'''
+Incremental decoding of ``/render`` responses.
+'''
+import codecs
+import json
+import re
+
+
+#: Size of the chunks read from streamed responses, in bytes
+CHUNK_SIZE = 64 * 1024
+
+SPECIAL_CHARS = re.compile(r'[\[\]{}"]')
+STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    '''
+    Decode a JSON array of objects read from *chunks*, an iterable of bytes,
+    and yield its items one by one as soon as they are complete.
+
+    Only the current item is kept in memory. Top-level scalar items are
+    ignored.
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)()
+    buf = ''
+    pos = 0
+    start = None
+    depth = 0
+    in_string = False
+    for chunk in chunks:
+        buf += decoder.decode(chunk)
+        while True:
+            if in_string:
+                match = STRING_END.match(buf, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                in_string = False
+                continue
+            match = SPECIAL_CHARS.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                in_string = True
+            elif char in '[{':
+                depth += 1
+                if depth == 2:
+                    start = match.start()
+            else:
+                depth -= 1
+                if depth == 1 and start is not None:
+                    yield json.loads(buf[start:pos])
+                    start = None
+        if start is None:
+            # Drop everything consumed so far, the buffer only ever holds
+            # the item being decoded
+            buf = buf[pos:]
+            pos = 0
+        elif start:
+            buf = buf[start:]
+            pos -= start
+            start = 0
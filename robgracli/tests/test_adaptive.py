@@ -0,0 +1,40 @@
+import pytest
+
+from ..adaptive import (parse_duration, parse_retentions, is_short_response,
+                        RangeLearner)
+from .test_client import (SINGLE_METRIC_DATA, METRIC_WITH_ONLY_NULLS_DATA)
+
+
+def test_parse_duration():
+    assert parse_duration('10s') == 10
+    assert parse_duration('1min') == 60
+    assert parse_duration('7d') == 7 * 86400
+    assert parse_duration('1y') == 365 * 86400
+    assert parse_duration('42') == 42
+    with pytest.raises(ValueError):
+        parse_duration('1fortnight')
+
+
+def test_parse_retentions():
+    assert parse_retentions('10s:1d,1min:7d,10min:1y') == [
+        (10, 86400), (60, 7 * 86400), (600, 365 * 86400)]
+    assert parse_retentions('10:8640') == [(10, 86400)]
+
+
+def test_is_short_response():
+    assert is_short_response([])
+    assert is_short_response(METRIC_WITH_ONLY_NULLS_DATA)
+    assert not is_short_response(SINGLE_METRIC_DATA)
+
+
+def test_range_learner():
+    learner = RangeLearner(prefix_nodes=2, decay_after=2)
+    prefix = learner.prefix('servers.foo.cpu.*')
+    assert prefix == 'servers.foo'
+    assert learner.get(prefix) == 0
+    learner.learn(prefix, 240)
+    learner.learn(prefix, 120)
+    assert learner.get(prefix) == 240
+    learner.success(prefix)
+    learner.success(prefix)
+    assert learner.get(prefix) == 120
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+
+import pytest
+
+from .. import aggregators
+from ..series import Series
+
+
+DATA = OrderedDict([
+    ('foo', [[1., 10], [None, 20], [4., 30], [2., 40], [None, 50]]),
+    ('bar', [[None, 10], [None, 20]]),
+    ('baz', [[3., 10]]),
+    ('qux', []),
+])
+EXPECTED = {
+    'avg': [7. / 3, None, 3., None],
+    'sum': [7., None, 3., None],
+    'min': [1., None, 3., None],
+    'max': [4., None, 3., None],
+    'last': [2., None, 3., None],
+    'count': [3, 0, 1, 0],
+    'stddev': [(14. / 9) ** .5, None, 0., None],
+    'p50': [2., None, 3., None],
+    'p75': [3., None, 3., None],
+    'rate': [1. / 30, None, None, None],
+}
+
+
+def check(results, expected):
+    assert list(results) == list(DATA)
+    for result, value in zip(results.values(), expected):
+        if value is None:
+            assert result is None
+        else:
+            assert result == pytest.approx(value)
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_pure_python(name, monkeypatch):
+    monkeypatch.setattr(aggregators, 'numpy', None)
+    check(aggregators.aggregate(DATA, name), EXPECTED[name])
+    series_data = OrderedDict((k, Series.from_datapoints(v)[:])
+                              for k, v in DATA.items())
+    check(aggregators.aggregate(series_data, name), EXPECTED[name])
+
+
+@pytest.mark.parametrize('name', sorted(EXPECTED))
+def test_vectorized(name):
+    if aggregators.numpy is None:
+        pytest.skip('numpy is not installed')
+    check(aggregators.aggregate(DATA, name), EXPECTED[name])
+    series_data = OrderedDict((k, Series.from_datapoints(v).trim(30))
+                              for k, v in DATA.items())
+    expected = [aggregators.aggregate_series(v, name)
+                for v in series_data.values()]
+    check(aggregators.aggregate(series_data, name), expected)
+
+
+def test_unknown_aggregator():
+    assert not aggregators.is_builtin('median')
+    assert not aggregators.is_builtin(max)
+    assert aggregators.is_builtin('p99.9')
+    with pytest.raises(ValueError):
+        aggregators.aggregate(DATA, 'median')
+    assert aggregators.is_builtin('p100')
+    for func in (aggregators.is_builtin,
+                 lambda name: aggregators.aggregate(DATA, name),
+                 lambda name: aggregators.aggregate_series(
+                     DATA['foo'], name)):
+        with pytest.raises(ValueError):
+            func('p150')
+
+
+def test_summarize_function():
+    assert aggregators.summarize_function(aggregators.average) == 'avg'
+    assert aggregators.summarize_function(max) == 'max'
+    assert aggregators.summarize_function('last') == 'last'
+    assert aggregators.summarize_function('p95') is None
+    assert aggregators.summarize_function(lambda values: 0) is None
+
+
+def test_unwrap_summarized_name():
+    assert aggregators.unwrap_summarized_name(
+        'summarize(a.b, "60s", "avg", true)') == 'a.b'
+    assert aggregators.unwrap_summarized_name(
+        'summarize(sumSeries(a.*), "1min", "sum")') == 'sumSeries(a.*)'
+    assert aggregators.unwrap_summarized_name('a.b') is None
+
+
+def test_top():
+    pairs = [('a', 3.), ('b', None), ('c', 1.), ('d', 5.), ('e', 2.)]
+    top = aggregators.top(iter(pairs), 2)
+    assert list(top.items()) == [('d', 5.), ('a', 3.)]
+    bottom = aggregators.top(iter(pairs), 3, largest=False)
+    assert list(bottom.items()) == [('c', 1.), ('e', 2.), ('a', 3.)]
+    assert aggregators.top(iter(pairs), 0) == {}
+
+
+def test_group_by():
+    pairs = [
+        ('dc1.web1.cpu', 1.),
+        ('dc1.web2.cpu', 3.),
+        ('dc2.web1.cpu', 5.),
+        ('dc2.web2.cpu', None),
+    ]
+    assert list(aggregators.group_by(iter(pairs), 0).items()) == [
+        ('dc1', 2.), ('dc2', 5.)]
+    assert aggregators.group_by(pairs, [1, -1], 'sum') == {
+        'web1.cpu': 6., 'web2.cpu': 3.}
+    assert aggregators.group_by(pairs, 0, 'count') == {'dc1': 2, 'dc2': 1}
+    assert aggregators.group_by(pairs, 0, 'min') == {'dc1': 1., 'dc2': 5.}
+    assert aggregators.group_by(pairs, 0, 'max') == {'dc1': 3., 'dc2': 5.}
+    with pytest.raises(ValueError):
+        aggregators.group_by(pairs, 0, 'median')
@@ -0,0 +1,159 @@
+import json
+import socket
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+import asyncio  # NOQA
+
+from ..aio import (AsyncGraphiteClient, AsyncSingleFlight,  # NOQA
+                   get_backoff_time)
+from ..exceptions import BadResponse, DeadlineExceeded  # NOQA
+from .test_client import SlowContentServer  # NOQA
+from .test_client import (SINGLE_METRIC_DATA, MULTI_METRIC_DATA,  # NOQA
+                          FIND_METRICS_SAMPLE)
+
+
+def run(client, coro_func, *args, **kwargs):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro_func(*args, **kwargs))
+    finally:
+        loop.run_until_complete(client.close())
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def test_query(httpserver):
+    httpserver.serve_content(json.dumps(MULTI_METRIC_DATA))
+    client = AsyncGraphiteClient(httpserver.url)
+    assert run(client, client.query, 'metric') == {
+        'foo': MULTI_METRIC_DATA[0]['datapoints'],
+        'bar': MULTI_METRIC_DATA[1]['datapoints'],
+    }
+
+
+def test_query_many(httpserver):
+    httpserver.serve_content(json.dumps(MULTI_METRIC_DATA))
+    client = AsyncGraphiteClient(httpserver.url)
+    assert run(client, client.query_many, ['foo', 'bar']) == {
+        'foo': {'foo': MULTI_METRIC_DATA[0]['datapoints']},
+        'bar': {'bar': MULTI_METRIC_DATA[1]['datapoints']},
+    }
+
+
+def test_query_many_compressed(httpserver):
+    data = [{'target': 'a.x', 'datapoints': []}]
+    httpserver.serve_content(json.dumps(data))
+    client = AsyncGraphiteClient(httpserver.url, compress_targets=True)
+    assert run(client, client.query_many, ['a.x', 'a.y']) == {
+        'a.x': {'a.x': []},
+        'a.y': {},
+    }
+    assert httpserver.requests[0].args.getlist('target') == ['a.{x,y}']
+    assert 'POST' in client.retry_methods
+
+
+def test_aggregate(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = AsyncGraphiteClient(httpserver.url)
+    assert run(client, client.aggregate, 'metric', aggregator=max) == \
+        {'foo': 3.}
+
+
+def test_concurrent_queries(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = AsyncGraphiteClient(httpserver.url, max_in_flight=4)
+
+    def query_all():
+        loop = asyncio.get_event_loop()
+        return asyncio.gather(*[loop.create_task(client.aggregate('metric'))
+                                for _ in range(20)])
+
+    assert run(client, query_all) == [{'foo': 2.}] * 20
+    assert len(httpserver.requests) == 20
+
+
+def test_server_error(httpserver):
+    httpserver.serve_content('internal error', code=500)
+    client = AsyncGraphiteClient(httpserver.url)
+    with pytest.raises(BadResponse) as exc:
+        run(client, client.query, 'metric')
+    assert 'internal error' in str(exc.value)
+
+
+def test_find_metrics(httpserver):
+    httpserver.serve_content(json.dumps(FIND_METRICS_SAMPLE))
+    client = AsyncGraphiteClient(httpserver.url)
+    assert run(client, client.find_metrics, '*') == FIND_METRICS_SAMPLE
+
+
+def test_backoff_time():
+    assert [get_backoff_time(1, n) for n in range(1, 5)] == [0, 2, 4, 8]
+    assert get_backoff_time(1, 20) == 120
+
+
+def test_coalesce(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = AsyncGraphiteClient(httpserver.url, coalesce=True)
+
+    def query_all():
+        loop = asyncio.get_event_loop()
+        return asyncio.gather(*[loop.create_task(client.aggregate('metric'))
+                                for _ in range(5)])
+
+    assert run(client, query_all) == [{'foo': 2.}] * 5
+    assert len(httpserver.requests) == 1
+    assert client.flights.coalesced == 4
+
+
+def test_coalesce_cancelled_leader():
+    flights = AsyncSingleFlight()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        leader = loop.create_task(
+            flights.do('key', lambda: asyncio.sleep(0.2, 'value')))
+        follower = loop.create_task(
+            flights.do('key', lambda: asyncio.sleep(0.2, 'other')))
+        leader = loop.create_task(asyncio.wait_for(leader, 0.05))
+        loop.run_until_complete(asyncio.wait([leader, follower]))
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+    assert isinstance(leader.exception(), asyncio.TimeoutError)
+    # The follower still got the result of the leader's call
+    assert follower.result() == 'value'
+    assert flights.coalesced == 1
+    assert flights.calls == {}
+
+
+def test_deadline():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    try:
+        client = AsyncGraphiteClient(
+            'http://127.0.0.1:%d/' % sock.getsockname()[1], read_timeout=5)
+        with pytest.raises(DeadlineExceeded):
+            run(client, client.query, 'foo', deadline=0.2)
+    finally:
+        sock.close()
+
+
+def test_longer_deadline():
+    server = SlowContentServer()
+    server.start()
+    try:
+        server.serve_content(json.dumps(SINGLE_METRIC_DATA))
+        server.delay = 0.5
+        client = AsyncGraphiteClient(server.url, deadline=0.2)
+        # The call's deadline overrides the client's default
+        assert run(client, client.aggregate, 'metric', deadline=5) == \
+            {'foo': 2.}
+        with pytest.raises(DeadlineExceeded):
+            run(client, client.aggregate, 'metric')
+    finally:
+        server.stop()
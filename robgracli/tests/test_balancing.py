@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from ..balancing import EndpointPool, hedged_call
+
+
+def test_ranked():
+    pool = EndpointPool(['a', 'b', 'c'])
+    pool.record_success('a', 0.2)
+    pool.record_success('b', 0.1)
+    assert pool.ranked() == ['c', 'b', 'a']
+    pool.record_success('c', 0.3)
+    pool.record_failure('b')
+    assert pool.ranked() == ['a', 'c', 'b']
+
+
+def test_ewma():
+    pool = EndpointPool(['a'], alpha=0.5)
+    pool.record_success('a', 1.)
+    pool.record_success('a', 3.)
+    assert pool.stats[0].latency == 2.
+
+
+def test_cooldown():
+    pool = EndpointPool(['a', 'b'], cooldown=0)
+    pool.record_success('a', 0.1)
+    pool.record_success('b', 0.2)
+    pool.record_failure('a')
+    assert pool.ranked() == ['a', 'b']
+
+
+def test_latency_percentile():
+    pool = EndpointPool(['a'])
+    assert pool.latency_percentile(50) is None
+    for latency in range(11):
+        pool.record_success('a', latency)
+    assert pool.latency_percentile(50) == 5
+
+
+def test_hedged_call():
+    def slow():
+        time.sleep(1)
+        return 'slow'
+
+    def failing():
+        raise ValueError('failed')
+
+    assert hedged_call(lambda: 'fast', slow, 0.01) == 'fast'
+    assert hedged_call(slow, lambda: 'fast', 0.01) == 'fast'
+    assert hedged_call(failing, lambda: 'fast', 1) == 'fast'
+    with pytest.raises(ValueError):
+        hedged_call(failing, failing, 0.01)
+
+
+def test_no_endpoints():
+    with pytest.raises(ValueError):
+        EndpointPool([])
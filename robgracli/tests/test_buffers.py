@@ -0,0 +1,44 @@
+from collections import deque
+
+from ..buffers import QueryBuffer, BufferStore, merge_datapoint
+
+
+def test_merge_datapoint():
+    buf = deque([[1., 10], [None, 20]])
+    merge_datapoint(buf, [2., 20])
+    merge_datapoint(buf, [3., 30])
+    merge_datapoint(buf, [4., 15])
+    # Buffered values are not replaced by None
+    merge_datapoint(buf, [None, 10])
+    assert list(buf) == [[1., 10], [2., 20], [3., 30]]
+
+
+def test_query_buffer():
+    buf = QueryBuffer(max_age=20, max_points=100)
+    buf.replace({'foo': [[1., 10], [2., 20], [None, 30]]})
+    assert buf.last_ts == 30
+    buf.merge({'foo': [[3., 30], [4., 40]], 'bar': [[1., 40]]})
+    assert buf.last_ts == 40
+    assert buf.datapoints() == {
+        'foo': [[2., 20], [3., 30], [4., 40]],
+        'bar': [[1., 40]],
+    }
+    buf.merge({'bar': [[2., 50]]})
+    assert list(buf.datapoints()) == ['bar']
+
+
+def test_query_buffer_max_points():
+    buf = QueryBuffer(max_age=1000, max_points=2)
+    buf.replace({'foo': [[1., 10], [2., 20], [3., 30]]})
+    assert buf.datapoints() == {'foo': [[2., 20], [3., 30]]}
+
+
+def test_buffer_store():
+    store = BufferStore(max_queries=2)
+    store.set('a', 1)
+    store.set('b', 2)
+    store.get('a')
+    store.set('c', 3)
+    assert store.get('b') is None
+    assert store.get('a') == 1
+    assert store.get('c') == 3
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from ..cache import ResultCache, series_step
+
+
+def compute(value, step=None):
+    calls = []
+
+    def func():
+        calls.append(1)
+        return value, step
+
+    func.calls = calls
+    return func
+
+
+def test_hits_and_misses():
+    cache = ResultCache()
+    func = compute({'foo': 1.})
+    assert cache.get_or_compute('a', func) == {'foo': 1.}
+    assert cache.get_or_compute('a', func) == {'foo': 1.}
+    assert len(func.calls) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_expiration():
+    cache = ResultCache(default_ttl=0.01)
+    func = compute({'foo': 1.})
+    cache.get_or_compute('a', func)
+    time.sleep(0.02)
+    cache.get_or_compute('a', func)
+    assert len(func.calls) == 2
+
+
+def test_step_aligned_ttl():
+    cache = ResultCache()
+    cache.get_or_compute('a', compute({}, 10))
+    entry = cache.entries['a']
+    assert entry.expires_at % 10 == 0
+    assert 0 < entry.expires_at - entry.created_at <= 10
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    for key in 'abc':
+        cache.get_or_compute(key, compute({}))
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.evictions == 1
+
+
+def test_max_bytes_eviction():
+    cache = ResultCache(max_bytes=300)
+    cache.get_or_compute('a', compute({'foo': [[1., 1]]}))
+    cache.get_or_compute('b', compute({'foo': [[1., 1]]}))
+    assert list(cache.entries) == ['b']
+    assert cache.size == cache.entries['b'].size
+
+
+def test_refresh_ahead():
+    cache = ResultCache(default_ttl=1, refresh_ahead=0)
+    refreshed = threading.Event()
+    values = iter([{'foo': 1.}, {'foo': 2.}])
+
+    def func():
+        try:
+            return next(values), None
+        finally:
+            if cache.entries:
+                refreshed.set()
+
+    assert cache.get_or_compute('a', func) == {'foo': 1.}
+    assert cache.get_or_compute('a', func) == {'foo': 1.}
+    assert refreshed.wait(1)
+    for _ in range(100):
+        if not cache.refreshing:
+            break
+        time.sleep(0.01)
+    assert cache.get_or_compute('a', func) == {'foo': 2.}
+    assert cache.refreshes >= 1
+
+
+def test_series_step():
+    assert series_step({'foo': [[1., 10], [2., 20]], 'bar': []}) == 10
+    assert series_step({'foo': [[1., 10]]}) is None
@@ -1,9 +1,17 @@
 import json
+import multiprocessing
+import time
+from collections import OrderedDict
 
 import pytest
+from pytest_localserver.http import ContentServer
 
+from .. import client as client_module
+from ..cache import ResultCache
 from ..exceptions import BadResponse
-from ..client import GraphiteClient, trim_datapoints
+from ..client import (GraphiteClient, trim_datapoints, split_series,
+                      target_matches, compress_targets, assign_series)
+from ..http import get_adapter
 
 
 SINGLE_METRIC_DATA = [{
@@ -125,3 +133,430 @@ def test_find_metrics(httpserver):
     httpserver.serve_content(json.dumps(FIND_METRICS_SAMPLE))
     client = GraphiteClient(httpserver.url)
     assert client.find_metrics('*') == FIND_METRICS_SAMPLE
+
+
+def test_query_many(httpserver):
+    httpserver.serve_content(json.dumps(MULTI_METRIC_DATA))
+    client = GraphiteClient(httpserver.url)
+    assert client.query_many(['foo', 'bar', 'baz']) == {
+        'foo': {'foo': MULTI_METRIC_DATA[0]['datapoints']},
+        'bar': {'bar': MULTI_METRIC_DATA[1]['datapoints']},
+        'baz': {},
+    }
+    assert len(httpserver.requests) == 1
+    request = httpserver.requests[0]
+    assert request.method == 'GET'
+    assert request.args.getlist('target') == ['foo', 'bar', 'baz']
+
+
+def test_query_many_functions(httpserver):
+    httpserver.serve_content(json.dumps([
+        {'target': 'scale(b.y,2)', 'datapoints': [[2., 1417629030]]},
+    ]))
+    client = GraphiteClient(httpserver.url)
+    assert client.query_many(['a.x', 'a.y', 'scale(b.y, 2)']) == {
+        'a.x': {},
+        'a.y': {},
+        'scale(b.y, 2)': {'scale(b.y,2)': [[2., 1417629030]]},
+    }
+    # Function targets are sent in their own request
+    assert [r.args.getlist('target') for r in httpserver.requests] == [
+        ['a.x', 'a.y'], ['scale(b.y, 2)']]
+
+
+def test_query_many_post(httpserver):
+    httpserver.serve_content(json.dumps([]))
+    client = GraphiteClient(httpserver.url, max_url_length=50,
+                            max_post_size=60)
+    queries = ['metric.%s' % i for i in range(5)]
+    assert client.query_many(queries) == dict((q, {}) for q in queries)
+    assert all(r.method == 'POST' for r in httpserver.requests)
+    targets = [t for r in httpserver.requests
+               for t in r.form.getlist('target')]
+    assert targets == queries
+    assert len(httpserver.requests) > 1
+
+
+def test_query_many_compressed(httpserver):
+    data = [{'target': name, 'datapoints': [[1., 1417629030]]}
+            for name in ['a.b.x', 'a.b.y', 'c']]
+    httpserver.serve_content(json.dumps(data))
+    client = GraphiteClient(httpserver.url, compress_targets=True)
+    assert client.query_many(['a.b.x', 'c', 'a.b.z']) == {
+        'a.b.x': {'a.b.x': [[1., 1417629030]]},
+        'c': {'c': [[1., 1417629030]]},
+        'a.b.z': {},
+    }
+    request, = httpserver.requests
+    assert request.args.getlist('target') == ['a.b.{x,z}', 'c']
+
+
+def test_compress_targets():
+    assert compress_targets(['a.b.c1', 'x', 'a.b.c2', 'a.d.c1', 'a.d.c2',
+                             'sum(a.b.c3)', 'a.e.c1']) == [
+        ('a.b.{c1,c2}', ['a.b.c1', 'a.b.c2']),
+        ('x', ['x']),
+        ('a.d.{c1,c2}', ['a.d.c1', 'a.d.c2']),
+        ('sum(a.b.c3)', ['sum(a.b.c3)']),
+        ('a.e.c1', ['a.e.c1']),
+    ]
+    # Merged along the first node with siblings
+    assert compress_targets(['s.h1.cpu', 's.h2.cpu', 's.*.mem']) == [
+        ('s.{h1,h2}.cpu', ['s.h1.cpu', 's.h2.cpu']),
+        ('s.*.mem', ['s.*.mem']),
+    ]
+    assert compress_targets(['a.x', 'a.y', 'a.{x,y}']) == [
+        ('a.x', ['a.x']), ('a.y', ['a.y']), ('a.{x,y}', ['a.{x,y}']),
+    ]
+
+
+def test_compress_targets_wildcard():
+    class Index(object):
+        def expand(self, pattern):
+            assert pattern == 'a.*.c'
+            return ['a.x.c', 'a.y.c']
+
+    assert compress_targets(['a.x.c', 'a.y.c'], Index()) == [
+        ('a.*.c', ['a.x.c', 'a.y.c']),
+    ]
+    assert compress_targets(['a.x.c', 'a.z.c'], Index()) == [
+        ('a.{x,z}.c', ['a.x.c', 'a.z.c']),
+    ]
+
+
+def test_assign_series():
+    groups = [('b', ['b']), ('a.*', ['a.x', 'a.y'])]
+    data = [{'target': name, 'datapoints': []}
+            for name in ['b', 'a.x', 'a.new', 'a.y']]
+    assigned = assign_series(groups, data)
+    assert [[e['target'] for e in entries]
+            for entries in assigned.values()] == \
+        [['b'], ['a.x'], ['a.y']]
+    assert list(assigned) == ['b', 'a.x', 'a.y']
+
+
+def test_post_retries():
+    retry = get_adapter(3, 1).max_retries
+    assert not retry.is_retry('POST', 503) and \
+        not retry._is_method_retryable('POST')
+    retry = get_adapter(3, 1, retry_methods=['GET', 'POST']).max_retries
+    assert retry._is_method_retryable('POST')
+    assert GraphiteClient('http://localhost').session.get_adapter(
+        'http://localhost').max_retries._is_method_retryable('POST')
+
+
+def test_split_series():
+    data = [{'target': name, 'datapoints': []}
+            for name in ['a.x', 'a.y', 'b', 'a.x', 'sumSeries(c.*)']]
+    split = split_series(['a.*', 'b', 'a.x', 'c.*'], data)
+    assert [[e['target'] for e in entries] for entries in split.values()] \
+        == [['a.x', 'a.y'], ['b'], ['a.x'], []]
+    split = split_series(['a.{x,y}', 'sumSeries(c.*)'], data)
+    assert [len(entries) for entries in split.values()] == [3, 1]
+    # Never assigned to another query
+    split = split_series(['a.x', 'scale(b.y, 2)'], [
+        {'target': 'a.x', 'datapoints': []},
+        {'target': 'scale(b.y,2)', 'datapoints': []},
+    ])
+    assert [len(entries) for entries in split.values()] == [1, 0]
+    split = split_series(['alias(b.y, "foo")'],
+                         [{'target': 'foo', 'datapoints': []}])
+    assert [len(entries) for entries in split.values()] == [1]
+
+
+def test_target_matches():
+    assert target_matches('a.b', 'a.b')
+    assert target_matches('a.*.c', 'a.foo.c')
+    assert not target_matches('a.*', 'a.b.c')
+    assert target_matches('a.{b,c}.d', 'a.c.d')
+    assert target_matches('a.b[0-9]', 'a.b7')
+    assert not target_matches('a.b?', 'a.b')
+
+
+def test_target_matches_cache(monkeypatch):
+    monkeypatch.setattr(client_module, '_glob_regexes', OrderedDict())
+    monkeypatch.setattr(client_module, 'GLOB_CACHE_SIZE', 2)
+    for pattern in ('a.*', 'b.*', 'a.*', 'c.*'):
+        assert target_matches(pattern, pattern[0] + '.x')
+    # The least recently used pattern was evicted
+    assert list(client_module._glob_regexes) == ['a.*', 'c.*']
+
+
+def test_query_parallel(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, pool_maxsize=4)
+    results = client.query_parallel(['metric%s' % i for i in range(10)])
+    assert results == [({'foo': SINGLE_METRIC_DATA[0]['datapoints']}, None)] \
+        * 10
+    assert sorted(r.args['target'] for r in httpserver.requests) == \
+        sorted('metric%s' % i for i in range(10))
+
+
+def test_aggregate_parallel_errors(httpserver):
+    httpserver.serve_content('internal error', code=500)
+    client = GraphiteClient(httpserver.url)
+    results = client.aggregate_parallel(['foo', 'bar'])
+    assert [r for r, _ in results] == [None, None]
+    assert all(isinstance(e, BadResponse) for _, e in results)
+    assert client.aggregate_parallel([]) == []
+
+
+def test_query_incremental(httpserver):
+    httpserver.serve_content(json.dumps(METRIC_WITH_NULL_DATA))
+    client = GraphiteClient(httpserver.url, incremental=True,
+                            incremental_overlap=10)
+    assert client.query('metric', 20) == {
+        'foo': METRIC_WITH_NULL_DATA[0]['datapoints'],
+    }
+    httpserver.serve_content(json.dumps([{
+        'datapoints': [[5., 1417629040], [6., 1417629050], [7., 1417629060]],
+        'target': 'foo',
+    }]))
+    assert client.aggregate('metric', 20, aggregator=list) == \
+        {'foo': [5., 6., 7.]}
+    assert httpserver.requests[0].args['from'] == '-600s'
+    assert httpserver.requests[1].args['from'] == '1417629040'
+
+
+def test_query_incremental_empty_response(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, incremental=True)
+    client.query('metric')
+    httpserver.serve_content(json.dumps([]))
+    assert client.query('metric') == {}
+    assert [r.args['from'] for r in httpserver.requests] == \
+        ['-600s', '1417628990', '-600s']
+
+
+def test_query_incremental_null_response(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, incremental=True)
+    client.query('metric')
+    # Only null values in the new window, the whole range is fetched again
+    httpserver.serve_content(json.dumps(METRIC_WITH_ONLY_NULLS_DATA))
+    client.query('metric')
+    assert [r.args['from'] for r in httpserver.requests] == \
+        ['-600s', '1417628990', '-600s']
+
+
+def test_cache(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, cache=ResultCache())
+    assert client.query('metric') == client.query('metric')
+    assert client.aggregate('metric') == client.aggregate('metric')
+    assert client.aggregate('metric', aggregator=max) == {'foo': 3.}
+    assert len(httpserver.requests) == 3
+    assert client.cache.hits == 2
+    # Pushed down aggregates are cached separately
+    client.aggregate('metric', aggregator=max, push_down=True)
+    assert httpserver.requests[3].args['target'] == \
+        'summarize(metric, "60s", "max", true)'
+    assert client.cache.hits == 2
+
+
+def test_query_iter(httpserver):
+    httpserver.serve_content(json.dumps(MULTI_METRIC_DATA))
+    client = GraphiteClient(httpserver.url)
+    assert list(client.query_iter('metric', 10)) == [
+        ('foo', MULTI_METRIC_DATA[0]['datapoints'][1:]),
+        ('bar', MULTI_METRIC_DATA[1]['datapoints'][1:]),
+    ]
+
+
+def test_query_series(httpserver):
+    httpserver.serve_content(json.dumps(METRIC_WITH_NULL_DATA))
+    client = GraphiteClient(httpserver.url, series=True)
+    result = client.query('metric', 10)
+    assert result['foo'].to_datapoints() == \
+        METRIC_WITH_NULL_DATA[0]['datapoints'][1:]
+    assert client.aggregate('metric') == {'foo': 1.5}
+
+
+def test_process_pool(httpserver):
+    httpserver.serve_content(json.dumps(METRIC_WITH_NULL_DATA))
+    pool = multiprocessing.Pool(1)
+    try:
+        client = GraphiteClient(httpserver.url, process_pool=pool,
+                                process_threshold=0)
+        assert client.query('metric', 10) == {
+            'foo': METRIC_WITH_NULL_DATA[0]['datapoints'][1:],
+        }
+        assert client.aggregate('metric') == {'foo': 1.5}
+        assert client.aggregate('metric', aggregator='max') == {'foo': 2.}
+        # Not picklable, aggregated in the calling process
+        assert client.aggregate('metric', aggregator=lambda v: len(v)) == \
+            {'foo': 2}
+        client.series = True
+        assert client.query('metric', 10)['foo'].to_datapoints() == \
+            METRIC_WITH_NULL_DATA[0]['datapoints'][1:]
+    finally:
+        pool.terminate()
+
+
+def test_aggregate_builtin(httpserver):
+    httpserver.serve_content(json.dumps(METRIC_WITH_NULL_DATA))
+    client = GraphiteClient(httpserver.url)
+    assert client.aggregate('metric', aggregator='avg') == {'foo': 1.5}
+    assert client.aggregate('metric', aggregator='count') == {'foo': 2}
+
+
+def test_aggregate_top_grouped(httpserver):
+    httpserver.serve_content(json.dumps([
+        {'target': 'dc1.a.cpu', 'datapoints': [[1., 1417629040]]},
+        {'target': 'dc1.b.cpu', 'datapoints': [[4., 1417629040]]},
+        {'target': 'dc2.a.cpu', 'datapoints': [[3., 1417629040]]},
+        {'target': 'dc2.b.cpu', 'datapoints': [[None, 1417629040]]},
+    ]))
+    client = GraphiteClient(httpserver.url)
+    top = client.aggregate_top('*.*.cpu', 2)
+    assert list(top.items()) == [('dc1.b.cpu', 4.), ('dc2.a.cpu', 3.)]
+    assert client.aggregate_top('*.*.cpu', 1, largest=False) == \
+        {'dc1.a.cpu': 1.}
+    grouped = client.aggregate_grouped('*.*.cpu', 0, aggregator='max')
+    assert list(grouped.items()) == [('dc1', 2.5), ('dc2', 3.)]
+    assert client.aggregate_grouped('*.*.cpu', 1, reducer='sum') == \
+        {'a': 4., 'b': 4.}
+
+
+def test_aggregate_push_down(httpserver):
+    httpserver.serve_content(json.dumps([{
+        'datapoints': [[1., 1417629000], [2., 1417629060]],
+        'target': 'summarize(foo.bar, "60s", "max", true)',
+    }]))
+    client = GraphiteClient(httpserver.url, min_queries_range=100)
+    assert client.aggregate('foo.*', aggregator=max, push_down=True) == \
+        {'foo.bar': 2.}
+    request = httpserver.requests[0]
+    assert request.args['target'] == 'summarize(foo.*, "60s", "max", true)'
+    assert request.args['from'] == '-120s'
+
+
+def test_aggregate_push_down_fallback(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url)
+    assert client.aggregate('metric', push_down=True) == {'foo': 2.}
+    assert [r.args['target'] for r in httpserver.requests] == \
+        ['summarize(metric, "60s", "avg", true)', 'metric']
+    assert client.aggregate('metric', aggregator='p50', push_down=True) == \
+        {'foo': 2.}
+    assert len(httpserver.requests) == 3
+
+
+def test_query_raw_format(httpserver):
+    httpserver.serve_content('foo,1417629030,1417629060,10|1.0,None,2.0\n')
+    client = GraphiteClient(httpserver.url, render_format='raw')
+    assert client.query('metric') == {
+        'foo': METRIC_WITH_NULL_DATA[0]['datapoints'],
+    }
+    assert httpserver.requests[0].args['format'] == 'raw'
+
+
+def test_multiple_endpoints_failover(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(['http://127.0.0.1:1', httpserver.url],
+                            max_retries=0)
+    assert client.aggregate('metric') == {'foo': 2.}
+    assert client.endpoint_pool.ranked() == \
+        [httpserver.url, 'http://127.0.0.1:1']
+    assert client.aggregate('metric') == {'foo': 2.}
+    assert len(httpserver.requests) == 2
+
+
+class SlowContentServer(ContentServer):
+    '''
+    A ContentServer replying after *delay* seconds, counting the requests it
+    received before replying in *received*.
+    '''
+
+    delay = 0
+    received = 0
+
+    def __call__(self, environ, start_response):
+        self.received += 1
+        time.sleep(self.delay)
+        return super(SlowContentServer, self).__call__(environ,
+                                                       start_response)
+
+
+@pytest.fixture
+def slow_server():
+    server = SlowContentServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_hedged_requests(httpserver, slow_server):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    slow_server.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient([slow_server.url, httpserver.url],
+                            hedge_percentile=90)
+    # Make the slow server the preferred endpoint
+    for _ in range(10):
+        client.endpoint_pool.record_success(slow_server.url, 0.01)
+    client.endpoint_pool.record_success(httpserver.url, 0.02)
+    slow_server.delay = 2
+    start = time.time()
+    assert client.aggregate('metric') == {'foo': 2.}
+    assert time.time() - start < 1
+    # The request was sent to the slow server first, then hedged
+    assert slow_server.received == 1
+    assert len(slow_server.requests) == 0
+    assert len(httpserver.requests) == 1
+
+
+def test_adaptive_range(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, adaptive_range=True)
+    assert client.query('metric', 20) == {
+        'foo': SINGLE_METRIC_DATA[0]['datapoints'],
+    }
+    httpserver.serve_content(json.dumps(METRIC_WITH_ONLY_NULLS_DATA))
+    assert client.aggregate('metric') == {'foo': None}
+    assert [r.args['from'] for r in httpserver.requests] == \
+        ['-20s', '-60s', '-120s', '-240s', '-480s', '-600s']
+    # The metric is empty, its range is not learned
+    assert client.range_learner.get('metric') == 0
+
+
+def test_adaptive_range_learn(httpserver):
+    client = GraphiteClient(httpserver.url, adaptive_range=True)
+    # Values only show up in the third, wider response
+    responses = iter([METRIC_WITH_ONLY_NULLS_DATA] * 2 + [SINGLE_METRIC_DATA])
+    client._decode = lambda response: next(responses)
+    httpserver.serve_content(json.dumps([]))
+    assert client.aggregate('servers.web1.cpu') == {'foo': 2.}
+    assert [r.args['from'] for r in httpserver.requests] == \
+        ['-60s', '-120s', '-240s']
+    assert client.range_learner.get('servers.web1') == 240
+
+
+def test_adaptive_range_retentions(httpserver):
+    httpserver.serve_content(json.dumps([]))
+    client = GraphiteClient(httpserver.url, adaptive_range=True,
+                            retentions='10s:2min,1min:1d')
+    client.query('metric')
+    assert [r.args['from'] for r in httpserver.requests] == ['-60s', '-120s']
+    # Ranges are not widened beyond min_queries_range
+    client = GraphiteClient(httpserver.url, adaptive_range=True,
+                            retentions='10s:1d,1min:7d')
+    client.query('metric')
+    assert [r.args['from'] for r in httpserver.requests[2:]] == \
+        ['-60s', '-120s', '-240s', '-480s', '-600s']
+
+
+def test_coalesce(httpserver):
+    httpserver.serve_content(json.dumps(SINGLE_METRIC_DATA))
+    client = GraphiteClient(httpserver.url, coalesce=True)
+    original_query = client._query
+
+    def slow_query(query, from_):
+        time.sleep(0.1)
+        return original_query(query, from_)
+
+    client._query = slow_query
+    results = client.query_parallel(['metric'] * 5)
+    assert [r for r, _ in results] == \
+        [{'foo': SINGLE_METRIC_DATA[0]['datapoints']}] * 5
+    assert len(httpserver.requests) == 1
+    assert client.flights.coalesced == 4
@@ -0,0 +1,172 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+from requests.exceptions import ConnectionError
+
+from ..client import GraphiteClient
+from ..deadline import (Deadline, DeadlineTimeout, bind, current_deadline,
+                        deadline_scope)
+from ..exceptions import DeadlineExceeded
+from ..resilience import BudgetedRetry, ConcurrencyLimiter
+from ..singleflight import SingleFlight
+from .test_client import SINGLE_METRIC_DATA, SlowContentServer
+
+
+@pytest.fixture
+def silent_server():
+    '''
+    A server accepting connections (in its backlog) but never responding.
+    '''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    yield 'http://127.0.0.1:%d/' % sock.getsockname()[1]
+    sock.close()
+
+
+def test_deadline_scope():
+    assert current_deadline() is None
+    with deadline_scope(None) as deadline:
+        assert deadline is None
+    with deadline_scope(10) as outer:
+        assert current_deadline() is outer
+        with deadline_scope(20):
+            assert current_deadline() is outer
+        with deadline_scope(1) as inner:
+            assert current_deadline() is inner
+            assert inner.remaining() <= 1
+        assert current_deadline() is outer
+    assert current_deadline() is None
+
+
+def test_bind():
+    results = []
+    with deadline_scope(10) as deadline:
+        func = bind(lambda: results.append(current_deadline()))
+    thread = threading.Thread(target=func)
+    thread.start()
+    thread.join()
+    assert results == [deadline]
+    # Called in the calling thread, the deadline is still current after it
+    with deadline_scope(10) as deadline:
+        bind(current_deadline)()
+        assert current_deadline() is deadline
+
+
+def test_deadline_timeout():
+    timeout = DeadlineTimeout(5, 5, Deadline(1))
+    attempt = timeout.clone()
+    assert attempt.connect_timeout <= 1
+    assert attempt.read_timeout <= 1
+    with pytest.raises(DeadlineExceeded):
+        DeadlineTimeout(5, 5, Deadline(0)).clone()
+
+
+def test_retry_sleep():
+    error = ConnectionError('failed')
+    retry = BudgetedRetry(3, backoff_factor=10)
+    retry = retry.increment('GET', '/', error=error)
+    retry = retry.increment('GET', '/', error=error)
+    assert retry.get_backoff_time() >= 1
+    with deadline_scope(0.5):
+        with pytest.raises(DeadlineExceeded):
+            retry.sleep()
+
+
+def test_limiter_timeout():
+    limiter = ConcurrencyLimiter(initial=1)
+    assert limiter.acquire(0.01)
+    assert not limiter.acquire(0.01)
+    assert limiter.in_flight == 1
+
+
+def test_singleflight_deadline():
+    flights = SingleFlight()
+    started = threading.Event()
+    done = threading.Event()
+
+    def slow():
+        started.set()
+        done.wait(5)
+
+    thread = threading.Thread(target=flights.do, args=('key', slow))
+    thread.start()
+    started.wait(1)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            flights.do('key', slow, Deadline(0.05))
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_singleflight_leader_deadline():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def leader():
+        def call():
+            started.set()
+            release.wait(5)
+            raise DeadlineExceeded(0.1)
+        try:
+            flights.do('key', call, Deadline(0.1))
+        except DeadlineExceeded as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    started.wait(1)
+    result = []
+    follower = threading.Thread(target=lambda: result.append(
+        flights.do('key', lambda: 'value')))
+    follower.start()
+    # Wait for the follower to join the call
+    while not flights.coalesced:
+        time.sleep(0.01)
+    release.set()
+    thread.join()
+    follower.join()
+    assert len(errors) == 1
+    # The follower has no deadline, it made its own call
+    assert result == ['value']
+
+
+def test_client_deadline(silent_server):
+    client = GraphiteClient(silent_server, read_timeout=5, max_retries=3,
+                            backoff_factor=0)
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        client.query('foo', deadline=0.2)
+    assert time.time() - start < 1
+
+
+def test_client_longer_deadline():
+    server = SlowContentServer()
+    server.start()
+    try:
+        server.serve_content(json.dumps(SINGLE_METRIC_DATA))
+        server.delay = 0.5
+        client = GraphiteClient(server.url, deadline=0.2)
+        # The call's deadline overrides the client's default
+        assert client.aggregate('metric', deadline=5) == {'foo': 2.}
+        with client.deadline_scope(5):
+            assert client.aggregate('metric') == {'foo': 2.}
+        with pytest.raises(DeadlineExceeded):
+            client.aggregate('metric')
+    finally:
+        server.stop()
+
+
+def test_client_default_deadline(silent_server):
+    client = GraphiteClient(silent_server, read_timeout=5, deadline=0.2)
+    start = time.time()
+    for func in (client.aggregate, client.find_metrics):
+        with pytest.raises(DeadlineExceeded):
+            func('foo')
+    assert time.time() - start < 2
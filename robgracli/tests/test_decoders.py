@@ -0,0 +1,56 @@
+import json
+import os
+import pickle
+
+import pytest
+
+from .. import decoders
+from .test_client import METRIC_WITH_NULL_DATA
+
+
+def test_json(monkeypatch):
+    content = json.dumps(METRIC_WITH_NULL_DATA).encode('utf-8')
+    assert decoders.decode('json', content) == METRIC_WITH_NULL_DATA
+    monkeypatch.setattr(decoders, 'fast_json', None)
+    assert decoders.decode('json', content) == METRIC_WITH_NULL_DATA
+
+
+def test_pickle():
+    content = pickle.dumps([{
+        'name': 'foo',
+        'start': 1417629030,
+        'end': 1417629060,
+        'step': 10,
+        'values': [1., None, 2.],
+    }], protocol=2)
+    assert decoders.decode('pickle', content) == METRIC_WITH_NULL_DATA
+
+
+class Evil(object):
+
+    def __reduce__(self):
+        return (os.system, ('true',))
+
+
+def test_pickle_refuses_globals():
+    with pytest.raises(pickle.UnpicklingError):
+        decoders.decode('pickle', pickle.dumps([Evil()], protocol=2))
+
+
+def test_raw():
+    content = b'foo,1417629030,1417629060,10|1.0,None,2.0\n'
+    assert decoders.decode('raw', content) == METRIC_WITH_NULL_DATA
+    content = b'sumSeries(a,b),1417629030,1417629040,10|1.0\n'
+    assert decoders.decode('raw', content)[0]['target'] == 'sumSeries(a,b)'
+
+
+def test_csv():
+    content = (b'foo,2014-12-03 17:50:30,1.0\n'
+               b'foo,2014-12-03 17:50:40,\n'
+               b'foo,2014-12-03 17:50:50,2.0\n')
+    assert decoders.decode('csv', content) == METRIC_WITH_NULL_DATA
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        decoders.decode('svg', b'')
@@ -0,0 +1,144 @@
+import json
+
+import pytest
+
+from .. import functions
+from ..client import GraphiteClient
+from ..functions import (Call, Path, TimeSeries, evaluate, leaves, lookback,
+                         moving_averages, parse, parse_duration)
+
+
+def series(name, values, start=0, step=10):
+    return TimeSeries(name, list(range(start, start + len(values) * step,
+                                       step)), values)
+
+
+def run(target, data):
+    return [(s.name, s.values) for s in evaluate(parse(target), data)]
+
+
+def test_parse():
+    node = parse('scale(sumSeries(a.{b,c}.*, d), 0.5)')
+    assert isinstance(node, Call)
+    assert node.name == 'scale'
+    assert node.text == 'scale(sumSeries(a.{b,c}.*, d), 0.5)'
+    inner, factor = node.args
+    assert inner.text == 'sumSeries(a.{b,c}.*, d)'
+    assert [arg.text for arg in inner.args] == ['a.{b,c}.*', 'd']
+    assert factor == 0.5
+    node = parse('movingAverage(a, windowSize="5min")')
+    assert node.kwargs == {'windowSize': '5min'}
+    assert isinstance(parse('a.b'), Path)
+    for target in ('scale(a, 2', 'scale(a 2)', '5', 'a)', 'f("a)'):
+        with pytest.raises(ValueError):
+            parse(target)
+
+
+def test_leaves():
+    node = parse('asPercent(summarize(a.*, "1h"), sumSeries(a.*, b))')
+    assert leaves(node) == ['summarize(a.*, "1h")', 'a.*', 'b']
+    # Calls that don't match the signature of the implementation are left to
+    # Graphite
+    for target in ('scale(a.b)', 'scale(a.b, 2, 3)', 'absolute(a.b, x=1)',
+                   'movingAverage(a.b, 5, xFilesFactor=0.5)'):
+        assert leaves(parse(target)) == [target]
+        assert lookback(parse(target)) == 0
+    assert run('sumSeries(scale(a.b))', {'scale(a.b)': [
+        series('scale(a.b)', [1., 2.])]}) == [
+        ('sumSeries(scale(a.b))', [1., 2.])]
+    assert lookback(parse('movingAverage(scale(a, 2), "5min")')) == 300
+    assert lookback(parse('movingAverage(a, 5)')) == 0
+    assert parse_duration('1h') == 3600
+    assert parse_duration('-2days') == 2 * 24 * 3600
+
+
+def test_combine():
+    data = {
+        'a.*': [series('a.b', [1., None, 3.]), series('a.c', [2., None, 1.])],
+        'd': [series('d', [1., 1.], start=10)],
+    }
+    assert run('sumSeries(a.*)', data) == [
+        ('sumSeries(a.*)', [3., None, 4.])]
+    assert run('avg(a.*, d)', data) == [('avg(a.*,d)', [1.5, 1., 5. / 3])]
+    assert run('minSeries(a.*)', data)[0][1] == [1., None, 1.]
+    assert run('maxSeries(a.*)', data)[0][1] == [2., None, 3.]
+    assert run('diffSeries(a.*, d)', data)[0][1] == [-1., 1., 1.]
+    assert run('multiplySeries(a.*)', data)[0][1] == [2., None, 3.]
+    assert run('sumSeries(x)', data) == []
+
+
+def test_transforms():
+    data = {'a': [series('a', [1., None, -3., 2.])]}
+    assert run('scale(a, 2)', data) == [('scale(a,2)', [2., None, -6., 4.])]
+    assert run('offset(a, 1)', data)[0][1] == [2., None, -2., 3.]
+    assert run('absolute(a)', data)[0][1] == [1., None, 3., 2.]
+    assert run('alias(a, "foo")', data) == [('foo', [1., None, -3., 2.])]
+    assert run('derivative(a)', data)[0][1] == [None, None, None, 5.]
+    assert run('nonNegativeDerivative(a)', data)[0][1] == \
+        [None, None, None, 5.]
+
+
+@pytest.mark.parametrize('vectorized', [False, True])
+def test_moving_average(monkeypatch, vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(functions, 'numpy', None)
+    assert moving_averages([1., 2., None, 4., 6.], 2) == \
+        [1., 1.5, 2., 4., 5.]
+    data = {'a': [series('a', [1., 2., 3., 4.])]}
+    assert run('movingAverage(a, "20s")', data) == [
+        ('movingAverage(a,"20s")', [1., 1.5, 2.5, 3.5])]
+    assert run('movingAverage(a, 3)', data)[0][1] == [1., 1.5, 2., 3.]
+
+
+def test_as_percent():
+    data = {
+        'a.*': [series('a.b', [1., None, 0.]), series('a.c', [3., 1., 0.])],
+        't': [series('t', [10., 10., 10.])],
+    }
+    assert run('asPercent(a.*)', data) == [
+        ('asPercent(a.b,sumSeries(a.*))', [25., None, None]),
+        ('asPercent(a.c,sumSeries(a.*))', [75., 100., None]),
+    ]
+    assert run('asPercent(a.*, t)', data)[1] == \
+        ('asPercent(a.c,t)', [30., 10., 0.])
+    assert run('asPercent(a.*, 4)', data)[0] == \
+        ('asPercent(a.b,4)', [25., None, 0.])
+    with pytest.raises(ValueError):
+        run('asPercent(t, a.*)', data)
+
+
+def test_client_evaluate(httpserver):
+    httpserver.serve_content(json.dumps([
+        {'target': 'a.b', 'datapoints': [[1., 10], [2., 20], [3., 30]]},
+        {'target': 'a.c', 'datapoints': [[3., 10], [4., 20], [5., 30]]},
+    ]))
+    client = GraphiteClient(httpserver.url)
+    result = client.evaluate(['sumSeries(a.*)', 'scale(a.*, 10)'], from_=10)
+    assert result == {
+        'sumSeries(a.*)': {'sumSeries(a.*)': [[6., 20], [8., 30]]},
+        'scale(a.*, 10)': {
+            'scale(a.b,10)': [[20., 20], [30., 30]],
+            'scale(a.c,10)': [[40., 20], [50., 30]],
+        },
+    }
+    # Leaves are fetched once
+    request, = httpserver.requests
+    assert request.args.getlist('target') == ['a.*']
+
+
+def test_client_evaluate_server_side(httpserver):
+    httpserver.serve_content(json.dumps([
+        {'target': 'summarize(a.b, "1h")', 'datapoints': [[6., 30]]},
+    ]))
+    client = GraphiteClient(httpserver.url)
+    result = client.evaluate(['scale(summarize(a.b, "1h"), 2)', 'bad('])
+    assert result == {
+        'scale(summarize(a.b, "1h"), 2)': {
+            'scale(summarize(a.b, "1h"),2)': [[12., 30]],
+        },
+        'bad(': {'summarize(a.b, "1h")': [[6., 30]]},
+    }
+    assert [r.args.getlist('target') for r in httpserver.requests] == [
+        ['summarize(a.b, "1h")'], ['bad(']]
@@ -0,0 +1,149 @@
+import json
+import os
+import time
+
+from ..client import GraphiteClient, match_step, merge_tail
+from ..history import HistoryCache
+
+
+def datapoints(start, count, step=10, nulls=()):
+    return [[None if i in nulls else float(i), start + i * step]
+            for i in range(count)]
+
+
+def test_append_read(tmpdir):
+    cache = HistoryCache(str(tmpdir))
+    assert cache.read('q', 'foo', 0) is None
+    points = datapoints(1000, 10, nulls=(3,))
+    cache.append('q', 'foo', points, until=1050)
+    assert cache.read('q', 'foo', 1000) == (points[:6], 1050, 10)
+    assert cache.read('q', 'foo', 1015) == (points[1:6], 1050, 10)
+    assert cache.read('q', 'foo', 990) is None
+    assert cache.read('q', 'bar', 1000) is None
+    cache.append('q', 'foo', points, until=2000)
+    assert cache.read('q', 'foo', 1000) == (points, 1090, 10)
+
+
+def test_append_older(tmpdir):
+    cache = HistoryCache(str(tmpdir))
+    cache.append('q', 'foo', datapoints(1000, 3), until=2000)
+    # Datapoints starting before the cached ones replace them
+    cache.append('q', 'foo', datapoints(950, 6), until=2000)
+    assert cache.read('q', 'foo', 950) == (datapoints(950, 6), 1000, 10)
+
+
+def test_append_gap(tmpdir):
+    cache = HistoryCache(str(tmpdir), max_gap=5)
+    cache.append('q', 'foo', datapoints(1000, 3), until=2000)
+    cache.append('q', 'foo', datapoints(1050, 2), until=2000)
+    values = [v for v, _ in cache.read('q', 'foo', 1000)[0]]
+    assert values == [0., 1., 2., None, None, 0., 1.]
+    # Larger gaps replace the file
+    cache.append('q', 'foo', datapoints(2000, 2), until=3000)
+    assert cache.read('q', 'foo', 1000) is None
+    assert cache.read('q', 'foo', 2000) == (datapoints(2000, 2), 2010, 10)
+
+
+def test_irregular_series(tmpdir):
+    cache = HistoryCache(str(tmpdir))
+    cache.append('q', 'foo', [[1., 1000], [2., 1010], [3., 1030]], 2000)
+    assert cache.read('q', 'foo', 1000) is None
+
+
+def test_shared_directory(tmpdir):
+    cache = HistoryCache(str(tmpdir))
+    other = HistoryCache(str(tmpdir))
+    cache.set_targets('q', ['foo'])
+    cache.append('q', 'foo', datapoints(1000, 3), until=2000)
+    assert other.get_targets('q') == ['foo']
+    assert other.read('q', 'foo', 1000) == (datapoints(1000, 3), 1020, 10)
+
+
+def test_evict(tmpdir):
+    cache = HistoryCache(str(tmpdir), max_bytes=200)
+    for i, name in enumerate(['a', 'b', 'c']):
+        cache.append('q', name, datapoints(1000, 10), until=2000)
+        path = cache._path('q', name)
+        os.utime(path, (1000 + i, 1000 + i))
+    cache.evict()
+    assert cache.read('q', 'a', 1000) is None
+    assert cache.read('q', 'b', 1000) is None
+    assert cache.read('q', 'c', 1000) is not None
+
+
+def test_merge_tail():
+    assert merge_tail(datapoints(0, 5), []) == datapoints(0, 5)
+    assert merge_tail(datapoints(0, 5), [[9., 30]]) == \
+        datapoints(0, 3) + [[9., 30]]
+
+
+def test_client(tmpdir, httpserver):
+    step = 60
+    now = int(time.time()) // step * step
+    points = datapoints(now - 2 * 3600, 2 * 60 + 1, step)
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': points}]))
+    cache = HistoryCache(str(tmpdir), settle=600)
+    client = GraphiteClient(httpserver.url, history_cache=cache)
+    expected = {'foo': points[-61:]}
+    assert client.query('foo', 3600) == expected
+    assert client.query('foo', 600) == {'foo': points[-11:]}
+    assert len(httpserver.requests) == 2
+
+    tail = [[v + 100, ts] for v, ts in points[-20:]]
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': tail}]))
+    assert client.query('foo', 3600) == {'foo': points[-61:-20] + tail}
+    tail_from = int(httpserver.requests[-1].args['from'])
+    assert now - 660 <= tail_from <= now - 600
+
+
+def test_match_step():
+    points = datapoints(1000, 3, step=60)
+    assert match_step(points, 60) is points
+    fine = [[float(i), 1010 + i * 10] for i in range(12)]
+    fine[7][0] = None
+    # The first bucket (960) is not fully covered
+    assert match_step(fine, 60) == [[3.5, 1020], [9.5, 1080]]
+    assert match_step(points, 10) is None
+    assert match_step(datapoints(1000, 3, step=25), 60) is None
+
+
+def test_client_resolution_by_age(tmpdir, httpserver):
+    # Graphite serves old datapoints from a 1min archive, and recent ones
+    # from a 10s archive
+    now = int(time.time()) // 60 * 60
+    coarse = datapoints(now - 3 * 3600, 3 * 60 + 1, 60)
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': coarse}]))
+    cache = HistoryCache(str(tmpdir), settle=600)
+    client = GraphiteClient(httpserver.url, history_cache=cache)
+    client.query('foo', 2 * 3600)
+    fine = [[1., ts] for ts in range(now - 590, now + 1, 10)]
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': fine}]))
+    result = client.query('foo', 2 * 3600)['foo']
+    assert len(httpserver.requests) == 2
+    assert set(b[1] - a[1] for a, b in zip(result, result[1:])) == {60}
+    assert result[-10:] == [[1., ts] for ts in range(now - 540, now + 1, 60)]
+    # The cache still accepts appends at its step
+    assert cache.read('foo', 'foo', now - 3600)[2] == 60
+
+
+def test_client_longer_query(tmpdir, httpserver):
+    step = 60
+    now = int(time.time()) // step * step
+    points = datapoints(now - 24 * 3600, 24 * 60 + 1, step)
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': points[-121:]}]))
+    cache = HistoryCache(str(tmpdir), settle=600)
+    client = GraphiteClient(httpserver.url, history_cache=cache)
+    client.query('foo', 7200)
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': points}]))
+    expected = client.query('foo', 86400)
+    # The cache now covers the longer range, only the tail is fetched
+    assert client.query('foo', 86400) == expected
+    assert [r.args['from'] for r in httpserver.requests[:2]] == \
+        ['-7200s', '-86400s']
+    assert int(httpserver.requests[2].args['from']) >= now - 660
@@ -0,0 +1,99 @@
+import json
+
+from ..client import GraphiteClient
+from ..exceptions import BadResponse
+from ..http import HttpClient
+from ..index import MetricIndex, insert, split_nodes
+
+
+METRICS = [
+    'carbon.agents.a.cpu',
+    'carbon.agents.b.cpu',
+    'servers.web1.disk.sda.used',
+    'servers.web1.disk.sdb.used',
+    'servers.web2.disk.sda.used',
+    'servers.web2.load',
+]
+
+
+class FakeResponse(object):
+    status_code = 404
+    text = 'not found'
+
+
+class CrawledClient(HttpClient):
+    '''
+    A client without ``/metrics/index.json``, answering ``/metrics/find``
+    from :data:`METRICS`.
+    '''
+
+    def __init__(self):
+        super(CrawledClient, self).__init__()
+        self.find_queries = []
+        self.index = MetricIndex(None)
+        self.index.root = {}
+        self.index.built_at = float('inf')
+        for metric in METRICS:
+            insert(self.index.root, metric)
+
+    def _call(self, method, path, params=None, data=None, stream=False):
+        raise BadResponse(FakeResponse())
+
+    def find_metrics(self, query, use_index=True):
+        self.find_queries.append(query)
+        return self.index.find(query)
+
+
+def test_index_json(httpserver):
+    httpserver.serve_content(json.dumps(METRICS))
+    client = GraphiteClient(httpserver.url)
+    client.metric_index = MetricIndex(client)
+    assert client.find_metrics('*') == [
+        {'text': 'carbon', 'expandable': 1, 'leaf': 0, 'id': 'carbon',
+         'allowChildren': 1},
+        {'text': 'servers', 'expandable': 1, 'leaf': 0, 'id': 'servers',
+         'allowChildren': 1},
+    ]
+    assert [n['id'] for n in client.find_metrics('servers.web2.*')] == \
+        ['servers.web2.disk', 'servers.web2.load']
+    assert client.find_metrics('servers.web2.load')[0]['leaf'] == 1
+    assert client.expand_metrics('servers.*.disk.{sda,sdb}.used') == \
+        METRICS[2:5]
+    assert client.find_metrics('nothing.*') == []
+    assert len(httpserver.requests) == 1
+    assert httpserver.requests[0].path == '/metrics/index.json'
+
+
+def test_crawl():
+    client = CrawledClient()
+    index = MetricIndex(client, max_workers=2)
+    assert index.expand('*.*.*.cpu') == METRICS[:2]
+    assert sorted(client.find_queries) == sorted([
+        '*', 'carbon.*', 'servers.*', 'carbon.agents.*', 'servers.web1.*',
+        'servers.web2.*', 'carbon.agents.a.*', 'carbon.agents.b.*',
+        'servers.web1.disk.*', 'servers.web2.disk.*',
+        'servers.web1.disk.sda.*', 'servers.web1.disk.sdb.*',
+        'servers.web2.disk.sda.*',
+    ])
+
+
+def test_persistence(httpserver, tmpdir):
+    httpserver.serve_content(json.dumps(METRICS))
+    path = str(tmpdir.join('index.json'))
+    client = GraphiteClient(httpserver.url)
+    MetricIndex(client, path=path).build()
+    index = MetricIndex(client, path=path)
+    assert index.expand('servers.web2.load') == ['servers.web2.load']
+    assert len(httpserver.requests) == 1
+
+
+def test_split_nodes():
+    assert split_nodes('a.{b,c}.d') == ['a', '{b,c}', 'd']
+    assert split_nodes('*') == ['*']
+
+
+def test_expand_metrics_without_index(httpserver):
+    httpserver.serve_content(json.dumps({'results': ['b', 'a']}))
+    client = GraphiteClient(httpserver.url)
+    assert client.expand_metrics('*') == ['a', 'b']
+    assert httpserver.requests[0].args['leavesOnly'] == '1'
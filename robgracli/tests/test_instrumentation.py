@@ -0,0 +1,166 @@
+import json
+import logging
+
+import pytest
+
+from ..cache import ResultCache
+from ..client import GraphiteClient
+from ..exceptions import BadResponse
+from ..http import HttpClient
+from ..instrumentation import (Histogram, HistogramSink, LoggingSink, bind,
+                               current_stats, measure, phase)
+
+
+DATA = [{
+    'datapoints': [
+        [1., 1417629030],
+        [2., 1417629040],
+        [3., 1417629050],
+    ],
+    'target': 'foo'
+}]
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.stats = []
+
+    def record(self, stats):
+        self.stats.append(stats)
+
+
+def test_query_stats(httpserver):
+    content = json.dumps(DATA)
+    httpserver.serve_content(content)
+    sink = ListSink()
+    client = GraphiteClient(httpserver.url, instrumentation=sink)
+    client.query('metric')
+    stats, = sink.stats
+    assert stats.operation == 'query'
+    assert stats.target == 'metric'
+    assert stats.requests == 1
+    assert stats.retries == 0
+    assert stats.bytes == len(content)
+    assert stats.datapoints == 3
+    assert stats.cache_hit is None
+    assert stats.error is None
+    assert set(stats.phases) == set(['ttfb', 'download', 'decode', 'trim'])
+    assert stats.duration >= sum(stats.phases.values())
+    assert current_stats() is None
+
+
+def test_aggregate_stats(httpserver):
+    httpserver.serve_content(json.dumps(DATA))
+    sink = ListSink()
+    client = GraphiteClient(httpserver.url, instrumentation=sink,
+                            cache=ResultCache())
+    client.aggregate('metric')
+    client.aggregate('metric')
+    miss, hit = sink.stats
+    assert miss.operation == 'aggregate'
+    assert miss.cache_hit is False
+    assert 'aggregate' in miss.phases
+    assert hit.cache_hit is True
+    assert hit.requests == 0
+    assert hit.phases == {}
+
+
+def test_error_stats(httpserver):
+    httpserver.serve_content('error', code=400)
+    sink = ListSink()
+    client = GraphiteClient(httpserver.url, instrumentation=sink)
+    with pytest.raises(BadResponse):
+        client.find_metrics('*')
+    stats, = sink.stats
+    assert stats.operation == 'find_metrics'
+    assert isinstance(stats.error, BadResponse)
+
+
+def test_http_client_stats(httpserver):
+    httpserver.serve_content('hello')
+    sink = ListSink()
+    client = HttpClient(instrumentation=sink)
+    assert client.get(httpserver.url).text == 'hello'
+    stats, = sink.stats
+    assert stats.operation == 'request'
+    assert stats.bytes == 5
+
+
+def test_multiple_sinks(httpserver):
+    httpserver.serve_content(json.dumps(DATA))
+    sinks = [ListSink(), ListSink()]
+    client = GraphiteClient(httpserver.url, instrumentation=sinks)
+    client.query('metric')
+    assert len(sinks[0].stats) == len(sinks[1].stats) == 1
+
+
+def test_sink_errors_are_ignored(httpserver):
+    httpserver.serve_content(json.dumps(DATA))
+
+    class BrokenSink(object):
+        def record(self, stats):
+            raise ValueError()
+
+    client = GraphiteClient(httpserver.url, instrumentation=BrokenSink())
+    assert client.query('metric') == {'foo': DATA[0]['datapoints']}
+
+
+def test_disabled():
+    with measure(None, 'query', 'metric') as stats:
+        assert stats is None
+        with phase('decode'):
+            assert current_stats() is None
+
+
+def test_nested_measures():
+    sink = ListSink()
+    with measure(sink, 'query', 'metric') as stats:
+        with measure(sink, 'request', 'url') as inner:
+            assert inner is None
+            assert current_stats() is stats
+    assert len(sink.stats) == 1
+
+
+def test_bind():
+    with measure(ListSink(), 'query', 'metric') as stats:
+        func = bind(current_stats)
+        # Called in the calling thread, the call stats are still current
+        # after it
+        assert func() is stats
+        assert current_stats() is stats
+
+
+def test_logging_sink(caplog):
+    sink = ListSink()
+    with caplog.at_level(logging.INFO):
+        with measure([sink, LoggingSink(level=logging.INFO)], 'query', 'foo'):
+            pass
+    assert '<Stats query' in caplog.text
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for i in range(1, 101):
+        histogram.add(i / 100.)
+    assert histogram.count == 100
+    assert histogram.max == 1.
+    assert 0.5 <= histogram.percentile(50) <= 0.55
+    assert histogram.percentile(100) == 1.
+    histogram.add(0)
+    assert histogram.percentile(0) == 0.
+
+
+def test_histogram_sink(httpserver):
+    httpserver.serve_content(json.dumps(DATA))
+    sink = HistogramSink()
+    client = GraphiteClient(httpserver.url, instrumentation=sink)
+    for _ in range(3):
+        client.query('metric')
+    snapshot = sink.snapshot()
+    assert snapshot['query']['calls'] == 3
+    assert snapshot['query']['requests'] == 3
+    assert snapshot['query']['duration']['count'] == 3
+    assert snapshot['query']['datapoints']['max'] == 3
+    assert sink.percentile('query', 'decode', 99) is not None
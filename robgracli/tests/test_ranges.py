@@ -0,0 +1,77 @@
+import datetime
+import json
+
+from ..client import GraphiteClient
+from ..deadline import current_deadline
+from ..ranges import Stitcher, split_range, to_timestamp
+from ..series import Series
+
+
+def test_to_timestamp():
+    assert to_timestamp(datetime.datetime(1970, 1, 1, 1)) == 3600
+    assert to_timestamp(3600.5) == 3600
+
+
+def test_split_range():
+    assert split_range(1000, 1000, 100) == []
+    assert split_range(1050, 1250, 100) == [(1050, 1100), (1100, 1200),
+                                            (1200, 1250)]
+    assert split_range(1000, 1100, 100) == [(1000, 1100)]
+
+
+def test_stitcher():
+    stitcher = Stitcher()
+    stitcher.add([{'target': 'foo', 'datapoints': [[1., 10], [2., 20]]},
+                  {'target': 'bar', 'datapoints': []}], 0, 20)
+    # Overlapping and out of range datapoints are dropped
+    stitcher.add([{'target': 'foo', 'datapoints': [[2., 20], [3., 30],
+                                                   [4., 50]]}], 20, 40)
+    assert stitcher.result() == {'foo': [[1., 10], [2., 20], [3., 30]],
+                                 'bar': []}
+    assert list(stitcher.result()) == ['foo', 'bar']
+
+
+def test_stitcher_series():
+    stitcher = Stitcher(series=True)
+    stitcher.add([{'target': 'foo', 'datapoints': [[1., 10], [None, 20]]}],
+                 0, 20)
+    stitcher.add([{'target': 'foo', 'datapoints': [[3., 30]]}], 20, 40)
+    foo = stitcher.result()['foo']
+    assert isinstance(foo, Series)
+    assert foo.to_datapoints() == [[1., 10], [None, 20], [3., 30]]
+
+
+def test_query_range(httpserver):
+    datapoints = [[float(i), 1000 + i * 60] for i in range(100)]
+    httpserver.serve_content(json.dumps([{'target': 'foo',
+                                          'datapoints': datapoints}]))
+    client = GraphiteClient(httpserver.url)
+    assert client.query_range('foo', 1000, 1000 + 99 * 60, chunk=1800,
+                              max_workers=2) == {'foo': datapoints[1:]}
+    ranges = sorted((int(r.args['from']), int(r.args['until']))
+                    for r in httpserver.requests)
+    assert ranges == [(1000, 1800), (1800, 3600), (3600, 5400),
+                      (5400, 6940)]
+    with client.deadline_scope(5) as deadline:
+        assert client.query_range('foo', 999, 1060) == \
+            {'foo': datapoints[:2]}
+        # Single chunks are fetched in the calling thread
+        assert current_deadline() is deadline
+    assert len(httpserver.requests) == 5
+
+
+def test_query_range_resolution_by_age():
+    # Graphite serves chunks starting more than an hour ago from a 1min
+    # archive, and more recent ones from a 10s archive
+    def fetch_range(query, range_):
+        start, end = range_
+        step = 60 if start < 7200 else 10
+        return [{'target': 'foo', 'datapoints': [
+            [float(ts // 10), ts]
+            for ts in range(start - start % step + step, end + 1, step)]}]
+
+    client = GraphiteClient('http://localhost')
+    client._fetch_range = fetch_range
+    result = client.query_range('foo', 3600, 10800, chunk=3600)['foo']
+    assert [dp[1] for dp in result] == list(range(3660, 10801, 60))
+    assert result[-2] == [1076.5, 10740]
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+from requests.exceptions import ConnectionError
+from requests.packages.urllib3.exceptions import MaxRetryError
+
+from ..client import GraphiteClient
+from ..exceptions import BadResponse, CircuitOpen
+from ..http import HttpClient
+from ..resilience import (BudgetedRetry, CircuitBreaker, ConcurrencyLimiter,
+                          RetryBudget, CLOSED, HALF_OPEN, OPEN)
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, min_retries=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    for _ in range(4):
+        budget.record_request()
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    assert budget.exhausted == 2
+
+
+def test_retry_budget_window():
+    budget = RetryBudget(ratio=0, min_retries=1, window=0.01)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    time.sleep(0.02)
+    assert budget.withdraw()
+
+
+def test_budgeted_retry():
+    budget = RetryBudget(ratio=0, min_retries=1)
+    retry = BudgetedRetry(3, budget=budget)
+    error = ConnectionError('failed')
+    retry = retry.increment('GET', '/', error=error)
+    assert retry.budget is budget
+    with pytest.raises(MaxRetryError):
+        retry.increment('GET', '/', error=error)
+
+
+def test_client_retry_budget():
+    budget = RetryBudget(ratio=0, min_retries=0)
+    client = HttpClient(max_retries=3, backoff_factor=0, retry_budget=budget)
+    with pytest.raises(ConnectionError):
+        client.get('http://127.0.0.1:1/')
+    assert budget.exhausted == 1
+    assert len(budget.requests) == 1
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=2, timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_lost_probe():
+    breaker = CircuitBreaker(threshold=1, timeout=60)
+    breaker.record_failure()
+    breaker.opened_at -= 60
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.probe_at -= 60
+    assert breaker.allow()
+
+
+def test_client_circuit_breaker(httpserver):
+    httpserver.serve_content('error', code=500)
+    client = GraphiteClient(httpserver.url, breaker_threshold=2,
+                            breaker_timeout=60)
+    for _ in range(2):
+        with pytest.raises(BadResponse):
+            client.query('foo')
+    with pytest.raises(CircuitOpen):
+        client.query('foo')
+    assert len(httpserver.requests) == 2
+
+
+def test_client_circuit_breaker_failover(httpserver):
+    httpserver.serve_content('[]')
+    client = GraphiteClient(['http://127.0.0.1:1/', httpserver.url],
+                            max_retries=0, breaker_threshold=1,
+                            breaker_timeout=60)
+    client.endpoint_pool.record_success(httpserver.url, 1)
+    client.endpoint_pool.record_failure('http://127.0.0.1:1/')
+    assert client.query('foo') == {}
+    assert client.query('foo') == {}
+    assert len(httpserver.requests) == 2
+
+
+def test_concurrency_limiter_aimd():
+    limiter = ConcurrencyLimiter(initial=4, min_limit=1, max_limit=5)
+    limiter.acquire()
+    limiter.release(0.1)
+    assert limiter.limit == 4.25
+    limiter.acquire()
+    limiter.release(None, error=True)
+    assert limiter.limit == 2.125
+    limiter.acquire()
+    limiter.release(1, error=False)
+    assert limiter.limit == 2.125
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit == 5
+
+
+def test_concurrency_limiter_blocks():
+    limiter = ConcurrencyLimiter(initial=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.05)
+    limiter.release(0.01)
+    assert acquired.wait(1)
+    thread.join()
+    assert limiter.in_flight == 1
+
+
+def test_client_concurrency_limiter(httpserver):
+    httpserver.serve_content('error', code=503)
+    limiter = ConcurrencyLimiter(initial=8)
+    client = HttpClient(concurrency_limiter=limiter)
+    with pytest.raises(BadResponse):
+        client.get(httpserver.url)
+    assert limiter.limit == 4
+    assert limiter.in_flight == 0
@@ -0,0 +1,38 @@
+import pytest
+
+from ..client import trim_datapoints
+from ..series import Series
+from .test_client import METRIC_WITH_NULL_DATA, SINGLE_METRIC_DATA
+
+
+def test_roundtrip():
+    dp = METRIC_WITH_NULL_DATA[0]['datapoints']
+    series = Series.from_datapoints(dp)
+    assert series.to_datapoints() == dp
+    assert len(series) == 3
+    assert series[1] == (None, 1417629040)
+    assert series[-1] == (2., 1417629050)
+    assert series.valid_values() == [1., 2.]
+    with pytest.raises(IndexError):
+        series[3]
+
+
+def test_trim():
+    dp = SINGLE_METRIC_DATA[0]['datapoints']
+    series = Series.from_datapoints(dp)
+    for max_age in (100, 20, 19, 10, 0):
+        assert series.trim(max_age).to_datapoints() == \
+            trim_datapoints(dp, max_age)
+    assert Series.from_datapoints([]).trim(10).to_datapoints() == []
+
+
+def test_slicing_shares_arrays():
+    series = Series.from_datapoints(METRIC_WITH_NULL_DATA[0]['datapoints'])
+    view = series[1:]
+    assert view.values is series.values
+    assert view.to_datapoints() == \
+        METRIC_WITH_NULL_DATA[0]['datapoints'][1:]
+    assert view[:1].to_datapoints() == [[None, 1417629040]]
+    assert view.valid_values() == [2.]
+    assert len(series[5:]) == 0
+    assert series == Series.from_datapoints(series.to_datapoints())
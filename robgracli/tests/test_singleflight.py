@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from ..singleflight import SingleFlight, request_key
+
+
+def test_concurrent_calls_are_coalesced():
+    flights = SingleFlight()
+    calls = []
+
+    def func():
+        calls.append(1)
+        time.sleep(0.1)
+        return len(calls)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        flights.do('key', func))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1] * 5
+    assert len(calls) == 1
+    assert flights.coalesced == 4
+    assert flights.do('key', func) == 2
+
+
+def test_exceptions_are_shared():
+    flights = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def func():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('failed')
+
+    def follower():
+        started.wait()
+        try:
+            flights.do('key', func)
+        except ValueError as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=follower)
+    thread.start()
+    with pytest.raises(ValueError):
+        flights.do('key', func)
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_request_key():
+    assert request_key('get', 'url', {'b': 1, 'a': 2}) == \
+        ('GET', 'url', (('a', 2), ('b', 1)))
+    assert request_key('GET', 'url', [('a', 1)]) == ('GET', 'url', (('a', 1),))
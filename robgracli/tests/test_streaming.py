@@ -0,0 +1,25 @@
+import json
+
+from ..streaming import iter_json_array
+from .test_client import MULTI_METRIC_DATA
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_array():
+    data = json.dumps(MULTI_METRIC_DATA).encode('utf-8')
+    for size in (1, 7, len(data)):
+        assert list(iter_json_array(chunked(data, size))) == \
+            MULTI_METRIC_DATA
+
+
+def test_iter_json_array_strings():
+    items = [{'target': u'a "[{x}]" \\ \xe9', 'datapoints': []}, {}]
+    data = json.dumps(items, ensure_ascii=False).encode('utf-8')
+    assert list(iter_json_array(chunked(data, 1))) == items
+
+
+def test_iter_json_array_empty():
+    assert list(iter_json_array([b'[', b' ]'])) == []
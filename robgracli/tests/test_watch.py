@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+from ..client import GraphiteClient
+from ..watch import Watcher, SKIP
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = []
+        self.data = {}
+
+    def query_many(self, queries, from_):
+        self.calls.append((queries, from_))
+        return OrderedDict((query, self.data.get(query, {}))
+                           for query in queries)
+
+
+def test_poll():
+    client = FakeClient()
+    watcher = Watcher(client, default_step=10, lag=1)
+    received = []
+    watcher.watch(['a', 'b'], received.append)
+    client.data = {
+        'a': {'a': [[1., 980], [2., 990], [None, 1000]]},
+        'b': {'b1': [[3., 990]], 'b2': []},
+    }
+    deliveries = watcher.poll(1002)
+    assert client.calls == [(['a', 'b'], 10)]
+    (subscription, data), = deliveries
+    assert data == {
+        'a': {'a': [[1., 980], [2., 990]]},
+        'b': {'b1': [[3., 990]]},
+    }
+    # Polls are aligned on steps, plus the lag
+    assert watcher.next_due() == 1011
+    assert watcher.poll(1010) == []
+    assert len(client.calls) == 1
+
+    # Only new datapoints are delivered, held back None values included
+    client.data['a'] = {'a': [[2., 990], [None, 1000], [4., 1010]]}
+    (_, data), = watcher.poll(1011)
+    assert data == {'a': {'a': [[None, 1000], [4., 1010]]}}
+    assert client.calls[-1] == (['a', 'b'], 31)
+
+
+def test_stale_series():
+    client = FakeClient()
+    watcher = Watcher(client, default_step=10, lag=0, stale_steps=3)
+    watcher.watch(['a', 'b'], lambda data: None)
+    client.data = {
+        'a': {'a1': [[1., 990]], 'a2': [[1., 990]]},
+        'b': {'b': [[1., 990]]},
+    }
+    watcher.poll(1000)
+    # a2 stops reporting
+    for now in range(1010, 1100, 10):
+        client.data['a'] = {'a1': [[1., now - 10]], 'a2': [[None, now - 10]]}
+        client.data['b'] = {'b': [[1., now - 10]]}
+        watcher.poll(now)
+    # Polls are no longer widened once a2 is stale
+    assert [from_ for _, from_ in client.calls] == [10, 30, 40] + [30] * 7
+
+
+def test_learned_steps():
+    client = FakeClient()
+    watcher = Watcher(client, default_step=10, lag=0)
+    watcher.watch('a', lambda data: None)
+    watcher.watch('b', lambda data: None, step=30)
+    client.data = {'a': {'a': [[1., 940], [2., 1000]]}}
+    watcher.poll(1005)
+    assert watcher.targets['a'].due_at == 1020
+    assert watcher.targets['b'].due_at == 1020
+    watcher.poll(1020)
+    assert client.calls[-1][0] == ['a', 'b']
+    assert watcher.targets['a'].due_at == 1080
+    assert watcher.targets['b'].due_at == 1050
+
+
+def test_subscriptions():
+    client = FakeClient()
+    watcher = Watcher(client, lag=0)
+    first = watcher.watch(['a', 'b'], lambda data: None)
+    second = watcher.watch(['b'], lambda data: None)
+    client.data = {'b': {'b': [[1., 1000]]}}
+    deliveries = dict(watcher.poll(1000))
+    assert deliveries == {
+        first: {'b': {'b': [[1., 1000]]}},
+        second: {'b': {'b': [[1., 1000]]}},
+    }
+    first.cancel()
+    assert list(watcher.targets) == ['b']
+    second.cancel()
+    assert watcher.next_due() is None
+
+
+def test_poll_errors():
+    class FailingClient(object):
+        def query_many(self, queries, from_):
+            raise ValueError()
+
+    watcher = Watcher(FailingClient(), default_step=10, lag=0)
+    watcher.watch('a', lambda data: None)
+    assert watcher.poll(1000) == []
+    assert watcher.next_due() == 1010
+
+
+def test_skip_overdue():
+    watcher = Watcher(FakeClient(), default_step=10, lag=0)
+    watcher.watch('a', lambda data: None)
+    watcher.watch('b', lambda data: None)
+    watcher.targets['a'].due_at = 1010
+    assert watcher._skip_overdue(1035)
+    assert watcher.targets['a'].due_at == 1040
+    # Never polled
+    assert watcher.targets['b'].due_at == 0
+
+
+def test_overrun_skip():
+    watcher = Watcher(FakeClient(), max_pending=1, overrun=SKIP)
+    watcher._enqueue(('subscription', {}))
+    watcher._enqueue(('subscription', {}))
+    assert watcher.dropped == 1
+    with pytest.raises(ValueError):
+        Watcher(FakeClient(), overrun='wait')
+
+
+def test_client_watch(httpserver):
+    now = int(time.time())
+    httpserver.serve_content(json.dumps([
+        {'target': 'foo', 'datapoints': [[1., now - 1], [2., now]]},
+    ]))
+    client = GraphiteClient(httpserver.url)
+    received = []
+    delivered = threading.Event()
+
+    def callback(data):
+        received.append(data)
+        delivered.set()
+
+    subscription = client.watch('foo', callback)
+    try:
+        assert delivered.wait(5)
+    finally:
+        subscription.cancel()
+        client.watcher.stop()
+    assert received[0] == {'foo': {'foo': [[1., now - 1], [2., now]]}}
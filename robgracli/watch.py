@@ -0,0 +1,285 @@
+'''
+Subscriptions to new datapoints, polled by a scheduler aligned on the steps
+of the series (see :meth:`robgracli.client.GraphiteClient.watch`).
+'''
+import logging
+import threading
+import time
+from collections import OrderedDict
+try:
+    from queue import Queue, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Full
+
+from .aggregators import string_types
+from .series import Series
+
+
+logger = logging.getLogger(__name__)
+
+#: Policies when subscribers don't keep up with deliveries
+BLOCK = 'block'
+SKIP = 'skip'
+
+
+class Subscription(object):
+    '''
+    A set of targets watched by a callback, returned by
+    :meth:`Watcher.watch`.
+    '''
+
+    def __init__(self, watcher, targets, callback):
+        self.watcher = watcher
+        self.targets = targets
+        self.callback = callback
+
+    def cancel(self):
+        self.watcher.unwatch(self)
+
+
+class WatchedTarget(object):
+
+    def __init__(self, target, step):
+        self.target = target
+        self.step = step
+        self.due_at = 0
+        self.last_ts = {}
+        self.subscriptions = []
+
+
+class Watcher(object):
+    '''
+    Polls watched targets and delivers their new datapoints to subscribers.
+
+    Each target is polled when a new datapoint is expected: at the start of
+    its next step (learned from the responses), plus *lag* seconds to let
+    Graphite store it. All the targets due at the same time are fetched with
+    a single :meth:`~robgracli.client.GraphiteClient.query_many` call.
+
+    Callbacks are called from a delivery thread, through a queue of at most
+    *max_pending* batches. When it is full, the poller waits for it if
+    *overrun* is ``'block'``, or drops the batch if it is ``'skip'`` (the
+    ``dropped`` counter is then incremented, and the dropped datapoints are
+    not delivered). Polls are never made to catch up: when a poll cycle takes
+    longer than a step the missed polls are skipped, and the ``overruns``
+    counter is incremented. Since each poll fetches all the datapoints since
+    the last delivered ones, skipped polls lose no datapoint.
+
+    Series without new datapoints for more than *stale_steps* steps (e.g.
+    that stopped reporting) are not taken into account to compute the range
+    of polls, so they don't widen the polls of all the targets. If they
+    resume, only their datapoints of the last *stale_steps* steps are
+    delivered.
+
+    :param client: the :class:`~robgracli.client.GraphiteClient` used to
+        fetch datapoints;
+    :param default_step: the step assumed for targets until it is known;
+    :param lag: the delay between the start of a step and polls, in seconds;
+    :param max_range:
+        the maximum number of seconds of datapoints fetched by a poll;
+    :param stale_steps:
+        the number of steps after which series without new datapoints no
+        longer widen polls.
+    '''
+
+    def __init__(self, client, default_step=10, lag=1, max_range=60 * 60,
+                 max_pending=100, overrun=BLOCK, stale_steps=10):
+        if overrun not in (BLOCK, SKIP):
+            raise ValueError('invalid overrun policy: %r' % overrun)
+        self.client = client
+        self.default_step = default_step
+        self.lag = lag
+        self.max_range = max_range
+        self.stale_steps = stale_steps
+        self.overrun = overrun
+        self.targets = OrderedDict()
+        self.queue = Queue(max_pending)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.changed = threading.Event()
+        self.threads = []
+        self.overruns = 0
+        self.dropped = 0
+
+    def watch(self, targets, callback, step=None):
+        '''
+        Call *callback* with the new datapoints of *targets*, until the
+        returned :class:`Subscription` is cancelled.
+
+        *callback* receives an :class:`~collections.OrderedDict` with
+        targets as keys, and dicts of series names to new datapoints lists as
+        values. Datapoints are delivered once, in order, and trailing None
+        values are held back until they are filled or followed by a value.
+
+        *step* is the interval between the datapoints of *targets*, learned
+        from the responses if None.
+        '''
+        if isinstance(targets, string_types):
+            targets = [targets]
+        subscription = Subscription(self, list(targets), callback)
+        with self.lock:
+            for target in subscription.targets:
+                watched = self.targets.get(target)
+                if watched is None:
+                    watched = self.targets[target] = WatchedTarget(target,
+                                                                   step)
+                watched.subscriptions.append(subscription)
+        self.changed.set()
+        return subscription
+
+    def unwatch(self, subscription):
+        with self.lock:
+            for target in subscription.targets:
+                watched = self.targets.get(target)
+                if watched is None:
+                    continue
+                if subscription in watched.subscriptions:
+                    watched.subscriptions.remove(subscription)
+                if not watched.subscriptions:
+                    del self.targets[target]
+
+    def start(self):
+        '''
+        Start the poller and delivery threads.
+        '''
+        if self.threads:
+            return
+        self.stopped.clear()
+        for target in (self._run_poller, self._run_delivery):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        self.changed.set()
+        self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def poll(self, now=None):
+        '''
+        Poll the targets due at *now*, and return a list of ``(subscription,
+        data)`` pairs to deliver.
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            due = [watched for watched in self.targets.values()
+                   if watched.due_at <= now]
+        if not due:
+            return []
+        from_ = max(self._range(watched, now) for watched in due)
+        try:
+            results = self.client.query_many([w.target for w in due], from_)
+        except Exception:
+            logger.exception('error polling %d watched targets', len(due))
+            results = {}
+        deliveries = OrderedDict()
+        with self.lock:
+            for watched in due:
+                result = results.get(watched.target)
+                new = self._new_datapoints(watched, result or {})
+                self._schedule(watched, now)
+                if not new:
+                    continue
+                for subscription in watched.subscriptions:
+                    data = deliveries.get(subscription)
+                    if data is None:
+                        data = deliveries[subscription] = OrderedDict()
+                    data[watched.target] = new
+        return list(deliveries.items())
+
+    def next_due(self):
+        '''
+        Return the time of the next poll, or None if nothing is watched.
+        '''
+        with self.lock:
+            return min([w.due_at for w in self.targets.values()] or [None])
+
+    def _range(self, watched, now):
+        step = watched.step or self.default_step
+        if not watched.last_ts:
+            return step
+        stale_range = (self.stale_steps + 1) * step
+        recent = [ts for ts in watched.last_ts.values()
+                  if now - ts < stale_range]
+        query_range = now - min(recent) + step if recent else stale_range
+        return int(min(max(query_range, step), self.max_range))
+
+    def _new_datapoints(self, watched, result):
+        ret = OrderedDict()
+        for name, datapoints in result.items():
+            if isinstance(datapoints, Series):
+                datapoints = datapoints.to_datapoints()
+            if watched.step is None and len(datapoints) > 1:
+                watched.step = datapoints[-1][1] - datapoints[-2][1]
+            # Trailing None values may not be written yet
+            end = len(datapoints)
+            while end and datapoints[end - 1][0] is None:
+                end -= 1
+            last_ts = watched.last_ts.get(name)
+            new = [dp for dp in datapoints[:end]
+                   if last_ts is None or dp[1] > last_ts]
+            if new:
+                watched.last_ts[name] = new[-1][1]
+                ret[name] = new
+        return ret
+
+    def _schedule(self, watched, now):
+        step = watched.step or self.default_step
+        watched.due_at = (now - self.lag) // step * step + step + self.lag
+
+    def _run_poller(self):
+        while not self.stopped.is_set():
+            due_at = self.next_due()
+            now = time.time()
+            if due_at is None or due_at > now:
+                self.changed.clear()
+                self.changed.wait(None if due_at is None else due_at - now)
+                continue
+            for delivery in self.poll(now):
+                self._enqueue(delivery)
+            if self._skip_overdue(time.time()):
+                self.overruns += 1
+
+    def _skip_overdue(self, now):
+        '''
+        Reschedule the targets already polled whose next poll is overdue at
+        *now*. Return True if there were any.
+        '''
+        skipped = False
+        with self.lock:
+            for watched in self.targets.values():
+                if watched.due_at and watched.due_at <= now:
+                    self._schedule(watched, now)
+                    skipped = True
+        return skipped
+
+    def _enqueue(self, delivery):
+        if self.overrun == BLOCK:
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(delivery, timeout=1)
+                    return
+                except Full:
+                    continue
+        else:
+            try:
+                self.queue.put_nowait(delivery)
+            except Full:
+                self.dropped += 1
+
+    def _run_delivery(self):
+        while True:
+            delivery = self.queue.get()
+            if delivery is None:
+                break
+            subscription, data = delivery
+            try:
+                subscription.callback(data)
+            except Exception:
+                logger.exception('error in watch callback %r',
+                                 subscription.callback)
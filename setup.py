@@ -18,6 +18,12 @@ dev_requires = [
 install_requires = [
     'requests>=2.4.0',
 ]
+async_requires = [
+    'aiohttp>=3.3',
+]
+numpy_requires = [
+    'numpy',
+]
 
 
 class PyTest(TestCommand):
@@ -49,6 +55,8 @@ setup(
     extras_require={
         'tests': tests_requires,
         'dev': dev_requires,
+        'async': async_requires,
+        'numpy': numpy_requires,
     },
     tests_require=tests_requires,
     cmdclass={'test': PyTest},